@@ -0,0 +1,94 @@
+"""
+Answer extraction and voting over the evidences of a question.
+
+The answer spans of an evidence, a B tag and the I tags after it, are turned
+into strings with the evidence tokens. Every span is a vote for its string,
+weighing 1 or the CRF probability of the span when scores are given, and the
+string with the most votes answers the question. A question without any
+span is answered no_answer, one none of whose evidences makes a sample gets
+no record.
+
+Records are written as json lines:
+    {"q_idx": 0, "question": "...", "answer": "...",
+     "votes": [["answer", 3.0], ...]}
+"""
+import json
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+
+import crf
+import reader
+
+__all__ = ["tag_spans", "span_texts", "vote", "answer_records",
+           "write_records"]
+
+
+def tag_spans(tags, settings):
+    """
+    :param tags: decoded tags of an evidence
+    :param settings: reader settings, for the label schema
+    :type settings: reader.Settings
+    :return: (start, end, weight) of each answer span, every weight is 1
+    :rtype: list
+    """
+    return [(start, end, 1.)
+            for start, end in crf.extract_spans(tags, settings.B, settings.I)]
+
+
+def span_texts(tokens, spans):
+    """
+    :param tokens: evidence tokens
+    :type tokens: list
+    :param spans: (start, end, weight) of each span
+    :type spans: list
+    :return: (answer, weight) of each span
+    :rtype: list
+    """
+    return [("".join(tokens[start:end]), weight)
+            for start, end, weight in spans]
+
+
+def vote(answers):
+    """
+    :param answers: (answer, weight) of all spans of a question
+    :type answers: list
+    :return: [answer, votes] sorted by decreasing votes, ties in the order
+        the answers first occur
+    :rtype: list
+    """
+    votes = defaultdict(float)
+    first = {}
+    for answer, weight in answers:
+        votes[answer] += weight
+        first.setdefault(answer, len(first))
+    return sorted(
+        [[answer, v] for answer, v in votes.iteritems()],
+        key=lambda item: (-item[1], first[item[0]]))
+
+
+def answer_records(samples):
+    """
+    Answer questions as their samples arrive
+
+    :param samples: (q_idx, (question tokens, evidence tokens), spans) of
+        every sample in the order of the data file, spans are the (start,
+        end, weight) of its answer spans, see reader.TOKENS
+    :return: a generator of one record per question
+    """
+    for q_idx, group in groupby(samples, key=itemgetter(0)):
+        answers = []
+        for _, (question, tokens), spans in group:
+            answers.extend(span_texts(tokens, spans))
+        votes = vote(answers)
+        yield {
+            "q_idx": q_idx,
+            "question": "".join(question),
+            "answer": votes[0][0] if votes else reader.NO_ANSWER,
+            "votes": votes
+        }
+
+
+def write_records(records, output):
+    for record in records:
+        print >> output, json.dumps(record, ensure_ascii=False).encode("utf-8")
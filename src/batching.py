@@ -0,0 +1,164 @@
+"""
+Length-bucketed batching.
+
+Samples are read into a window, sorted by evidence length and cut into
+batches of similar lengths, limited by the number of samples and optionally
+by a token budget. For inference the original position of every sample is
+kept so the results can be put back in order with restore_order.
+"""
+import random
+from itertools import izip
+
+import reader
+
+__all__ = ["batch", "bucket_batch", "split_results", "restore_order"]
+
+
+def evidence_length(sample):
+    return len(sample[reader.E_IDS])
+
+
+def _cut_batches(samples, batch_size, max_tokens):
+    """
+    Cut samples sorted by evidence length into batches
+    """
+    batch, longest = [], 0
+    for item in samples:
+        length = evidence_length(item[1])
+        too_many = len(batch) >= batch_size
+        # every evidence costs as much as the longest one of the batch
+        too_long = max_tokens > 0 and \
+            max(longest, length) * (len(batch) + 1) > max_tokens
+        if batch and (too_many or too_long):
+            yield batch
+            batch, longest = [], 0
+        batch.append(item)
+        longest = max(longest, length)
+    if batch:
+        yield batch
+
+
+def bucket_batch(reader_creator,
+                 batch_size,
+                 window,
+                 max_tokens=0,
+                 shuffle=True,
+                 keep_index=False,
+                 rng=None):
+    """
+    Create a batched reader grouping samples of similar evidence lengths
+
+    :param reader_creator: a function returning an iterable of samples
+    :type reader_creator: callable
+    :param batch_size: maximum number of samples in a batch
+    :type batch_size: int
+    :param window: number of samples sorted together
+    :type window: int
+    :param max_tokens: if positive, the maximum of the number of samples in a
+        batch times its longest evidence length
+    :type max_tokens: int
+    :param shuffle: shuffle the batches of a window, for training
+    :type shuffle: bool
+    :param keep_index: yield (indices, batch) where indices are the positions
+        of the samples in the input, for restore_order
+    :type keep_index: bool
+    :param rng: the random generator shuffling the batches, the random module
+        by default
+    :type rng: random.Random
+    :return: a function returning an iterable of batches
+    :rtype: callable
+    """
+
+    rng = rng or random
+
+    def flush(pending):
+        pending.sort(key=lambda item: evidence_length(item[1]))
+        batches = list(_cut_batches(pending, batch_size, max_tokens))
+        if shuffle:
+            rng.shuffle(batches)
+        for b in batches:
+            samples = [sample for i, sample in b]
+            if keep_index:
+                yield [i for i, sample in b], samples
+            else:
+                yield samples
+
+    def batch_reader():
+        pending = []
+        for item in enumerate(reader_creator()):
+            pending.append(item)
+            if len(pending) >= window:
+                for b in flush(pending):
+                    yield b
+                pending = []
+        for b in flush(pending):
+            yield b
+
+    return batch_reader
+
+
+def batch(reader_creator, batch_size, window=0, max_tokens=0, shuffle=True,
+          keep_index=False, rng=None):
+    """
+    Batch samples in arrival order, or by evidence length if window is
+    positive. See bucket_batch for the parameters.
+    """
+    if window > 0:
+        return bucket_batch(reader_creator, batch_size, window, max_tokens,
+                            shuffle, keep_index, rng)
+
+    def batch_reader():
+        samples, start = [], 0
+        for sample in reader_creator():
+            samples.append(sample)
+            if len(samples) >= batch_size:
+                yield (range(start, start + len(samples)), samples) \
+                    if keep_index else samples
+                start += len(samples)
+                samples = []
+        if samples:
+            yield (range(start, start + len(samples)), samples) \
+                if keep_index else samples
+
+    return batch_reader
+
+
+def split_results(results, batch):
+    """
+    Split the per-token results of a batch, e.g. the decoded tags, by sample
+
+    :param results: one result per evidence token of the batch
+    :param batch: the samples of the batch
+    :type batch: list
+    :return: the results of each sample
+    :rtype: list
+    """
+    ret, start = [], 0
+    for sample in batch:
+        end = start + evidence_length(sample)
+        ret.append(results[start:end])
+        start = end
+    if start != len(results):
+        raise ValueError("%d results for %d evidence tokens" %
+                         (len(results), start))
+    return ret
+
+
+def restore_order(indexed_results):
+    """
+    Put the results of bucketed batches back in the input order
+
+    :param indexed_results: an iterable of (indices, results) where results
+        has one item per index
+    :return: a generator of the results in the order of their indices
+    """
+    pending = {}
+    next_idx = 0
+    for indices, results in indexed_results:
+        for i, result in izip(indices, results):
+            pending[i] = result
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
+    if pending:
+        raise ValueError("missing results before index %d" % next_idx)
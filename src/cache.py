@@ -0,0 +1,124 @@
+"""
+A content addressed cache of inference results.
+
+A sample is keyed by a hash of everything the network reads from it, the
+question and evidence token ids and the q-e.comm and e-e.comm features,
+together with a fingerprint of the model file. Results of a different model
+are therefore never returned, and a cache saved to disk is dropped when it is
+loaded for another model.
+"""
+import cPickle as pickle
+import hashlib
+import os
+
+import numpy
+
+import reader
+import utils
+from utils import logger
+
+__all__ = ["model_fingerprint", "ResultCache"]
+
+# the parts of a sample read by the network
+_INPUTS = (reader.Q_IDS, reader.E_IDS, reader.QE_COMM, reader.EE_COMM)
+
+
+def model_fingerprint(model_path):
+    """
+    :return: the sha1 of the content of the model file
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(model_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ResultCache(utils.LRUCache):
+    """
+    Cache the results of samples with size and TTL based eviction
+    """
+
+    def __init__(self, capacity, ttl=0, path=None):
+        """
+        :param capacity: maximum number of results, 0 disables the cache
+        :type capacity: int
+        :param ttl: lifetime of the results in seconds, 0 for no expiry
+        :type ttl: float
+        :param path: file the cache is loaded from and saved to, the cache
+            is kept in memory only if None
+        :type path: str
+        """
+        super(ResultCache, self).__init__(capacity, ttl)
+        self.path = path
+        self.fingerprint = ""
+
+    def bind(self, model_path):
+        """
+        Use the cache for the results of a model, the results of another
+        model are dropped
+        """
+        fingerprint = model_fingerprint(model_path)
+        if fingerprint != self.fingerprint:
+            self.clear()
+            self.fingerprint = fingerprint
+
+    def key(self, sample):
+        sha1 = hashlib.sha1(self.fingerprint)
+        for i in _INPUTS:
+            data = numpy.asarray(sample[i], dtype="int64")
+            sha1.update(str(len(data)))
+            sha1.update(data.tostring())
+        return sha1.digest()
+
+    def infer(self, samples, infer_batch):
+        """
+        Look up the results of samples, the missing ones are computed by
+        infer_batch and cached
+
+        :param samples: samples, see reader.SampleStream
+        :type samples: list
+        :param infer_batch: a function mapping a list of samples to a list of
+            results, one per sample
+        :type infer_batch: callable
+        :return: one result per sample
+        :rtype: list
+        """
+        keys = [self.key(s) for s in samples]
+        results = [self.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            computed = infer_batch([samples[i] for i in missing])
+            for i, result in zip(missing, computed):
+                results[i] = result
+                self.put(keys[i], result)
+        return results
+
+    def load(self):
+        """
+        Load the results saved by a cache of the same model
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            fingerprint, items = pickle.load(f)
+        if fingerprint != self.fingerprint:
+            logger.info("drop the result cache %s of another model" %
+                        self.path)
+            return
+        with self.lock:
+            for key, item in items:
+                self.items[key] = item
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            items = self.items.items()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.fingerprint, items), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,290 @@
+"""
+Asynchronous checkpoints of the training.
+
+At the end of a pass the parameters are copied out of paddle with the model
+average applied, as trainer.save_parameter_to_tar does, and a background
+thread compresses and writes them to model_save_dir/params_pass_%05d.tar.gz
+in the format of paddle, so the next pass starts at once. The parameters
+being trained, without the model average, are written next to them as
+params_pass_%05d.raw.tar.gz, a resumed training goes on from those. A
+checkpoint is written to a temporary file and renamed, a killed job never
+leaves a truncated one. The state of the training, e.g. the random generators, the
+order of the samples and the read positions of the data shards, is written
+next to the parameters as params_pass_%05d.json. Old checkpoints are removed except the last keep
+ones, the best one of the validation log written by val_and_test.py and the
+ones it has not evaluated yet.
+
+The v2 API does not expose the state of the optimizer: when training is
+resumed from a checkpoint, the RMSProp moments and the model average start
+from zero again.
+"""
+import gzip
+import json
+import os
+import re
+import tarfile
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import paddle.v2 as paddle
+
+import numpy_infer
+import pipeline
+import utils
+import val_and_test
+from utils import logger
+
+__all__ = [
+    "checkpoint_path", "raw_checkpoint_path", "state_path", "list_checkpoints", "latest_checkpoint",
+    "restore", "load_state", "Checkpointer"
+]
+
+CHECKPOINT_PATTERN = re.compile(r"^params_pass_(\d+)\.tar\.gz$")
+
+
+def checkpoint_path(model_dir, pass_id):
+    return os.path.join(model_dir, "params_pass_%05d.tar.gz" % pass_id)
+
+
+def raw_checkpoint_path(model_dir, pass_id):
+    return os.path.join(model_dir, "params_pass_%05d.raw.tar.gz" % pass_id)
+
+
+def state_path(model_dir, pass_id):
+    return os.path.join(model_dir, "params_pass_%05d.json" % pass_id)
+
+
+def list_checkpoints(model_dir):
+    """
+    :return: the sorted pass ids of the checkpoints in model_dir
+    :rtype: list
+    """
+    if not os.path.isdir(model_dir):
+        return []
+    pass_ids = []
+    for name in os.listdir(model_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match:
+            pass_ids.append(int(match.group(1)))
+    return sorted(pass_ids)
+
+
+def latest_checkpoint(model_dir):
+    """
+    :return: the pass id of the last checkpoint in model_dir, None if there
+        is not any
+    """
+    pass_ids = list_checkpoints(model_dir)
+    return pass_ids[-1] if pass_ids else None
+
+
+def restore(parameters, model_dir, pass_id):
+    """
+    Set the parameters to the values being trained when a checkpoint was
+    saved, before the trainer is created. The values with the model average
+    applied are used if the checkpoint has no raw values.
+
+    :param parameters: the parameters created in a model
+    :type parameters: paddle.parameters.Parameters
+    """
+    path = raw_checkpoint_path(model_dir, pass_id)
+    if not os.path.exists(path):
+        path = checkpoint_path(model_dir, pass_id)
+        logger.info("no raw parameters in %s, the averaged ones are "
+                    "trained on" % path)
+    with utils.open_file(path, "r") as f:
+        saved = paddle.parameters.Parameters.from_tar(f)
+    for name in parameters.names():
+        parameters.set(name, saved.get(name))
+    logger.info("parameters restored from %s" % path)
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name=name)
+    info.size = len(data)
+    tar.addfile(info, StringIO(data))
+
+
+def load_state(model_dir, pass_id):
+    """
+    :return: the state of the training saved with a checkpoint, empty if
+        none was saved
+    :rtype: dict
+    """
+    path = state_path(model_dir, pass_id)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_tar(values, confs, f):
+    """
+    Write parameters in the tar format of paddle
+
+    :param values: the values of the parameters keyed by names, in order
+    :type values: OrderedDict
+    :param confs: the serialized ParameterConfig of the parameters
+    :type confs: dict
+    :param f: a binary file
+    :type f: file
+    """
+    tar = tarfile.TarFile(fileobj=f, mode="w")
+    for name, value in values.iteritems():
+        value = value.astype("<f4")
+        header = numpy_infer.PARAM_HEADER.pack(0, 4, value.size)
+        _add_member(tar, name, header + value.tostring())
+        _add_member(tar, name + ".protobuf", confs[name])
+    tar.close()
+
+
+class Checkpointer(object):
+    """
+    Save the parameters at the end of every pass in a background thread
+
+    Usage:
+        with Checkpointer(conf.model_save_dir) as checkpointer:
+            ...
+            checkpointer.save(trainer, parameters, pass_id)
+    """
+
+    def __init__(self, model_dir, keep=0, eval_log=""):
+        """
+        :param model_dir: dir of the checkpoints
+        :type model_dir: str
+        :param keep: number of the last checkpoints kept, 0 to keep all
+        :type keep: int
+        :param eval_log: validation log of val_and_test.py, "" to keep only
+            the last checkpoints
+        :type eval_log: str
+        """
+        self.model_dir = model_dir
+        self.keep = keep
+        self.eval_log = eval_log
+        self.confs = None
+        # static parameters, e.g. wordvecs, are copied once
+        self.static_values = {}
+        # one checkpoint is written while the next one waits, save blocks
+        # when the writing falls behind by more than that
+        self.writer = pipeline.BackgroundWriter(self.write_all, 1)
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def copy_values(self, parameters):
+        """
+        :return: copies of the current parameter values, keyed by names
+        :rtype: OrderedDict
+        """
+        values = OrderedDict()
+        for name in parameters.names():
+            if name not in self.static_values:
+                # get copies the values out of the gradient machine
+                value = parameters.get(name)
+                if parameters.__param_conf__[name].is_static:
+                    self.static_values[name] = value
+                values[name] = value
+            else:
+                values[name] = self.static_values[name]
+        return values
+
+    def snapshot(self, trainer, parameters):
+        """
+        :return: copies of the parameter values being trained and of the
+            values with the model average applied, keyed by names
+        :rtype: tuple
+        """
+        if self.confs is None:
+            self.confs = dict(
+                (name, parameters.__param_conf__[name].SerializeToString())
+                for name in parameters.names())
+
+        updater = trainer.__parameter_updater__
+        updater.catchUpWith()
+        raw_values = self.copy_values(parameters)
+        updater.apply()
+        try:
+            values = self.copy_values(parameters)
+        finally:
+            updater.restore()
+        return raw_values, values
+
+    def save(self, trainer, parameters, pass_id, state=None):
+        """
+        Snapshot the parameters and queue them to be written
+
+        :param state: the state of the training at the end of the pass,
+            written as json, see load_state
+        :type state: dict
+        """
+        raw_values, values = self.snapshot(trainer, parameters)
+        self.writer.put((pass_id, raw_values, values, state))
+
+    def write_all(self, checkpoints):
+        for pass_id, raw_values, values, state in checkpoints:
+            self.write(pass_id, raw_values, values, state)
+            self.prune()
+
+    def write_values(self, values, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                write_tar(values, self.confs, gz)
+        os.rename(tmp_path, path)
+
+    def write(self, pass_id, raw_values, values, state=None):
+        # the state and the raw values are written first, a checkpoint is
+        # complete when its averaged parameters are renamed
+        if state is not None:
+            path = state_path(self.model_dir, pass_id)
+            with open(path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.rename(path + ".tmp", path)
+        self.write_values(raw_values,
+                          raw_checkpoint_path(self.model_dir, pass_id))
+
+        path = checkpoint_path(self.model_dir, pass_id)
+        self.write_values(values, path)
+        logger.info("model saved to %s" % path)
+
+    def kept_checkpoints(self, pass_ids):
+        """
+        :return: the pass ids of the checkpoints not to remove
+        :rtype: set
+        """
+        if self.keep <= 0:
+            return set(pass_ids)
+        kept = set(pass_ids[-self.keep:])
+        if not self.eval_log:
+            return kept
+
+        evals = {}
+        if os.path.exists(self.eval_log):
+            try:
+                evals = val_and_test.load_existing_results(self.eval_log)
+                if evals:
+                    kept.add(val_and_test.find_best_pass(evals))
+            except (ValueError, AttributeError):
+                # the log is being written by val_and_test.py
+                logger.info("can not read %s, no checkpoint removed" %
+                            self.eval_log)
+                return set(pass_ids)
+        kept.update(pass_id for pass_id in pass_ids if pass_id not in evals)
+        return kept
+
+    def prune(self):
+        pass_ids = list_checkpoints(self.model_dir)
+        kept = self.kept_checkpoints(pass_ids)
+        for pass_id in pass_ids:
+            if pass_id not in kept:
+                path = checkpoint_path(self.model_dir, pass_id)
+                os.remove(path)
+                logger.info("removed %s" % path)
+                for path in (raw_checkpoint_path(self.model_dir, pass_id),
+                             state_path(self.model_dir, pass_id)):
+                    if os.path.exists(path):
+                        os.remove(path)
@@ -0,0 +1,375 @@
+"""
+A pre-compiled columnar format of the samples produced by
+reader.SampleStream.
+
+Compiling parses the json(.gz) file, maps labels and tokens to ids and
+regroups the ee.comm features once. The result is a directory of .npy
+columns which are memory-mapped by CompiledSampleStream:
+
+    q_offsets, q_ids           question token ids, one row per question
+    q_idx, question, type      per sample: line index in the source file, row
+                               in the question columns, evidence type code
+    e_offsets                  per sample: rows of e_ids, labels and qe_comm
+    e_ids, labels, qe_comm     concatenated evidence columns
+    ee_cand_offsets            per sample: candidate rows of ee_comm
+    ee_offsets, ee_negative    per candidate: rows of ee_comm, 1 if the
+                               candidate belongs to the grouped negative bucket
+    ee_comm                    concatenated ee.comm candidates
+
+Usage:
+    python corpus.py data/data/training.json.gz --training
+"""
+import argparse
+import json
+import os
+from array import array
+
+import numpy
+
+import config
+import embedding
+import reader
+import utils
+from datapoint import Evidence
+from utils import logger
+
+__all__ = [
+    "COMPILED_SUFFIX", "ColumnBuilder", "SampleColumns",
+    "CompiledSampleStream", "compiled_path", "is_compiled", "find_compiled",
+    "compile_corpus"
+]
+
+VERSION = 1
+COMPILED_SUFFIX = ".cols"
+META_FILE = "meta.json"
+
+# evidence types are stored as small integer codes
+TYPES = (Evidence.POSITIVE, Evidence.HIT_ANS_NEGATIVE, Evidence.OTHER_NEGATIVE)
+TYPE_CODES = {t: i for i, t in enumerate(TYPES)}
+
+COLUMNS = {
+    "q_offsets": "int64",
+    "q_ids": "int32",
+    "q_idx": "int32",
+    "question": "int32",
+    "type": "uint8",
+    "e_offsets": "int64",
+    "e_ids": "int32",
+    "labels": "uint8",
+    "qe_comm": "uint8",
+    "ee_cand_offsets": "int64",
+    "ee_offsets": "int64",
+    "ee_negative": "uint8",
+    "ee_comm": "uint8",
+}
+
+# typecodes of array.array used while building the columns
+_TYPECODES = {"int64": "l", "int32": "i", "uint8": "B"}
+
+
+def compiled_path(filename):
+    """
+    :return: the default path of the compiled version of filename
+    :rtype: str
+    """
+    return filename.rstrip("/") + COMPILED_SUFFIX
+
+
+def is_compiled(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+# the fingerprints of the vocabularies used in this process, keyed by their
+# ids, the vocabularies are kept so their ids are not reused
+_fingerprints = {}
+
+
+def vocab_fingerprint(vocab):
+    """
+    :return: embedding.fingerprint of vocab, computed once
+    :rtype: int
+    """
+    if id(vocab) not in _fingerprints:
+        _fingerprints[id(vocab)] = (vocab, embedding.fingerprint(vocab))
+    return _fingerprints[id(vocab)][1]
+
+
+def settings_meta(settings):
+    """
+    :return: the settings the compiled samples depend on
+    :rtype: dict
+    """
+    return {
+        "is_training": settings.is_training,
+        "label_map": {k: v
+                      for k, v in settings.label_map.iteritems()
+                      if k.isupper()},
+        "keep_first_b": settings.keep_first_b,
+        "vocab_size": len(settings.vocab),
+        # the token ids change with the tokens of the vocabulary
+        "vocab_fingerprint": vocab_fingerprint(settings.vocab),
+    }
+
+
+class ColumnBuilder(object):
+    """
+    Accumulate samples into flat typed columns
+    """
+
+    def __init__(self):
+        self.columns = {
+            name: array(_TYPECODES[dtype])
+            for name, dtype in COLUMNS.iteritems()
+        }
+        for name in ("q_offsets", "e_offsets", "ee_cand_offsets",
+                     "ee_offsets"):
+            self.columns[name].append(0)
+        self._last_q_idx = None
+
+    def __len__(self):
+        return len(self.columns["q_idx"])
+
+    def add(self, q_idx, sample, type_):
+        """
+        Append one sample as yielded by reader.SampleStream
+        """
+        c = self.columns
+        if q_idx != self._last_q_idx:
+            c["q_ids"].extend(sample[reader.Q_IDS])
+            c["q_offsets"].append(len(c["q_ids"]))
+            self._last_q_idx = q_idx
+
+        c["q_idx"].append(q_idx)
+        c["question"].append(len(c["q_offsets"]) - 2)
+        c["type"].append(TYPE_CODES[type_])
+
+        c["e_ids"].extend(sample[reader.E_IDS])
+        c["labels"].extend(sample[reader.LABELS])
+        c["qe_comm"].extend(sample[reader.QE_COMM])
+        c["e_offsets"].append(len(c["e_ids"]))
+
+        feats, offsets, positive_num, negative_num = sample[reader.EE_COMM]
+        for k in xrange(positive_num + negative_num):
+            # the negative candidates are the grouped negative bucket
+            self._add_ee_comm(feats[offsets[k]:offsets[k + 1]],
+                              int(k >= positive_num))
+        c["ee_cand_offsets"].append(len(c["ee_negative"]))
+
+    def _add_ee_comm(self, feats, negative):
+        c = self.columns
+        c["ee_comm"].extend(feats)
+        c["ee_offsets"].append(len(c["ee_comm"]))
+        c["ee_negative"].append(negative)
+
+    def build(self):
+        """
+        :rtype: SampleColumns
+        """
+        return SampleColumns({
+            name: numpy.frombuffer(self.columns[name],
+                                   dtype=self.columns[name].typecode).astype(
+                                       dtype, copy=False)
+            for name, dtype in COLUMNS.iteritems()
+        })
+
+
+class SampleColumns(object):
+    """
+    Samples stored in flat columns, see the module documentation
+    """
+
+    def __init__(self, columns):
+        """
+        :param columns: numpy arrays keyed by the names in COLUMNS
+        :type columns: dict
+        """
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["q_idx"])
+
+    def _rows(self, name, offsets, i):
+        start, end = self.columns[offsets][i:i + 2]
+        return self.columns[name][start:end]
+
+    def sample(self, i):
+        """
+        :return: the i-th sample in the format of reader.SampleStream
+        :rtype: list
+        """
+        c = self.columns
+        ret = [None] * 5
+        ret[reader.Q_IDS] = self._rows("q_ids", "q_offsets",
+                                       c["question"][i]).tolist()
+        ret[reader.E_IDS] = self._rows("e_ids", "e_offsets", i).tolist()
+        ret[reader.LABELS] = self._rows("labels", "e_offsets", i).tolist()
+        ret[reader.QE_COMM] = self._rows("qe_comm", "e_offsets", i).tolist()
+
+        # the candidates are stored as reader.make_eecom_table makes them,
+        # the positive ones first
+        first, last = c["ee_cand_offsets"][i:i + 2]
+        ee_offsets = c["ee_offsets"][first:last + 1]
+        negative_num = c["ee_negative"][first:last].tolist().count(1)
+        ret[reader.EE_COMM] = (
+            c["ee_comm"][ee_offsets[0]:ee_offsets[-1]].tolist(),
+            (ee_offsets - ee_offsets[0]).tolist(), last - first - negative_num,
+            negative_num)
+        return ret
+
+    def q_idx(self, i):
+        return int(self.columns["q_idx"][i])
+
+    def type(self, i):
+        return TYPES[self.columns["type"][i]]
+
+    def __getitem__(self, i):
+        return self.q_idx(i), self.sample(i), self.type(i)
+
+    def save(self, path, meta):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in COLUMNS:
+            numpy.save(os.path.join(path, name + ".npy"), self.columns[name])
+        # meta.json is written last, it marks the directory as complete
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        columns = {
+            name: numpy.load(
+                os.path.join(path, name + ".npy"),
+                mmap_mode="r" if mmap else None)
+            for name in COLUMNS
+        }
+        return cls(columns)
+
+
+def load_meta(path):
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+class CompiledSampleStream(object):
+    """
+    A drop-in replacement of reader.SampleStream reading compiled samples
+    """
+
+    def __init__(self, path, settings, start=0, step=1):
+        """
+        :param path: directory written by compile_corpus
+        :type path: str
+        :param settings: reader settings, they must match the ones used for
+            compiling
+        :type settings: reader.Settings
+        :param start: q_idx of the first question read
+        :type start: int
+        :param step: only every step-th question from start is read
+        :type step: int
+        """
+        self.path = path
+        self.settings = settings
+        self.start = start
+        self.step = step
+        meta = load_meta(path)
+        if meta["version"] != VERSION:
+            raise ValueError("unsupported version %d of %s" %
+                             (meta["version"], path))
+        if meta["settings"] != settings_meta(settings):
+            raise ValueError("%s was compiled with different settings: %s" %
+                             (path, meta["settings"]))
+        self.columns = SampleColumns.load(path)
+
+    def __iter__(self):
+        columns = self.columns
+        q_idx = columns.columns["q_idx"]
+        # the samples are in the order of the questions
+        first = int(numpy.searchsorted(q_idx, self.start))
+        if self.step == 1:
+            rows = xrange(first, len(columns))
+        else:
+            rows = numpy.flatnonzero(
+                (q_idx[first:] - self.start) % self.step == 0) + first
+        for i in rows:
+            yield columns[i]
+
+
+def find_compiled(filename, settings):
+    """
+    Find the compiled version of filename written by compile_corpus
+
+    :return: its path if it is up to date and compiled with settings, None
+        otherwise
+    :rtype: str
+    """
+    path = compiled_path(filename)
+    if not is_compiled(path):
+        return None
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.getmtime(meta_path) < os.path.getmtime(filename):
+        return None
+    meta = load_meta(path)
+    if meta["version"] != VERSION or \
+            meta["settings"] != settings_meta(settings):
+        logger.info("%s was compiled with other settings or vocabulary, "
+                    "compile it again with corpus.py" % path)
+        return None
+    return path
+
+
+def compile_corpus(filename, output_path, settings):
+    """
+    Compile the samples in filename
+
+    :param filename: json(.gz) data file
+    :type filename: str
+    :param output_path: output directory
+    :type output_path: str
+    :param settings: reader settings
+    :type settings: reader.Settings
+    """
+    builder = ColumnBuilder()
+    for q_idx, sample, type_ in reader.SampleStream(filename, settings):
+        builder.add(q_idx, sample, type_)
+
+    meta = {
+        "version": VERSION,
+        "source": os.path.abspath(filename),
+        "num_samples": len(builder),
+        "settings": settings_meta(settings),
+    }
+    builder.build().save(output_path, meta)
+    logger.info("%d samples compiled to %s" % (len(builder), output_path))
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path")
+    parser.add_argument(
+        "--output", help="output directory, default to data_path.cols")
+    parser.add_argument(
+        "--training",
+        action="store_true",
+        help="compile with the training settings")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.training:
+        conf = config.TrainingConfig()
+    else:
+        conf = config.InferConfig()
+    vocab = utils.load_dict(conf.word_dict_path, conf.wordvecs_bin_path)
+
+    settings = reader.Settings(
+        vocab=vocab,
+        is_training=args.training,
+        label_schema=conf.label_schema,
+        keep_first_b=getattr(conf, "keep_first_b", False),
+        num_workers=conf.num_reader_workers)
+    compile_corpus(args.data_path, args.output or
+                   compiled_path(args.data_path), settings)
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
@@ -0,0 +1,283 @@
+"""
+Batched linear chain CRF decoding in numpy.
+
+The CRF parameter _crf.w0 has label_num + 2 rows: the start weights, the end
+weights and the label_num x label_num transition weights, as used by the
+crf and crf_decoding layers of paddle. Emissions are padded to
+(batch, max_len, label_num), lengths gives the real length of each row.
+
+Besides Viterbi decoding, forward-backward gives the marginal probability of
+every tag and of every answer span, a B tag followed by I tags, so answers
+can be ranked by a probability instead of a single best path.
+"""
+import numpy
+
+__all__ = [
+    "split_crf_weights", "viterbi", "forward_backward", "marginals",
+    "span_log_probs", "score_spans", "top_spans", "extract_spans"
+]
+
+
+def split_crf_weights(crf_w, label_num):
+    """
+    :return: start weights, end weights, transition weights
+    :rtype: tuple
+    """
+    crf_w = numpy.asarray(crf_w).reshape(label_num + 2, label_num)
+    return crf_w[0], crf_w[1], crf_w[2:]
+
+
+def viterbi(emissions, lengths, crf_w):
+    """
+    Find the best tag sequence of every row
+
+    :param emissions: padded emission scores, (batch, max_len, label_num)
+    :type emissions: numpy array
+    :param lengths: length of every row, all positive
+    :type lengths: numpy array
+    :param crf_w: the CRF parameter
+    :type crf_w: numpy array
+    :return: padded best tags, (batch, max_len)
+    :rtype: numpy array
+    """
+    batch_size, max_len, label_num = emissions.shape
+    lengths = numpy.asarray(lengths)
+    start, end, trans = split_crf_weights(crf_w, label_num)
+
+    alpha = start + emissions[:, 0]
+    track = numpy.zeros((batch_size, max_len, label_num), dtype="int64")
+    for t in xrange(1, max_len):
+        # scores[b, j, i]: best path ending with j at t - 1 then i at t
+        scores = alpha[:, :, None] + trans[None]
+        track[:, t] = scores.argmax(axis=1)
+        active = (t < lengths)[:, None]
+        alpha = numpy.where(active, scores.max(axis=1) + emissions[:, t],
+                            alpha)
+
+    rows = numpy.arange(batch_size)
+    cur = (alpha + end).argmax(axis=1)
+    tags = numpy.zeros((batch_size, max_len), dtype="int64")
+    for t in xrange(max_len - 1, -1, -1):
+        valid = t < lengths
+        tags[valid, t] = cur[valid]
+        step = valid & (t > 0)
+        cur[step] = track[rows[step], t, cur[step]]
+    return tags
+
+
+def logsumexp(x, axis):
+    x_max = x.max(axis=axis)
+    x_max = numpy.where(numpy.isfinite(x_max), x_max, 0.)
+    with numpy.errstate(divide="ignore"):
+        return numpy.log(
+            numpy.exp(x - numpy.expand_dims(x_max, axis)).sum(axis=axis)) + \
+            x_max
+
+
+def forward_backward(emissions, lengths, crf_w):
+    """
+    Run the forward and backward algorithms in log space
+
+    :return: alpha, (batch, max_len, label_num), the log score of all paths
+        ending with each tag at each step, emissions included; beta, of the
+        same shape, the log score of all continuations after each tag at each
+        step, the end weights included; and the log partition of every row
+    :rtype: tuple
+    """
+    batch_size, max_len, label_num = emissions.shape
+    lengths = numpy.asarray(lengths)
+    emissions = emissions.astype("float64")
+    start, end, trans = split_crf_weights(crf_w, label_num)
+
+    alpha = numpy.empty((batch_size, max_len, label_num))
+    alpha[:, 0] = start + emissions[:, 0]
+    for t in xrange(1, max_len):
+        alpha[:, t] = logsumexp(
+            alpha[:, t - 1, :, None] + trans[None], axis=1) + emissions[:, t]
+
+    beta = numpy.empty((batch_size, max_len, label_num))
+    beta[:, max_len - 1] = end
+    for t in xrange(max_len - 2, -1, -1):
+        step = logsumexp(
+            trans[None] + (emissions[:, t + 1] + beta[:, t + 1])[:, None],
+            axis=2)
+        beta[:, t] = numpy.where((t >= lengths - 1)[:, None], end, step)
+
+    last = alpha[numpy.arange(batch_size), lengths - 1]
+    return alpha, beta, logsumexp(last + end, axis=1)
+
+
+def marginals(emissions, lengths, crf_w):
+    """
+    :return: the probability of every tag at every step, (batch, max_len,
+        label_num), zero in the padding
+    :rtype: numpy array
+    """
+    alpha, beta, log_z = forward_backward(emissions, lengths, crf_w)
+    probs = numpy.exp(alpha + beta - log_z[:, None, None])
+    mask = numpy.arange(emissions.shape[1])[None, :] < \
+        numpy.asarray(lengths)[:, None]
+    return probs * mask[:, :, None]
+
+
+def _span_parts(emissions, lengths, crf_w, b_label, i_label):
+    """
+    :return: the log probabilities of the paths before each B, with the B,
+        the cumulated I emissions, the log scores after a span ending with a
+        B or an I at each step, and the transition weights
+    :rtype: tuple
+    """
+    batch_size, max_len, label_num = emissions.shape
+    start, end, trans = split_crf_weights(crf_w, label_num)
+    alpha, beta, log_z = forward_backward(emissions, lengths, crf_w)
+    emissions = emissions.astype("float64")
+    last_step = (numpy.arange(max_len)[None, :] == lengths[:, None] - 1)
+
+    # log score of everything after a span ending at e with tag l, the next
+    # tag must not be I
+    following = numpy.full((batch_size, max_len, label_num), -numpy.inf)
+    following[:, :-1] = emissions[:, 1:] + beta[:, 1:]
+    following[:, :, i_label] = -numpy.inf
+    tails = {}
+    for label in (b_label, i_label):
+        tail = logsumexp(trans[label][None, None] + following, axis=2)
+        tails[label] = numpy.where(last_step, end[label], tail)
+
+    cum_i = numpy.cumsum(emissions[:, :, i_label], axis=1)
+    heads = alpha[:, :, b_label] - log_z[:, None]
+    return heads, cum_i, tails, trans
+
+
+def span_log_probs(emissions,
+                   lengths,
+                   crf_w,
+                   max_span_len=None,
+                   b_label=0,
+                   i_label=1):
+    """
+    Compute the log probability of every span being tagged as an answer, that
+    is B at its first token, I at the others and anything but I after it.
+    The spans of each length are computed together.
+
+    :param max_span_len: maximum number of tokens of a span, max_len if None
+    :type max_span_len: int
+    :param b_label: id of the B tag
+    :type b_label: int
+    :param i_label: id of the I tag
+    :type i_label: int
+    :return: log probabilities, (batch, max_len, max_span_len), item
+        [b, s, m - 1] for the span of m tokens starting at s of row b, -inf
+        for the spans not in the rows
+    :rtype: numpy array
+    """
+    batch_size, max_len, label_num = emissions.shape
+    lengths = numpy.asarray(lengths)
+    if max_span_len is None:
+        max_span_len = max_len
+    max_span_len = min(max_span_len, max_len)
+    heads, cum_i, tails, trans = _span_parts(emissions, lengths, crf_w,
+                                             b_label, i_label)
+
+    ret = numpy.full((batch_size, max_len, max_span_len), -numpy.inf)
+    for m in xrange(1, max_span_len + 1):
+        s = numpy.arange(max_len - m + 1)
+        e = s + m - 1
+        score = heads[:, s] + cum_i[:, e] - cum_i[:, s]
+        if m > 1:
+            score += trans[b_label, i_label] + \
+                (m - 2) * trans[i_label, i_label]
+            score += tails[i_label][:, e]
+        else:
+            score += tails[b_label][:, e]
+        valid = e[None, :] < lengths[:, None]
+        ret[:, :max_len - m + 1, m - 1] = numpy.where(valid, score,
+                                                      -numpy.inf)
+    return ret
+
+
+def score_spans(emissions,
+                lengths,
+                crf_w,
+                rows,
+                starts,
+                ends,
+                b_label=0,
+                i_label=1):
+    """
+    Compute the log probabilities of given spans, see span_log_probs
+
+    :param rows: row of each span
+    :type rows: numpy array
+    :param starts: first token of each span
+    :type starts: numpy array
+    :param ends: the token after each span
+    :type ends: numpy array
+    :return: the log probability of each span
+    :rtype: numpy array
+    """
+    lengths = numpy.asarray(lengths)
+    rows = numpy.asarray(rows, dtype="int64")
+    starts = numpy.asarray(starts, dtype="int64")
+    ends = numpy.asarray(ends, dtype="int64")
+    heads, cum_i, tails, trans = _span_parts(emissions, lengths, crf_w,
+                                             b_label, i_label)
+    sizes = ends - starts
+    last = ends - 1
+    score = heads[rows, starts] + cum_i[rows, last] - cum_i[rows, starts]
+    return score + numpy.where(
+        sizes > 1, trans[b_label, i_label] +
+        (sizes - 2) * trans[i_label, i_label] + tails[i_label][rows, last],
+        tails[b_label][rows, last])
+
+
+def top_spans(emissions,
+              lengths,
+              crf_w,
+              k=1,
+              max_span_len=None,
+              b_label=0,
+              i_label=1):
+    """
+    Find the k most probable answer spans of every row, see span_log_probs
+
+    :param k: number of spans of a row
+    :type k: int
+    :return: for every row, a list of (start, end, probability) sorted by
+        probability, the span covers tokens start to end - 1
+    :rtype: list
+    """
+    log_probs = span_log_probs(emissions, lengths, crf_w, max_span_len,
+                               b_label, i_label)
+    batch_size, max_len, max_span_len = log_probs.shape
+    flat = log_probs.reshape(batch_size, -1)
+    k = min(k, flat.shape[1])
+    rows = numpy.arange(batch_size)[:, None]
+    best = numpy.argpartition(-flat, k - 1, axis=1)[:, :k]
+    best = best[rows, numpy.argsort(-flat[rows, best], axis=1)]
+    probs = numpy.exp(flat[rows, best])
+    starts, sizes = numpy.divmod(best, max_span_len)
+    ret = []
+    for b in xrange(batch_size):
+        ret.append([(int(s), int(s + m + 1), float(p))
+                    for s, m, p in zip(starts[b], sizes[b], probs[b])
+                    if p > 0])
+    return ret
+
+
+def extract_spans(tags, b_label=0, i_label=1):
+    """
+    Find the answer spans of a tag sequence, a B tag and the I tags after it
+
+    :param tags: tags of an evidence
+    :type tags: sequence
+    :return: (start, end) of every span, the span covers tokens start to
+        end - 1
+    :rtype: list
+    """
+    tags = numpy.asarray(tags)
+    starts = numpy.flatnonzero(tags == b_label)
+    breaks = numpy.flatnonzero(tags != i_label)
+    # a span ends at the first tag after its B that is not I
+    idx = numpy.searchsorted(breaks, starts, side="right")
+    ends = numpy.append(breaks, len(tags))[idx]
+    return zip(starts.tolist(), ends.tolist())
@@ -0,0 +1,479 @@
+"""
+A compiled, memory-mapped store for the word embeddings.
+
+Parsing the comma separated wordvecs.txt with numpy.loadtxt dominates the
+start-up time of every script. This module converts wordvecs.vcb and
+wordvecs.txt once into a single binary file:
+
+    header (128 bytes)
+    vectors        float32[vocab_size, dim]
+    token_offsets  uint64[vocab_size + 1]
+    tokens         utf-8 bytes of all tokens, concatenated
+    token_hash     int32 open addressing table over the tokens, -1 if empty
+
+The header stores the offset and the size of every section, so the file can
+be memory-mapped directly and shared by all processes on the same host. The
+vocabulary is looked up in place through Vocab instead of being expanded to
+a dict of unicode strings.
+
+Usage:
+    python embedding.py wordvecs.vcb wordvecs.txt wordvecs.bin
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy
+
+import utils
+from datapoint import DataPoint, Evidence
+from utils import logger
+
+__all__ = [
+    "Vocab", "fingerprint", "convert", "load", "load_vocab", "scan_tokens",
+    "load_tokens", "restrict", "load_restricted"
+]
+
+MAGIC = "QAWVBIN\0"
+# version 3 resolves duplicate tokens to their last id, the hash tables of
+# older stores resolve them to the first one
+VERSION = 3
+
+# section names, the order is part of the file format
+SECTIONS = ("vectors", "token_offsets", "tokens", "token_hash")
+MAX_SECTIONS = 5
+
+# magic, version, vocabulary size, dimension, (offset, size) of each section
+_HEADER = struct.Struct("<8sIII" + "QQ" * MAX_SECTIONS)
+HEADER_SIZE = 128
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _hash(token):
+    return zlib.crc32(token) & 0xffffffff
+
+
+def build_hash_table(tokens):
+    """
+    Build an open addressing table mapping hashed tokens to their ids. A
+    token which occurs more than once maps to its last id, as in the dict
+    built by utils.load_dict.
+
+    :param tokens: utf-8 encoded tokens, the index of a token is its id
+    :type tokens: list of str
+    :return: the table, -1 for empty slots
+    :rtype: numpy array
+    """
+    size = 1
+    while size < 2 * len(tokens):
+        size *= 2
+    mask = size - 1
+    table = [-1] * size
+    for i, token in enumerate(tokens):
+        slot = _hash(token) & mask
+        while table[slot] != -1 and tokens[table[slot]] != token:
+            slot = (slot + 1) & mask
+        table[slot] = i
+    return numpy.array(table, dtype="<i4")
+
+
+class Vocab(object):
+    """
+    A read-only token to id mapping over one contiguous string table. It
+    supports the subset of the dict interface used by the readers.
+    """
+
+    def __init__(self, token_offsets, token_blob, hash_table=None):
+        """
+        :param token_offsets: start of every token in token_blob, followed by
+            the end of the last one
+        :type token_offsets: numpy array or list
+        :param token_blob: utf-8 bytes of all tokens, concatenated
+        :type token_blob: str or buffer
+        :param hash_table: the table built by build_hash_table, it is rebuilt
+            when not given
+        :type hash_table: numpy array
+        """
+        self._offsets = token_offsets
+        self._blob = token_blob
+        self._size = len(token_offsets) - 1
+        if hash_table is None:
+            hash_table = build_hash_table(
+                [self._token(i) for i in xrange(self._size)])
+        self._table = hash_table
+        self._mask = len(hash_table) - 1
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """
+        Create a vocabulary from a list of tokens, the index is the id
+
+        :param tokens: str or unicode tokens
+        :type tokens: list
+        :rtype: Vocab
+        """
+        tokens = [t.encode("utf-8") if isinstance(t, unicode) else t \
+                  for t in tokens]
+        offsets = [0]
+        for t in tokens:
+            offsets.append(offsets[-1] + len(t))
+        return cls(offsets, "".join(tokens), build_hash_table(tokens))
+
+    def _token(self, i):
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])]
+
+    def token(self, i):
+        """
+        :return: the token of id i
+        :rtype: unicode
+        """
+        if i < 0 or i >= self._size:
+            raise IndexError(i)
+        return self._token(i).decode("utf-8")
+
+    def get(self, token, default=None):
+        if isinstance(token, unicode):
+            token = token.encode("utf-8")
+        table = self._table
+        mask = self._mask
+        slot = _hash(token) & mask
+        while True:
+            i = table[slot]
+            if i < 0:
+                return default
+            if self._token(i) == token:
+                return int(i)
+            slot = (slot + 1) & mask
+
+    def lookup(self, tokens, default=None):
+        """
+        Map a sequence of tokens to ids, a shorthand for get on every token
+
+        :param tokens: str or unicode tokens
+        :type tokens: iterable
+        :param default: id of the tokens not in the vocabulary
+        :return: the ids
+        :rtype: list
+        """
+        get = self.get
+        return [get(t, default) for t in tokens]
+
+    def __getitem__(self, token):
+        i = self.get(token)
+        if i is None:
+            raise KeyError(token)
+        return i
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in xrange(self._size):
+            yield self.token(i)
+
+
+def fingerprint(vocab):
+    """
+    Checksum the tokens of a vocabulary in the order of their ids, a dict and
+    a Vocab of the same tokens have the same fingerprint
+
+    :param vocab: a dict or a Vocab
+    :rtype: int
+    """
+    if isinstance(vocab, Vocab):
+        offsets, blob = vocab._offsets, vocab._blob
+    else:
+        tokens = [t.encode("utf-8") if isinstance(t, unicode) else t \
+                  for t, i in sorted(vocab.iteritems(), key=lambda x: x[1])]
+        offsets = [0]
+        for t in tokens:
+            offsets.append(offsets[-1] + len(t))
+        blob = "".join(tokens)
+    checksum = zlib.crc32(numpy.asarray(offsets, dtype="<u8").tostring())
+    return zlib.crc32(blob, checksum) & 0xffffffff
+
+
+def _read_tokens(word_dict_path):
+    with utils.open_file(word_dict_path) as f:
+        # the first word must be OOV
+        return [line.rstrip("\n").split()[0] for line in f]
+
+
+def convert(word_dict_path, wordvecs_path, output_path):
+    """
+    Convert the text vocabulary and word embeddings to the binary store
+
+    :param word_dict_path: path of the vocabulary file
+    :type word_dict_path: str
+    :param wordvecs_path: path of the comma separated word embeddings
+    :type wordvecs_path: str
+    :param output_path: path of the binary store to write
+    :type output_path: str
+    """
+    tokens = _read_tokens(word_dict_path)
+    vocab_size = len(tokens)
+
+    token_offsets = numpy.zeros(vocab_size + 1, dtype="<u8")
+    token_offsets[1:] = numpy.cumsum([len(t) for t in tokens])
+    token_blob = "".join(tokens)
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        vecs_offset = HEADER_SIZE
+        out.write("\0" * HEADER_SIZE)
+
+        # the vectors are converted row by row to keep the memory bounded
+        dim = None
+        rows = 0
+        with utils.open_file(wordvecs_path) as f:
+            for line in f:
+                row = numpy.fromstring(line, sep=",", dtype="<f4")
+                if dim is None:
+                    dim = len(row)
+                if len(row) != dim:
+                    raise ValueError("line %d of %s has %d values, %d expected"
+                                     % (rows + 1, wordvecs_path, len(row), dim))
+                out.write(row.tostring())
+                rows += 1
+        if rows != vocab_size:
+            raise ValueError("%d words in %s but %d vectors in %s" %
+                             (vocab_size, word_dict_path, rows, wordvecs_path))
+        vecs_size = rows * dim * 4
+
+        sections = [(vecs_offset, vecs_size)]
+        hash_table = build_hash_table(tokens)
+        for blob in (token_offsets.tostring(), token_blob,
+                     hash_table.tostring()):
+            offset = _align(out.tell())
+            out.write("\0" * (offset - out.tell()))
+            out.write(blob)
+            sections.append((offset, len(blob)))
+
+        fields = [MAGIC, VERSION, vocab_size, dim]
+        for i in xrange(MAX_SECTIONS):
+            fields.extend(sections[i] if i < len(sections) else (0, 0))
+        out.seek(0)
+        out.write(_HEADER.pack(*fields))
+
+    os.rename(tmp_path, output_path)
+    logger.info("%d word vectors of dimension %d written to %s" %
+                (vocab_size, dim, output_path))
+
+
+class EmbeddingStore(object):
+    """
+    A read-only view of a binary embedding store
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the binary store
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = _HEADER.unpack_from(self._buf, 0)
+        magic, version, self.vocab_size, self.dim = fields[:4]
+        if magic != MAGIC:
+            raise ValueError("%s is not a word embedding store" % path)
+        if version != VERSION:
+            raise ValueError("%s has the version %d instead of %d, it was "
+                             "written by another embedding.py, convert it "
+                             "again" % (path, version, VERSION))
+        self.sections = {}
+        for i, name in enumerate(SECTIONS):
+            offset, size = fields[4 + 2 * i:6 + 2 * i]
+            if size:
+                self.sections[name] = (offset, size)
+
+    def section(self, name, dtype, shape=None):
+        offset, size = self.sections[name]
+        count = size // numpy.dtype(dtype).itemsize
+        arr = numpy.frombuffer(self._buf, dtype=dtype, count=count,
+                               offset=offset)
+        if shape is not None:
+            arr = arr.reshape(shape)
+        return arr
+
+    @property
+    def wordvecs(self):
+        """
+        the embedding matrix, backed by the memory-mapped file
+        """
+        return self.section("vectors", "<f4", (self.vocab_size, self.dim))
+
+    @property
+    def vocab(self):
+        """
+        the vocabulary, backed by the memory-mapped file
+        """
+        offset, size = self.sections["tokens"]
+        blob = buffer(self._buf, offset, size)
+        return Vocab(
+            self.section("token_offsets", "<u8"),
+            blob,
+            hash_table=self.section("token_hash", "<i4"))
+
+
+# stores opened by this process, keyed by their paths
+_stores = {}
+
+
+def _open_store(path):
+    key = os.path.realpath(path)
+    if key not in _stores:
+        _stores[key] = EmbeddingStore(path)
+    return _stores[key]
+
+
+def load(path):
+    """
+    Load the memory-mapped vocabulary and word embeddings
+
+    :param path: path of the binary store
+    :type path: str
+    :return: the vocabulary and the embedding matrix
+    :rtype: tuple
+    """
+    store = _open_store(path)
+    return store.vocab, store.wordvecs
+
+
+def load_vocab(path):
+    """
+    Load the memory-mapped vocabulary only
+
+    :param path: path of the binary store
+    :type path: str
+    :rtype: Vocab
+    """
+    return _open_store(path).vocab
+
+
+def scan_tokens(data_path):
+    """
+    Collect the question and evidence tokens of a data file
+
+    :param data_path: json(.gz) data file
+    :type data_path: str
+    :rtype: set
+    """
+    tokens = set()
+    with utils.open_file(data_path) as f:
+        for line in f:
+            data = json.loads(line)
+            tokens.update(data[DataPoint.Q_TOKENS])
+            for evi in data[DataPoint.EVIDENCES]:
+                tokens.update(evi[Evidence.E_TOKENS])
+    return tokens
+
+
+def load_tokens(path):
+    """
+    Load the tokens of a data file (.json or .json.gz) or of a token list,
+    one token per line
+
+    :rtype: set
+    """
+    if path.endswith(".json") or path.endswith(".json.gz"):
+        return scan_tokens(path)
+    with utils.open_file(path) as f:
+        return set(line.rstrip("\n").split()[0].decode("utf-8")
+                   for line in f if line.strip())
+
+
+def restrict(vocab, wordvecs, tokens):
+    """
+    Reduce a vocabulary and its embeddings to some tokens, the OOV id stays 0
+
+    :param vocab: the full vocabulary, a dict or a Vocab
+    :param wordvecs: the full embedding matrix, only the rows of the kept
+        tokens are read
+    :param tokens: the tokens to keep, those not in vocab are ignored
+    :return: the reduced vocabulary (dict), its embedding matrix and the ids
+        of its rows in the full vocabulary
+    :rtype: tuple
+    """
+    old_ids = {}
+    for token in tokens:
+        i = vocab.get(token)
+        if i: old_ids[token] = i
+    ids = [0] + sorted(set(old_ids.itervalues()))
+    new_ids = dict((old, new) for new, old in enumerate(ids))
+    reduced = dict((t, new_ids[i]) for t, i in old_ids.iteritems())
+    # the OOV token is kept, the reduced vocabulary has one token per row
+    if isinstance(vocab, Vocab):
+        reduced[vocab.token(0)] = 0
+    else:
+        reduced.update((t, 0) for t, i in vocab.iteritems() if i == 0)
+    return reduced, numpy.asarray(
+        wordvecs[ids], dtype="float32"), numpy.array(ids)
+
+
+def load_restricted(word_dict_path, wordvecs_path, tokens, binary_path=None):
+    """
+    Load the vocabulary and the embeddings of some tokens, see restrict. Only
+    the kept rows of the text embeddings are parsed.
+    """
+    if binary_path and os.path.exists(binary_path):
+        vocab, wordvecs = load(binary_path)
+        return restrict(vocab, wordvecs, tokens)
+
+    tokens = set(tokens)
+    vocab = {}
+    with utils.open_file(word_dict_path) as f:
+        for i, line in enumerate(f):
+            token = line.rstrip("\n").split()[0].decode("utf-8")
+            # the first word must be OOV
+            if i == 0 or token in tokens:
+                vocab[token] = i
+    rows = set(vocab.itervalues())
+    wordvecs = {}
+    with utils.open_file(wordvecs_path) as f:
+        for i, line in enumerate(f):
+            if i in rows:
+                wordvecs[i] = numpy.fromstring(line, sep=",", dtype="float32")
+    ids = sorted(rows)
+    matrix = numpy.array([wordvecs[i] for i in ids], dtype="float32")
+    return restrict(vocab, _Rows(ids, matrix), tokens)
+
+
+class _Rows(object):
+    """
+    Some rows of a matrix, indexed by their ids in the full matrix
+    """
+
+    def __init__(self, ids, matrix):
+        self.index = dict((i, n) for n, i in enumerate(ids))
+        self.matrix = matrix
+
+    def __getitem__(self, ids):
+        return self.matrix[[self.index[i] for i in ids]]
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("word_dict_path")
+    parser.add_argument("wordvecs_path")
+    parser.add_argument("output_path")
+    return parser.parse_args()
+
+
+def main(args):
+    convert(args.word_dict_path, args.wordvecs_path, args.output_path)
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
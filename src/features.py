@@ -0,0 +1,99 @@
+"""
+Vectorized q-e.comm and e-e.comm features.
+
+A token of an evidence has q-e.comm 1 if it occurs in the question, and
+e-e.comm 1 if it occurs in any other evidence of the same question. The
+tokens of a question are mapped to local ids once, then the features of all
+its evidences are computed with a few numpy operations instead of building a
+dict for every evidence.
+"""
+import numpy
+
+__all__ = ["local_ids", "comm_features", "make_samples"]
+
+
+def local_ids(question, evidences):
+    """
+    Map the tokens of a question and its evidences to dense local ids, equal
+    tokens get equal ids
+
+    :param question: question tokens
+    :type question: list
+    :param evidences: tokens of each evidence
+    :type evidences: list of list
+    :return: the ids of the question, and the ids of each evidence
+    :rtype: tuple
+    """
+    ids = {}
+    q_ids = numpy.array(
+        [ids.setdefault(t, len(ids)) for t in question], dtype="int64")
+    e_ids = [
+        numpy.array(
+            [ids.setdefault(t, len(ids)) for t in e], dtype="int64")
+        for e in evidences
+    ]
+    return q_ids, e_ids
+
+
+def comm_features(question, evidences):
+    """
+    Compute the q-e.comm and e-e.comm features of all evidences of a question
+
+    :param question: question tokens
+    :type question: list
+    :param evidences: tokens of each evidence
+    :type evidences: list of list
+    :return: the q-e.comm features and the e-e.comm features of each evidence,
+        as lists of 0/1
+    :rtype: tuple
+    """
+    if not evidences:
+        return [], []
+    q_ids, e_ids = local_ids(question, evidences)
+    lengths = [len(e) for e in e_ids]
+    tokens = numpy.concatenate(e_ids) if sum(lengths) else \
+        numpy.zeros(0, dtype="int64")
+    evi_idx = numpy.repeat(numpy.arange(len(e_ids)), lengths)
+
+    qe_comm = numpy.in1d(tokens, q_ids)
+
+    # number of distinct evidences containing each token, a token of an
+    # evidence occurs in another evidence iff the number is at least 2
+    vocab_size = len(q_ids) + len(tokens) + 1
+    pairs = numpy.unique(evi_idx * vocab_size + tokens)
+    evi_num = numpy.bincount(pairs % vocab_size, minlength=vocab_size)
+    ee_comm = evi_num[tokens] >= 2
+
+    bounds = numpy.cumsum(lengths)[:-1]
+    return ([f.tolist() for f in numpy.split(qe_comm.astype("int64"), bounds)],
+            [f.tolist() for f in numpy.split(ee_comm.astype("int64"), bounds)])
+
+
+def make_samples(question, evidences, vocab, oov_id=0, label=2):
+    """
+    Convert a question and its evidences to samples for inference, see
+    reader.SampleStream
+
+    :param question: question tokens, utf-8 or unicode
+    :type question: list
+    :param evidences: tokens of each evidence
+    :type evidences: list of list
+    :param vocab: the word dictionary
+    :param oov_id: id of the tokens not in vocab
+    :type oov_id: int
+    :param label: the placeholder label of every evidence token
+    :type label: int
+    :return: one sample per evidence
+    :rtype: list
+    """
+
+    def to_ids(tokens):
+        return [
+            vocab.get(t if isinstance(t, unicode) else unicode(t, "utf-8"),
+                      oov_id) for t in tokens
+        ]
+
+    q_ids = to_ids(question)
+    qe_comm, ee_comm = comm_features(question, evidences)
+    return [[q_ids, to_ids(e), [label] * len(e), qe, ee]
+            for e, qe, ee in zip(evidences, qe_comm, ee_comm)]
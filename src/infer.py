@@ -3,18 +3,57 @@ import sys
 
 import paddle.v2 as paddle
 
+import answer
+import batching
 import config
+import embedding
 import network
+import numpy_infer
+import pipeline
 import reader
+import tagfile
 import utils
 
 
+def load_parameters(output_layer, model_path, wordvecs=None):
+    """
+    Load the trained parameters
+
+    :param output_layer: the output layer of the network
+    :param model_path: path of params_pass_*.tar.gz
+    :type model_path: str
+    :param wordvecs: embeddings of a restricted vocabulary replacing the
+        wordvecs parameter, see embedding.restrict
+    :type wordvecs: numpy array
+    :rtype: paddle.parameters.Parameters
+    """
+    if wordvecs is None:
+        return paddle.parameters.Parameters.from_tar(
+            utils.open_file(model_path, "r"))
+
+    # the network is defined over the restricted vocabulary, its
+    # parameters are filled with the trained ones, which are read member by
+    # member without the full embeddings
+    restricted = paddle.parameters.create(output_layer)
+    trained = numpy_infer.load_parameters(model_path, skip=("wordvecs", ))
+    for name in restricted.names():
+        if name == "wordvecs":
+            restricted.set(name, wordvecs)
+        else:
+            restricted.set(name, trained[name].reshape(
+                restricted.get_shape(name)))
+    return restricted
+
+
 class Infer(object):
     def __init__(self, conf):
         self.conf = conf
 
         self.settings = reader.Settings(
-            vocab=conf.vocab, is_training=False, label_schema=conf.label_schema)
+            vocab=conf.vocab,
+            is_training=False,
+            label_schema=conf.label_schema,
+            num_workers=conf.num_reader_workers)
 
         # init paddle
         # TODO(lipeng17) v2 API does not support parallel_nn yet. Therefore, we
@@ -24,16 +63,32 @@ class Infer(object):
         # define network
         self.tags_layer = network.inference_net(conf)
 
-    def infer(self, model_path, data_path, output):
-        test_reader = paddle.batch(
+    def infer_batches(self, model_path, data_path):
+        """
+        Run the model on the batches, which are read and featurized ahead in
+        a background thread
+
+        :return: a generator of (indices, samples, tags of every sample) of
+            each batch, see batching.batch
+        """
+        test_reader = batching.batch(
             paddle.reader.buffered(
-                reader.create_reader(data_path, self.settings),
+                reader.create_reader(
+                    data_path,
+                    self.settings,
+                    shard_id=self.conf.shard_id,
+                    num_shards=self.conf.num_shards),
                 size=self.conf.batch_size * 1000),
-            batch_size=self.conf.batch_size)
+            batch_size=self.conf.batch_size,
+            window=self.conf.bucket_window,
+            max_tokens=self.conf.max_batch_tokens,
+            shuffle=False,
+            keep_index=True)
+        test_reader = pipeline.prefetch(test_reader, self.conf.pipeline_depth)
 
         # load the trained models
-        parameters = paddle.parameters.Parameters.from_tar(
-            utils.open_file(model_path, "r"))
+        parameters = load_parameters(self.tags_layer, model_path,
+                                     self.conf.wordvecs)
         inferer = paddle.inference.Inference(
             output_layer=self.tags_layer, parameters=parameters)
 
@@ -43,12 +98,63 @@ class Infer(object):
                 num += len(sample[reader.E_IDS])
             return num
 
-        for test_batch in test_reader():
+        for indices, test_batch in test_reader():
             tags = inferer.infer(
                 input=test_batch, field=["id"], feeding=network.feeding)
             evi_ids_num = count_evi_ids(test_batch)
             assert len(tags) == evi_ids_num
-            print >> output, ";\n".join(str(tag) for tag in tags) + ";"
+            yield indices, test_batch, batching.split_results(
+                tags, test_batch)
+
+    def infer_tags(self, model_path, data_path):
+        """
+        :return: a generator of the tags of every sample, in the order of the
+            data file
+        """
+        # bucketed batches are put back in the order of the data file
+        return batching.restore_order(
+            (indices, results)
+            for indices, test_batch, results in self.infer_batches(
+                model_path, data_path))
+
+    def infer(self, model_path, data_path, output, binary=False):
+        """
+        Write the tags of every sample
+
+        :param binary: write a tag file instead of text, see tagfile.py
+        :type binary: bool
+        """
+
+        def write(batches):
+            results = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch], tags))
+                for indices, test_batch, tags in batches)
+            tagfile.write(results, output, binary)
+
+        # the results are formatted and written in a background thread
+        pipeline.write_behind(
+            self.infer_batches(model_path, data_path), write,
+            self.conf.pipeline_depth)
+
+    def infer_answers(self, model_path, data_path, output):
+        """
+        Write the voted answer of every question as json lines, see answer.py
+        """
+
+        def write(batches):
+            results = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch],
+                              [s[reader.TOKENS] for s in test_batch], tags))
+                for indices, test_batch, tags in batches)
+            samples = ((q_idx, tokens, answer.tag_spans(tags, self.settings))
+                       for q_idx, tokens, tags in results)
+            answer.write_records(answer.answer_records(samples), output)
+
+        # the tokens the answers are made of are carried by the samples
+        self.settings.keep_tokens = True
+        pipeline.write_behind(
+            self.infer_batches(model_path, data_path), write,
+            self.conf.pipeline_depth)
 
 
 def parse_cmd():
@@ -56,12 +162,31 @@ def parse_cmd():
     parser.add_argument("model_path")
     parser.add_argument("data_path")
     parser.add_argument("output", help="'-' for stdout")
+    parser.add_argument(
+        "--answers",
+        action="store_true",
+        help="write the voted answer of every question instead of the tags")
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the tags to a binary tag file, see tagfile.py")
+    parser.add_argument(
+        "--restrict_vocab",
+        metavar="TOKENS_PATH",
+        help="only load the words of a json(.gz) data file, e.g. data_path, "
+        "or of a token list")
     return parser.parse_args()
 
 
 def main(args):
     conf = config.InferConfig()
-    conf.vocab = utils.load_dict(conf.word_dict_path)
+    if args.restrict_vocab:
+        conf.vocab, conf.wordvecs = utils.load_wordvecs(
+            conf.word_dict_path, conf.wordvecs_path, conf.wordvecs_bin_path,
+            embedding.load_tokens(args.restrict_vocab))
+    else:
+        conf.vocab = utils.load_dict(conf.word_dict_path,
+                                     conf.wordvecs_bin_path)
     # logger.info("length of word dictionary is : %d." % len(conf.vocab))
 
     if args.output == "-":
@@ -70,7 +195,10 @@ def main(args):
         output = utils.open_file(args.output, "w")
 
     infer = Infer(conf)
-    infer.infer(args.model_path, args.data_path, output)
+    if args.answers:
+        infer.infer_answers(args.model_path, args.data_path, output)
+    else:
+        infer.infer(args.model_path, args.data_path, output, args.binary)
 
     output.close()
 
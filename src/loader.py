@@ -0,0 +1,266 @@
+"""
+Training batches prepared in worker processes.
+
+paddle.reader.buffered reads ahead in a thread of the trainer process, so
+sampling, featurizing and batching still compete with the trainer for the
+GIL. ProcessLoader runs them in forked worker processes instead. The workers
+hand the batches to the trainer through a ring of fixed size slots in
+shared memory: an anonymous mmap, a semaphore counting the empty slots and
+one counting the full slots. A batch is serialized with marshal into one
+slot, the trainer copies it out and frees the slot at once.
+
+Every worker reads samples_per_pass / num_workers samples per pass with its
+own random seed, a pass of the loader ends when every worker has ended its
+pass. The workers go on with the next pass while the trainer finishes the
+current one, blocked when the ring is full or when depth batches of the next
+pass are already waiting for the slower workers to end the current one.
+"""
+import collections
+import marshal
+import mmap
+import multiprocessing
+import random
+import struct
+import traceback
+
+import numpy
+
+from utils import logger
+
+__all__ = ["SharedRing", "ProcessLoader"]
+
+_BATCH = 0
+_END_PASS = 1
+_ERROR = 2
+_STATE = 3
+
+
+class SharedRing(object):
+    """
+    A ring of slots in shared memory, written by any number of processes
+    forked after it is created and read by the process which created it
+    """
+    LENGTH = struct.Struct("<I")
+
+    def __init__(self, slots, slot_bytes):
+        """
+        :param slots: number of slots
+        :type slots: int
+        :param slot_bytes: size of a slot, the largest serialized item
+        :type slot_bytes: int
+        """
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.buffer = mmap.mmap(-1, slots * slot_bytes)
+        self.empty = multiprocessing.Semaphore(slots)
+        self.full = multiprocessing.Semaphore(0)
+        # the next slot to write, shared by the writers
+        self.lock = multiprocessing.Lock()
+        self.write_idx = multiprocessing.Value("L", 0, lock=False)
+        # the next slot to read, only known by the reader
+        self.read_idx = 0
+
+    def put(self, data, stopped=None, timeout=0.1):
+        """
+        Write a string into the next slot, wait while the ring is full
+
+        :param stopped: give up waiting when this event is set
+        :type stopped: multiprocessing.Event
+        :return: False if stopped before a slot was free
+        :rtype: bool
+        """
+        if self.LENGTH.size + len(data) > self.slot_bytes:
+            raise ValueError("an item of %d bytes does not fit in a slot of "
+                             "%d bytes" % (len(data), self.slot_bytes))
+        while not self.empty.acquire(True, timeout):
+            if stopped is not None and stopped.is_set():
+                return False
+        with self.lock:
+            start = (self.write_idx.value % self.slots) * self.slot_bytes
+            self.buffer[start:start + self.LENGTH.size] = \
+                self.LENGTH.pack(len(data))
+            start += self.LENGTH.size
+            self.buffer[start:start + len(data)] = data
+            self.write_idx.value += 1
+        self.full.release()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Read the string in the next slot
+
+        :return: the string, None if no slot was written within timeout
+        """
+        if not self.full.acquire(True, timeout):
+            return None
+        start = (self.read_idx % self.slots) * self.slot_bytes
+        length, = self.LENGTH.unpack_from(self.buffer, start)
+        start += self.LENGTH.size
+        data = self.buffer[start:start + length]
+        self.read_idx += 1
+        self.empty.release()
+        return data
+
+
+class ProcessLoader(object):
+    """
+    A batch reader creator whose batches are made by worker processes
+
+    Usage:
+        loader = ProcessLoader(create_batch_reader, num_workers)
+        trainer.train(reader=loader, ...)
+        loader.close()
+
+    The workers are daemonic processes, the readers they run can not start
+    processes of their own.
+    """
+
+    def __init__(self,
+                 create_batch_reader,
+                 num_workers,
+                 depth=8,
+                 slot_bytes=1 << 22,
+                 seed=0,
+                 get_state=None):
+        """
+        The workers are started at once, before the trainer starts threads
+
+        :param create_batch_reader: called with the id of a worker in the
+            worker process, returns the batch reader creator of one pass of
+            the worker
+        :type create_batch_reader: callable
+        :param num_workers: number of worker processes
+        :type num_workers: int
+        :param depth: number of batches read ahead, and number of batches of
+            the next pass read ahead while the current one is not ended
+        :type depth: int
+        :param slot_bytes: maximum size of a serialized batch
+        :type slot_bytes: int
+        :param seed: worker i seeds random and numpy.random with seed + i,
+            like reader.shard_random the seed 0 is a fixed seed
+        :type seed: int
+        :param get_state: called with the id of a worker in the worker
+            process at the end of every pass, the result is serialized and
+            sent in parts of half a slot before the end of the pass, see
+            states
+        :type get_state: callable
+        """
+        self.num_workers = num_workers
+        self.ring = SharedRing(depth, slot_bytes)
+        self.stopped = multiprocessing.Event()
+        # items of workers which are a pass ahead, (worker id, kind, batch,
+        # credited), at most depth as a worker takes a credit for every item
+        # it puts while it is ahead of the trainer
+        self.ahead = collections.deque()
+        self.credits = multiprocessing.Semaphore(depth)
+        # the pass of the trainer
+        self.pass_id = multiprocessing.Value("L", 0)
+        # what get_state returned in every worker at the end of the last pass
+        self.states = {}
+        self.workers = []
+        for worker_id in xrange(num_workers):
+            worker = multiprocessing.Process(
+                target=self.work,
+                args=(create_batch_reader, get_state, worker_id,
+                      seed + worker_id))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        logger.info("%d loader workers started" % num_workers)
+
+    def work(self, create_batch_reader, get_state, worker_id, seed):
+        random.seed(seed)
+        numpy.random.seed(seed)
+        try:
+            batch_reader = create_batch_reader(worker_id)
+            pass_id = 0
+            while not self.stopped.is_set():
+                for batch in batch_reader():
+                    if not self.put(worker_id, _BATCH, batch, pass_id):
+                        return
+                if get_state is not None:
+                    state = marshal.dumps(get_state(worker_id))
+                    part_bytes = self.ring.slot_bytes // 2
+                    for start in xrange(0, len(state), part_bytes):
+                        if not self.put(worker_id, _STATE,
+                                        state[start:start + part_bytes],
+                                        pass_id):
+                            return
+                if not self.put(worker_id, _END_PASS, None, pass_id): return
+                pass_id += 1
+        except Exception:
+            message = traceback.format_exc()
+            # the message is cut to fit in a slot
+            self.put(worker_id, _ERROR,
+                     message[-(self.ring.slot_bytes // 2):])
+
+    def put(self, worker_id, kind, batch, pass_id=None, timeout=0.1):
+        """
+        Put an item of a worker in pass pass_id, a credit is taken first
+        while the worker is ahead of the trainer
+        """
+        credited = False
+        # the trainer may catch up while the worker waits, the credits can
+        # all be held by a worker further ahead
+        while pass_id is not None and pass_id > self.pass_id.value:
+            if self.credits.acquire(True, timeout):
+                credited = True
+                break
+            if self.stopped.is_set():
+                return False
+        return self.ring.put(
+            marshal.dumps((worker_id, kind, batch, credited)), self.stopped)
+
+    def get(self):
+        while True:
+            data = self.ring.get(timeout=1.)
+            if data is not None:
+                break
+            for worker_id, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    raise RuntimeError("loader worker %d exited with %s" %
+                                       (worker_id, worker.exitcode))
+        worker_id, kind, batch, credited = item = marshal.loads(data)
+        if kind == _ERROR:
+            raise RuntimeError("loader worker %d failed:\n%s" % (worker_id,
+                                                                batch))
+        return item
+
+    def __call__(self):
+        """
+        :return: a generator of the batches of one pass
+        """
+        ended = set()
+        # the parts of the states of the workers
+        parts = collections.defaultdict(list)
+        pending, self.ahead = self.ahead, collections.deque()
+        while len(ended) < self.num_workers:
+            if pending:
+                item = pending.popleft()
+            else:
+                item = self.get()
+            worker_id, kind, batch, credited = item
+            if worker_id in ended:
+                # the worker is in the next pass already, it keeps the credit
+                self.ahead.append(item)
+                continue
+            if credited:
+                self.credits.release()
+            if kind == _STATE:
+                parts[worker_id].append(batch)
+            elif kind == _END_PASS:
+                ended.add(worker_id)
+                if worker_id in parts:
+                    self.states[worker_id] = marshal.loads("".join(
+                        parts.pop(worker_id)))
+            else:
+                yield batch
+        self.ahead.extend(pending)
+        self.pass_id.value += 1
+
+    def close(self):
+        self.stopped.set()
+        for worker in self.workers:
+            worker.join(1.)
+            if worker.is_alive():
+                worker.terminate()
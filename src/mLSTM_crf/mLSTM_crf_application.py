@@ -13,7 +13,7 @@ import mLSTM_crf_network
 # 把目录加入环境变量
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import reader, utils
+import batching, features, reader, utils
 
 
 # logger = logging.getLogger("paddle")
@@ -31,35 +31,42 @@ class Application(object):
 
         # define network
         self.tags_layer = mLSTM_crf_network.inference_net(conf)
+        self.inferer = None
 
-    def infer(self, model_path, data_path):
-
+    def load(self, model_path):
         # load the trained models
         parameters = paddle.parameters.Parameters.from_tar(
             utils.open_file(model_path, "r"))
-        inferer = paddle.inference.Inference(
+        self.inferer = paddle.inference.Inference(
             output_layer=self.tags_layer, parameters=parameters)
 
-        # get question and evidences
-        content = []
-        f = open(data_path)
-        for line in f.readlines():
-            content.append(line.strip())
-        question = []
-        for x in content[0].split(' '):
-            question.append(x)
-        evidences = []
-        for x in content[1:4]:
-            e = []
-            for y in x.split(' '):
-                e.append(y)
-            evidences.append(e)
+    def make_batch(self, question, evidences):
+        """
+        Convert a question and its evidences to samples
+
+        :param question: question tokens
+        :type question: list
+        :param evidences: tokens of each evidence
+        :type evidences: list of list
+        :return: one sample per evidence
+        :rtype: list
+        """
         test_batch = []
-        i = 0
-        for evidence in evidences:
+        qe_comm, ee_comm = features.comm_features(question, evidences)
+        for evidence, qe, ee in zip(evidences, qe_comm, ee_comm):
             test_batch.append(
-                self.application_reader(question, evidence, self.get_qe(question, evidence), self.get_ee(i, evidences)))
-            i += 1
+                self.application_reader(question, evidence, qe, ee))
+        return test_batch
+
+    def infer_batch(self, test_batch):
+        """
+        Tag the evidences of a batch, the model must be loaded
+
+        :param test_batch: samples created by make_batch
+        :type test_batch: list
+        :return: the tags of each evidence
+        :rtype: list
+        """
 
         def count_evi_ids(test_batch):
             num = 0
@@ -67,18 +74,26 @@ class Application(object):
                 num += len(sample[reader.E_IDS])
             return num
 
-        tags = inferer.infer(
+        tags = self.inferer.infer(
             input=test_batch, field=["id"], feeding=mLSTM_crf_network.feeding)
         evi_ids_num = count_evi_ids(test_batch)
         assert len(tags) == evi_ids_num
-        print(";\n".join(str(tag) for tag in tags) + ";")
+        return batching.split_results(tags, test_batch)
+
+    def infer(self, model_path, data_path):
+        self.load(model_path)
+        question, evidences = read_qe_text(data_path)
+        tags = self.infer_batch(self.make_batch(question, evidences))
+        print(";\n".join(str(tag) for e_tags in tags for tag in e_tags) + ";")
 
     def application_reader(self, question, evidence, qe, ee):
 
         def get_unicode(collection):
             result = []
             for x in collection:
-                result.append(unicode(x, 'utf-8'))
+                if not isinstance(x, unicode):
+                    x = unicode(x, 'utf-8')
+                result.append(x)
             return result
 
         question_unicode = get_unicode(question)
@@ -94,40 +109,28 @@ class Application(object):
         result.append(ee)
         return result
 
-    def get_qe(self, question, evidence):
-        result = []
-        d = dict()
-        for x in question:
-            d[x] = 1
-        for x in evidence:
-            if d.get(x) is not None:
-                result.append(1)
-            else:
-                result.append(0)
-        return result
 
-    def get_ee(self, pos, evidences):
-        result = []
-        d = dict()
-        evidence = evidences[pos]
-        i = 0
-        for _ in evidences:
-            if i != pos:
-                for y in evidences[i]:
-                    d[y] = 1
-            i += 1
-        for x in evidence:
-            if d.get(x) is not None:
-                result.append(1)
-            else:
-                result.append(0)
-        return result
+def read_qe_text(data_path):
+    """
+    Read a question and its evidences, see qe_text in README.md
+
+    :return: question tokens, tokens of each evidence
+    :rtype: tuple
+    """
+    content = []
+    f = open(data_path)
+    for line in f.readlines():
+        content.append(line.strip())
+    question = content[0].split(' ')
+    evidences = [x.split(' ') for x in content[1:4]]
+    return question, evidences
 
 
 def main():
     # start_time = time()
     conf = config.InferConfig()
-    conf.vocab = utils.load_dict(conf.word_dict_path)
+    conf.vocab = utils.load_dict(conf.word_dict_path,
+                                 conf.wordvecs_bin_path)
     # logger.info("length of word dictionary is : %d." % len(conf.vocab))
 
     application = Application(conf)
@@ -27,8 +27,24 @@ class CommonConfig(object):
         self.word_dict_path = "/home/QA/data/embedding/wordvecs.vcb"
         # word embedding file path
         self.wordvecs_path = "/home/QA/data/embedding/wordvecs.txt"
+        # binary word embedding store converted by embedding.py, used instead
+        # of the two files above when it exists
+        self.wordvecs_bin_path = "/home/QA/data/embedding/wordvecs.bin"
         self.word_vec_dim = 64
 
+        # data reading:
+        # number of processes parsing the data files, 1 to parse them in
+        # the reading thread, as the loader workers of training always do
+        self.num_reader_workers = 1
+
+        # batching:
+        # number of samples sorted by evidence length before being cut into
+        # batches, 0 to batch the samples in arrival order
+        self.bucket_window = 0
+        # if positive, also limit a batch to this number of evidence tokens,
+        # counting every evidence as long as the longest one of the batch
+        self.max_batch_tokens = 0
+
         # saving model & logs:
         # dir for saving models
         self.model_save_dir = "models"
@@ -37,6 +53,14 @@ class CommonConfig(object):
         self.log_period = 100
         # show 杂项 status every show_parameter_status_period batches
         self.show_parameter_status_period = 100
+        # json lines file the parameter statistics are appended to, see
+        # param_stats.py
+        self.parameter_status_path = "parameter_status.json"
+        # number of rows of a parameter the statistics are computed over, 0
+        # for all rows
+        self.parameter_status_rows = 1000
+        # number of bins of the parameter histograms
+        self.parameter_status_bins = 20
 
     @property
     def label_num(self):
@@ -85,13 +109,35 @@ class TrainingConfig(CommonConfig):
         # keep only first B in golden labels
         self.keep_first_b = False
 
+        # how training samples are kept in memory: "list" for python lists,
+        # "array" for flat typed arrays which use much less memory
+        self.sample_storage = "list"
+        # if positive, stream the training data (train_data_path may be a
+        # glob pattern of shards) through shuffle buffers holding at most this
+        # number of samples of each type, instead of loading all of it
+        self.shuffle_buffer_size = 0
+        # if positive, the training batches are made by this number of worker
+        # processes, each of them reading its shard of the training data, see
+        # loader.py
+        self.loader_workers = 0
+        # number of batches the workers make ahead
+        self.loader_depth = 8
+        # maximum size of a serialized batch in bytes
+        self.loader_slot_bytes = 4 * 1024 * 1024
+
         # use GPU to train the model
         self.use_gpu = False
         # number of threads
         self.trainer_count = 1
+        # the training data is split by question into a shard for every
+        # trainer process (and every loader worker of it), the id of this
+        # trainer and the number of trainers
+        self.trainer_id = 0
+        self.num_trainers = 1
 
         # random seeds:
-        # data reader random seed, 0 for random seed
+        # data reader random seed, the readers of every shard and every
+        # loader worker draw from it, 0 is a fixed seed as well
         self.seed = 0
         # paddle random seed, 0 for random seed
         self.paddle_seed = 0
@@ -106,6 +152,24 @@ class TrainingConfig(CommonConfig):
         self.average_window = 0.5
         self.max_average_window = 10000
 
+        # checkpoints:
+        # number of the last checkpoints kept in model_save_dir, 0 to keep
+        # all of them
+        self.keep_checkpoints = 0
+        # validation log of val_and_test.py, the best checkpoint by its
+        # chunk_f1 and the ones it has not evaluated yet are kept as well,
+        # "" to keep only the last checkpoints
+        self.val_eval_log = "eval.val.ann.txt"
+
+        # training metrics:
+        # json lines file of the timings and throughput of every batch, ""
+        # not to write them, see throughput.py
+        self.metrics_path = "train_metrics.json"
+        # the metrics file is rotated when it reaches this size
+        self.metrics_max_bytes = 64 * 1024 * 1024
+        # number of rotated metrics files kept
+        self.metrics_backups = 5
+
 
 class InferConfig(CommonConfig):
     def __init__(self):
@@ -115,3 +179,23 @@ class InferConfig(CommonConfig):
         self.trainer_count = 1
         self.batch_size = 120
         self.wordvecs = None
+        # number of batches read ahead of the model and of results waiting
+        # to be written, 0 to run reading, inference and writing one after
+        # another
+        self.pipeline_depth = 4
+        # only tag the questions whose line index modulo num_shards is
+        # shard_id, shard_infer.py sets them in every shard process
+        self.num_shards = 1
+        self.shard_id = 0
+
+        # serving:
+        # maximum time in seconds a request waits to be batched with others
+        self.max_batch_latency = 0.01
+        # maximum number of cached results of (question, evidence) pairs, 0 to
+        # disable the result cache
+        self.result_cache_size = 100000
+        # lifetime of the cached results in seconds, 0 for no expiry
+        self.result_cache_ttl = 3600
+        # file the result cache is saved to at exit, empty to keep it in
+        # memory only
+        self.result_cache_path = ""
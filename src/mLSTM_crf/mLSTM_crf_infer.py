@@ -9,7 +9,7 @@ import mLSTM_crf_network
 # 把目录加入环境变量
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import reader, config, utils
+import answer, batching, infer, pipeline, reader, config, tagfile, utils
 from utils import logger
 
 
@@ -18,7 +18,10 @@ class Infer(object):
         self.conf = conf
 
         self.settings = reader.Settings(
-            vocab=conf.vocab, is_training=False, label_schema=conf.label_schema)
+            vocab=conf.vocab,
+            is_training=False,
+            label_schema=conf.label_schema,
+            num_workers=conf.num_reader_workers)
 
         # init paddle
         # TODO(lipeng17) v2 API does not support parallel_nn yet. Therefore, we can only use CPU currently
@@ -27,16 +30,32 @@ class Infer(object):
         # define network
         self.tags_layer = mLSTM_crf_network.inference_net(conf)
 
-    def infer(self, model_path, data_path, output):
-        test_reader = paddle.batch(
+    def infer_batches(self, model_path, data_path):
+        """
+        Run the model on the batches, which are read and featurized ahead in
+        a background thread
+
+        :return: a generator of (indices, samples, tags of every sample) of
+            each batch, see batching.batch
+        """
+        test_reader = batching.batch(
             paddle.reader.buffered(
-                reader.create_reader(data_path, self.settings),
+                reader.create_reader(
+                    data_path,
+                    self.settings,
+                    shard_id=self.conf.shard_id,
+                    num_shards=self.conf.num_shards),
                 size=self.conf.batch_size * 1000),
-            batch_size=self.conf.batch_size)
+            batch_size=self.conf.batch_size,
+            window=self.conf.bucket_window,
+            max_tokens=self.conf.max_batch_tokens,
+            shuffle=False,
+            keep_index=True)
+        test_reader = pipeline.prefetch(test_reader, self.conf.pipeline_depth)
 
         # load the trained models
-        parameters = paddle.parameters.Parameters.from_tar(
-            utils.open_file(model_path, "r"))
+        parameters = infer.load_parameters(self.tags_layer, model_path,
+                                           self.conf.wordvecs)
         inferer = paddle.inference.Inference(
             output_layer=self.tags_layer, parameters=parameters)
 
@@ -46,17 +65,69 @@ class Infer(object):
                 num += len(sample[reader.E_IDS])
             return num
 
-        for test_batch in test_reader():
+        for indices, test_batch in test_reader():
             tags = inferer.infer(
                 input=test_batch, field=["id"], feeding=mLSTM_crf_network.feeding)
             evi_ids_num = count_evi_ids(test_batch)
             assert len(tags) == evi_ids_num
-            print >> output, ";\n".join(str(tag) for tag in tags) + ";"
+            yield indices, test_batch, batching.split_results(
+                tags, test_batch)
+
+    def infer_tags(self, model_path, data_path):
+        """
+        :return: a generator of the tags of every sample, in the order of the
+            data file
+        """
+        # bucketed batches are put back in the order of the data file
+        return batching.restore_order(
+            (indices, results)
+            for indices, test_batch, results in self.infer_batches(
+                model_path, data_path))
+
+    def infer(self, model_path, data_path, output, binary=False):
+        """
+        Write the tags of every sample
+
+        :param binary: write a tag file instead of text, see tagfile.py
+        :type binary: bool
+        """
+
+        def write(batches):
+            results = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch], tags))
+                for indices, test_batch, tags in batches)
+            tagfile.write(results, output, binary)
+
+        # the results are formatted and written in a background thread
+        pipeline.write_behind(
+            self.infer_batches(model_path, data_path), write,
+            self.conf.pipeline_depth)
+
+    def infer_answers(self, model_path, data_path, output):
+        """
+        Write the voted answer of every question as json lines, see answer.py
+        """
+
+        def write(batches):
+            results = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch],
+                              [s[reader.TOKENS] for s in test_batch], tags))
+                for indices, test_batch, tags in batches)
+            samples = ((q_idx, tokens, answer.tag_spans(tags, self.settings))
+                       for q_idx, tokens, tags in results)
+            answer.write_records(answer.answer_records(samples), output)
+
+        # the tokens the answers are made of are carried by the samples
+        self.settings.keep_tokens = True
+        pipeline.write_behind(
+            self.infer_batches(model_path, data_path), write,
+            self.conf.pipeline_depth)
 
 
 def main():
     conf = config.InferConfig()
-    conf.vocab = utils.load_dict(conf.word_dict_path)
+    conf.vocab = utils.load_dict(conf.word_dict_path,
+                                 conf.wordvecs_bin_path)
     logger.info("length of word dictionary is : %d." % len(conf.vocab))
 
     model_path = '/home/QA/models/params_pass_00023.tar.gz'
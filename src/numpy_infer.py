@@ -0,0 +1,593 @@
+"""
+A numpy implementation of the inference path of network.inference_net.
+
+It loads the parameters by name from a params_pass_*.tar.gz written by paddle
+and runs the same forward pass without the paddle runtime: the question LSTM
+with self-attention pooling, the three evidence LSTMs with the cross layer
+link, the _output projection and Viterbi decoding with _crf.w0. Evidences are
+batched with padding. Dropout layers scale their input by (1 - drop_rate) as
+paddle does at test time.
+
+The Match-LSTM network is not supported.
+
+Usage:
+    python numpy_infer.py model_path data_path output [--answers]
+"""
+import argparse
+import os
+import struct
+import sys
+import tarfile
+from itertools import izip
+
+import numpy
+
+import answer
+import batching
+import config
+import crf
+import embedding
+import features
+import pipeline
+import reader
+import tagfile
+import utils
+
+__all__ = [
+    "load_parameters", "parameter_shapes", "NumpyNetwork", "Infer",
+    "Application"
+]
+
+# version, size of a value and number of values, before the values of every
+# parameter in the tar
+PARAM_HEADER = struct.Struct("<IIQ")
+
+
+def load_parameters(model_path, skip=()):
+    """
+    Load the parameters saved by paddle
+
+    :param model_path: path of params_pass_*.tar.gz
+    :type model_path: str
+    :param skip: names of the parameters not to load
+    :type skip: collection
+    :return: flat float32 arrays keyed by parameter names
+    :rtype: dict
+    """
+    params = {}
+    with utils.open_file(model_path, "r") as f:
+        tar = tarfile.TarFile(fileobj=f, mode="r")
+        for member in tar:
+            name = member.name
+            if name.endswith(".protobuf") or name in skip:
+                continue
+            data = tar.extractfile(member).read()
+            version, value_size, size = PARAM_HEADER.unpack_from(data)
+            value = numpy.frombuffer(
+                data, dtype="<f4", offset=PARAM_HEADER.size)
+            if value_size != 4 or len(value) != size:
+                raise ValueError("broken parameter %s in %s" %
+                                 (name, model_path))
+            params[name] = value
+    return params
+
+
+# number of inputs of _e_hidden1, 2 and 3. The inputs of the first layer are
+# the word embedding, the question encoding, the qe.comm and ee.comm
+# embeddings, the third layer is also linked to the first LSTM
+E_HIDDEN_INPUTS = (4, 1, 2)
+
+
+def parameter_shapes(conf):
+    """
+    :return: the shapes of the parameters of network.inference_net keyed by
+        names, the matrices are (input size, output size)
+    :rtype: dict
+    """
+    word_vec_dim = conf.word_vec_dim
+    q_dim = conf.q_lstm_dim
+    e_dim = conf.e_lstm_dim
+    com_dim = conf.com_vec_dim
+    label_num = conf.label_num
+    shapes = {
+        "wordvecs": (-1, word_vec_dim),
+        "_q_hidden1.w0": (word_vec_dim, 4 * q_dim),
+        "_q_hidden1.wbias": (4 * q_dim, ),
+        "_q_rnn1.w0": (q_dim, 4 * q_dim),
+        "_q_rnn1.wbias": (7 * q_dim, ),
+        "_attention_layer1.w0": (q_dim, conf.latent_chain_dim),
+        "_attention_weight.w0": (conf.latent_chain_dim, 1),
+        "_cw_embedding.w0": (2, com_dim),
+        "_eecom_embedding.w0": (2, com_dim),
+        "_output.w0": (e_dim, label_num),
+        "_crf.w0": (label_num + 2, label_num),
+    }
+    e_hidden_in_dims = [(word_vec_dim, q_dim, com_dim, com_dim), (e_dim, ),
+                        (e_dim, e_dim)]
+    for idx, dims in enumerate(e_hidden_in_dims, 1):
+        for i, dim in enumerate(dims):
+            shapes["_e_hidden%d.w%d" % (idx, i)] = (dim, 4 * e_dim)
+        shapes["_e_hidden%d.wbias" % idx] = (4 * e_dim, )
+        shapes["_e_rnn%d.w0" % idx] = (e_dim, 4 * e_dim)
+        shapes["_e_rnn%d.wbias" % idx] = (7 * e_dim, )
+    return shapes
+
+
+def sigmoid(x):
+    return 1. / (1. + numpy.exp(-x))
+
+
+def pad(seqs, dtype="int64"):
+    """
+    :return: the padded sequences, (batch, max_len), and their lengths
+    :rtype: tuple
+    """
+    lengths = numpy.array([len(s) for s in seqs], dtype="int64")
+    ret = numpy.zeros((len(seqs), max(lengths.max(), 1)), dtype=dtype)
+    for i, s in enumerate(seqs):
+        ret[i, :len(s)] = s
+    return ret, lengths
+
+
+def reverse_padded(x, lengths):
+    """
+    Reverse the first lengths[b] steps of every row b, the padding stays
+    """
+    batch_size, max_len = x.shape[:2]
+    steps = numpy.arange(max_len)[None, :]
+    idx = numpy.where(steps < lengths[:, None], lengths[:, None] - 1 - steps,
+                      steps)
+    return x[numpy.arange(batch_size)[:, None], idx]
+
+
+def lstm(wx, lengths, w, bias, reverse=False):
+    """
+    The lstmemory layer of paddle with peephole connections
+
+    :param wx: projected inputs, (batch, max_len, 4 * size), the gates are
+        ordered as input node, input gate, forget gate, output gate
+    :param lengths: length of every row
+    :param w: recurrent weights, (size, 4 * size)
+    :param bias: 4 * size gate biases then the input, forget and output
+        peephole weights
+    :param reverse: process the rows from right to left
+    :return: the outputs, (batch, max_len, size)
+    """
+    size = w.shape[0]
+    gate_bias = bias[:4 * size]
+    check_i = bias[4 * size:5 * size]
+    check_f = bias[5 * size:6 * size]
+    check_o = bias[6 * size:7 * size]
+
+    if reverse:
+        wx = reverse_padded(wx, lengths)
+    batch_size, max_len = wx.shape[:2]
+    h = numpy.zeros((batch_size, size), dtype=wx.dtype)
+    c = numpy.zeros((batch_size, size), dtype=wx.dtype)
+    out = numpy.zeros((batch_size, max_len, size), dtype=wx.dtype)
+    # the padding is on the right, it never affects the real steps
+    for t in xrange(max_len):
+        g = wx[:, t] + gate_bias + h.dot(w)
+        a = numpy.tanh(g[:, :size])
+        i = sigmoid(g[:, size:2 * size] + c * check_i)
+        f = sigmoid(g[:, 2 * size:3 * size] + c * check_f)
+        c = a * i + c * f
+        o = sigmoid(g[:, 3 * size:] + c * check_o)
+        h = o * numpy.tanh(c)
+        out[:, t] = h
+    if reverse:
+        out = reverse_padded(out, lengths)
+    return out
+
+
+class NumpyNetwork(object):
+    """
+    The BiLSTM-CRF network of network.inference_net
+    """
+
+    def __init__(self, conf, parameters):
+        """
+        :param conf: network conf, conf.wordvecs is used instead of a float
+            wordvecs parameter when it is not None
+        :param parameters: flat parameters keyed by names
+        :type parameters: dict
+        """
+        self.conf = conf
+        self.label_num = conf.label_num
+        self.keep_rate = numpy.float32(1. - conf.drop_rate)
+        # question encodings keyed by token ids
+        self.q_cache = utils.LRUCache(conf.q_cache_size)
+        shapes = parameter_shapes(conf)
+
+        def get(name):
+            return numpy.asarray(parameters[name], dtype="float32").reshape(
+                shapes[name])
+
+        wordvecs = parameters.get("wordvecs")
+        if wordvecs is not None and \
+                not isinstance(wordvecs, numpy.ndarray) and \
+                (conf.wordvecs is None or len(conf.wordvecs) == len(wordvecs)):
+            # a quantize.QuantizedEmbedding of the full vocabulary, unless the
+            # vocabulary is restricted
+            self.wordvecs = wordvecs
+        elif conf.wordvecs is not None:
+            self.wordvecs = conf.wordvecs
+        else:
+            self.wordvecs = get("wordvecs")
+
+        self.q_hidden_w = get("_q_hidden1.w0")
+        self.q_hidden_b = get("_q_hidden1.wbias")
+        self.q_rnn_w = get("_q_rnn1.w0")
+        self.q_rnn_b = get("_q_rnn1.wbias")
+        self.att_w = get("_attention_layer1.w0")
+        self.att_weight_w = get("_attention_weight.w0")
+
+        self.qe_comm_emb = get("_cw_embedding.w0")
+        self.ee_comm_emb = get("_eecom_embedding.w0")
+
+        self.e_hidden_w = []
+        self.e_hidden_b = []
+        self.e_rnn_w = []
+        self.e_rnn_b = []
+        for idx, input_num in enumerate(E_HIDDEN_INPUTS, 1):
+            self.e_hidden_w.append([
+                get("_e_hidden%d.w%d" % (idx, i)) for i in xrange(input_num)
+            ])
+            self.e_hidden_b.append(get("_e_hidden%d.wbias" % idx))
+            self.e_rnn_w.append(get("_e_rnn%d.w0" % idx))
+            self.e_rnn_b.append(get("_e_rnn%d.wbias" % idx))
+
+        self.output_w = get("_output.w0")
+        self.crf_w = get("_crf.w0")
+
+    @classmethod
+    def from_tar(cls, conf, model_path):
+        """
+        Create the network from a params_pass_*.tar.gz
+        """
+        skip = ("wordvecs", ) if conf.wordvecs is not None else ()
+        return cls(conf, load_parameters(model_path, skip=skip))
+
+    @classmethod
+    def load(cls, conf, model_path):
+        """
+        Create the network from a params_pass_*.tar.gz or from parameters
+        quantized by quantize.py (.npz)
+        """
+        if model_path.endswith(".npz"):
+            import quantize
+            return cls(conf, quantize.load(model_path))
+        return cls.from_tar(conf, model_path)
+
+    def embed(self, ids):
+        return numpy.asarray(self.wordvecs[ids], dtype="float32")
+
+    def encode_questions(self, questions):
+        """
+        :param questions: token ids of every question
+        :type questions: list
+        :return: question encodings, (len(questions), q_lstm_dim)
+        :rtype: numpy array
+        """
+        ids, lengths = pad(questions)
+        wx = self.embed(ids).dot(self.q_hidden_w) + self.q_hidden_b
+        q_rnn = lstm(wx, lengths, self.q_rnn_w, self.q_rnn_b) * self.keep_rate
+
+        # self attention, a softmax over the steps of every question
+        score = numpy.tanh(q_rnn.dot(self.att_w)).dot(self.att_weight_w)[:, :,
+                                                                          0]
+        mask = numpy.arange(ids.shape[1])[None, :] < lengths[:, None]
+        score = numpy.where(mask, score, -numpy.inf)
+        score_max = numpy.where(mask, score, -1e30).max(axis=1)
+        weight = numpy.exp(score - score_max[:, None])
+        weight /= numpy.maximum(weight.sum(axis=1), 1e-30)[:, None]
+        return (q_rnn * weight[:, :, None]).sum(axis=1)
+
+    def question_encodings(self, questions):
+        """
+        Encode each distinct question once, the encodings are cached by token
+        ids across batches
+
+        :param questions: token ids of every question
+        :type questions: list
+        :return: question encodings, (len(questions), q_lstm_dim)
+        :rtype: numpy array
+        """
+        keys = [tuple(q) for q in questions]
+        encodings = {}
+        missing = []
+        for key in keys:
+            if key in encodings:
+                continue
+            encodings[key] = self.q_cache.get(key)
+            if encodings[key] is None:
+                missing.append(key)
+        if missing:
+            for key, enc in izip(missing, self.encode_questions(missing)):
+                encodings[key] = enc
+                self.q_cache.put(key, enc)
+        return numpy.array([encodings[key] for key in keys])
+
+    def emissions(self, batch, q_encodings=None):
+        """
+        Compute the CRF features, the output of the _output layer
+
+        :param batch: samples, see reader.SampleStream
+        :type batch: list
+        :param q_encodings: encodings of the questions of the samples, they
+            are looked up in the cache or computed when not given
+        :type q_encodings: numpy array
+        :return: padded emissions, (len(batch), max_len, label_num), and the
+            evidence lengths
+        :rtype: tuple
+        """
+        if q_encodings is None:
+            q_encodings = self.question_encodings(
+                [s[reader.Q_IDS] for s in batch])
+        e_ids, lengths = pad([s[reader.E_IDS] for s in batch])
+        qe_comm, _ = pad([s[reader.QE_COMM] for s in batch])
+        ee_comm, _ = pad([s[reader.EE_COMM] for s in batch])
+
+        w, b = self.e_hidden_w[0], self.e_hidden_b[0]
+        wx = self.embed(e_ids).dot(w[0]) + q_encodings.dot(w[1])[:, None] + \
+            self.qe_comm_emb[qe_comm].dot(w[2]) + \
+            self.ee_comm_emb[ee_comm].dot(w[3]) + b
+        e_rnn1 = lstm(wx, lengths, self.e_rnn_w[0],
+                      self.e_rnn_b[0]) * self.keep_rate
+
+        w, b = self.e_hidden_w[1], self.e_hidden_b[1]
+        e_rnn2 = lstm(
+            e_rnn1.dot(w[0]) + b,
+            lengths,
+            self.e_rnn_w[1],
+            self.e_rnn_b[1],
+            reverse=True) * self.keep_rate
+
+        # with cross layer links
+        w, b = self.e_hidden_w[2], self.e_hidden_b[2]
+        e_rnn3 = lstm(e_rnn2.dot(w[0]) + e_rnn1.dot(w[1]) + b, lengths,
+                      self.e_rnn_w[2], self.e_rnn_b[2]) * self.keep_rate
+
+        return e_rnn3.dot(self.output_w), lengths
+
+    def infer_batch(self, batch):
+        """
+        :param batch: samples, see reader.SampleStream
+        :type batch: list
+        :return: the best tags of each evidence
+        :rtype: list
+        """
+        emissions, lengths = self.emissions(batch)
+        tags = crf.viterbi(emissions, lengths, self.crf_w)
+        return [tags[i, :length] for i, length in enumerate(lengths)]
+
+    def top_spans(self, batch, k=1, max_span_len=None):
+        """
+        :return: for each evidence, the k most probable answer spans as
+            (start, end, probability), see crf.top_spans
+        :rtype: list
+        """
+        emissions, lengths = self.emissions(batch)
+        return crf.top_spans(emissions, lengths, self.crf_w, k, max_span_len)
+
+    def decode_spans(self, batch, b_label=0, i_label=1):
+        """
+        :return: for each evidence, (start, end, probability) of the answer
+            spans of its best tags
+        :rtype: list
+        """
+        emissions, lengths = self.emissions(batch)
+        tags = crf.viterbi(emissions, lengths, self.crf_w)
+        spans = [
+            crf.extract_spans(tags[i, :length], b_label, i_label)
+            for i, length in enumerate(lengths)
+        ]
+        rows = [i for i, row in enumerate(spans) for span in row]
+        if not rows:
+            return [[] for row in spans]
+        starts, ends = zip(*[span for row in spans for span in row])
+        probs = iter(
+            numpy.exp(
+                crf.score_spans(emissions, lengths, self.crf_w, rows, starts,
+                                ends, b_label, i_label)).tolist())
+        return [[(start, end, next(probs)) for start, end in row]
+                for row in spans]
+
+    def infer(self, input, field="id", feeding=None):
+        """
+        The same interface as paddle.inference.Inference, the tags of all
+        evidence tokens are concatenated
+        """
+        return numpy.concatenate(self.infer_batch(input))
+
+
+class Infer(object):
+    """
+    Tag a data file, the same as infer.Infer without paddle
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.settings = reader.Settings(
+            vocab=conf.vocab,
+            is_training=False,
+            label_schema=conf.label_schema,
+            num_workers=conf.num_reader_workers)
+
+    def infer_batches(self, model_path, data_path, decode=None):
+        """
+        Run the network on the batches, which are read and featurized ahead
+        in a background thread
+
+        :param decode: a function of the network and a batch returning one
+            result per sample, NumpyNetwork.infer_batch by default
+        :return: a generator of (indices, samples, result of every sample)
+            of each batch, see batching.batch
+        """
+        test_reader = batching.batch(
+            reader.create_reader(
+                data_path,
+                self.settings,
+                shard_id=self.conf.shard_id,
+                num_shards=self.conf.num_shards),
+            batch_size=self.conf.batch_size,
+            window=self.conf.bucket_window,
+            max_tokens=self.conf.max_batch_tokens,
+            shuffle=False,
+            keep_index=True)
+        test_reader = pipeline.prefetch(test_reader, self.conf.pipeline_depth)
+
+        network = NumpyNetwork.load(self.conf, model_path)
+        if decode is None:
+            decode = NumpyNetwork.infer_batch
+
+        for indices, test_batch in test_reader():
+            yield indices, test_batch, decode(network, test_batch)
+
+    def infer_tags(self, model_path, data_path):
+        """
+        :return: a generator of the tags of every sample, in the order of the
+            data file
+        """
+        # bucketed batches are put back in the order of the data file
+        return batching.restore_order(
+            (indices, results)
+            for indices, test_batch, results in self.infer_batches(
+                model_path, data_path))
+
+    def infer(self, model_path, data_path, output, binary=False):
+        """
+        Write the tags of every sample
+
+        :param binary: write a tag file instead of text, see tagfile.py
+        :type binary: bool
+        """
+
+        def write(batches):
+            results = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch], tags))
+                for indices, test_batch, tags in batches)
+            tagfile.write(results, output, binary)
+
+        # the results are formatted and written in a background thread
+        pipeline.write_behind(
+            self.infer_batches(model_path, data_path), write,
+            self.conf.pipeline_depth)
+
+    def infer_answers(self, model_path, data_path, output, use_scores=False):
+        """
+        Write the voted answer of every question as json lines, see answer.py
+
+        :param use_scores: weigh the votes by the probabilities of the spans
+        :type use_scores: bool
+        """
+        settings = self.settings
+        # the tokens the answers are made of are carried by the samples
+        settings.keep_tokens = True
+        if use_scores:
+            results = self.infer_batches(
+                model_path,
+                data_path,
+                decode=lambda network, batch: network.decode_spans(
+                    batch, settings.B, settings.I))
+        else:
+            results = self.infer_batches(model_path, data_path)
+
+        def write(batches):
+            samples = batching.restore_order(
+                (indices, zip([s[reader.Q_IDX] for s in test_batch],
+                              [s[reader.TOKENS] for s in test_batch], results))
+                for indices, test_batch, results in batches)
+            if not use_scores:
+                samples = ((q_idx, tokens, answer.tag_spans(tags, settings))
+                           for q_idx, tokens, tags in samples)
+            answer.write_records(answer.answer_records(samples), output)
+
+        pipeline.write_behind(results, write, self.conf.pipeline_depth)
+
+
+class Application(object):
+    """
+    Tag the evidences of single questions, the same as
+    application.Application without paddle
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.network = None
+
+    def load(self, model_path):
+        self.network = NumpyNetwork.load(self.conf, model_path)
+
+    def make_batch(self, question, evidences):
+        return features.make_samples(question, evidences, self.conf.vocab)
+
+    def infer_batch(self, test_batch):
+        return self.network.infer_batch(test_batch)
+
+
+def load_vocab(conf, tokens=None):
+    """
+    Load the vocabulary, and the word embeddings when the binary store
+    exists, otherwise they are read from the model
+
+    :param tokens: only load these tokens, see embedding.restrict
+    :type tokens: set
+    """
+    if tokens is not None:
+        conf.vocab, conf.wordvecs = utils.load_wordvecs(
+            conf.word_dict_path, conf.wordvecs_path, conf.wordvecs_bin_path,
+            tokens)
+    elif os.path.exists(conf.wordvecs_bin_path):
+        conf.vocab, conf.wordvecs = embedding.load(conf.wordvecs_bin_path)
+    else:
+        conf.vocab = utils.load_dict(conf.word_dict_path)
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path")
+    parser.add_argument("data_path")
+    parser.add_argument("output", help="'-' for stdout")
+    parser.add_argument(
+        "--answers",
+        action="store_true",
+        help="write the voted answer of every question instead of the tags")
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the tags to a binary tag file, see tagfile.py")
+    parser.add_argument(
+        "--vote_by_score",
+        action="store_true",
+        help="weigh the votes by the CRF probabilities of the answer spans")
+    parser.add_argument(
+        "--restrict_vocab",
+        metavar="TOKENS_PATH",
+        help="only load the words of a json(.gz) data file, e.g. data_path, "
+        "or of a token list")
+    return parser.parse_args()
+
+
+def main(args):
+    conf = config.InferConfig()
+    load_vocab(conf, embedding.load_tokens(args.restrict_vocab)
+               if args.restrict_vocab else None)
+
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = utils.open_file(args.output, "w")
+
+    infer = Infer(conf)
+    if args.answers:
+        infer.infer_answers(args.model_path, args.data_path, output,
+                            args.vote_by_score)
+    else:
+        infer.infer(args.model_path, args.data_path, output, args.binary)
+
+    output.close()
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
@@ -0,0 +1,132 @@
+"""
+Statistics of the parameters during training.
+
+Every show_parameter_status_period batches the values and gradients of the
+parameters which are trained are copied out of paddle, static ones such as
+wordvecs never change and are skipped. The statistics are computed in a
+background thread, over a sample of the rows of the large parameters, and
+appended to a file as json lines, one record per parameter:
+
+    {"time": ..., "pass_id": 0, "batch_id": 99, "name": "_output.w0",
+     "shape": [192, 4], "rows": 192,
+     "value": {"mean": ..., "std": ..., "abs_mean": ..., "abs_max": ...,
+               "abs_min": ..., "norm": ..., "hist": [counts, bin edges]},
+     "grad": {...}}
+"""
+import json
+import time
+
+import numpy
+
+import pipeline
+import utils
+
+__all__ = ["summarize", "ParameterStats"]
+
+
+def summarize(array, bins):
+    """
+    :param array: values or gradients of a parameter
+    :type array: numpy array
+    :param bins: number of bins of the histogram
+    :type bins: int
+    :return: statistics of the array
+    :rtype: dict
+    """
+    array = numpy.asarray(array, dtype="float64").ravel()
+    if not array.size:
+        return {}
+    abs_array = numpy.abs(array)
+    counts, edges = numpy.histogram(array, bins=bins)
+    return {
+        "mean": array.mean(),
+        "std": array.std(),
+        "abs_mean": abs_array.mean(),
+        "abs_max": abs_array.max(),
+        "abs_min": abs_array.min(),
+        "norm": numpy.sqrt(numpy.dot(array, array)),
+        "hist": [counts.tolist(), edges.tolist()]
+    }
+
+
+class ParameterStats(object):
+    """
+    Write statistics of the parameters in a background thread
+
+    Usage:
+        with ParameterStats(path) as stats:
+            ...
+            stats.record(parameters, pass_id, batch_id)
+    """
+
+    def __init__(self, path, sample_rows=0, bins=20, seed=0):
+        """
+        :param path: json lines file the records are appended to
+        :type path: str
+        :param sample_rows: number of rows of a parameter the statistics are
+            computed over, 0 for all rows
+        :type sample_rows: int
+        :param bins: number of bins of the histograms
+        :type bins: int
+        :param seed: random seed of the sampled rows
+        :type seed: int
+        """
+        self.path = path
+        self.sample_rows = sample_rows
+        self.bins = bins
+        self.random = numpy.random.RandomState(seed or None)
+        self.writer = pipeline.BackgroundWriter(self.write_all, 1)
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def record(self, parameters, pass_id, batch_id):
+        """
+        Copy the values and gradients of the parameters which are trained,
+        and queue them to be summarized
+        """
+        copies = []
+        for name in parameters.names():
+            if parameters.__param_conf__[name].is_static:
+                continue
+            copies.append((name, parameters.get(name),
+                           parameters.get_grad(name)))
+        self.writer.put((time.time(), pass_id, batch_id, copies))
+
+    def sample(self, value, grad):
+        """
+        :return: the same sampled rows of the values and the gradients
+        """
+        value = value.reshape(value.shape[0], -1)
+        grad = grad.reshape(value.shape)
+        if self.sample_rows <= 0 or len(value) <= self.sample_rows:
+            return value, grad
+        rows = numpy.sort(
+            self.random.choice(len(value), self.sample_rows, replace=False))
+        return value[rows], grad[rows]
+
+    def records(self, timestamp, pass_id, batch_id, copies):
+        for name, value, grad in copies:
+            shape = list(value.shape)
+            value, grad = self.sample(value, grad)
+            yield {
+                "time": timestamp,
+                "pass_id": pass_id,
+                "batch_id": batch_id,
+                "name": name,
+                "shape": shape,
+                "rows": len(value),
+                "value": summarize(value, self.bins),
+                "grad": summarize(grad, self.bins)
+            }
+
+    def write_all(self, items):
+        with utils.open_file(self.path, "a") as f:
+            for item in items:
+                for record in self.records(*item):
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
@@ -0,0 +1,160 @@
+"""
+Threaded stages connected by bounded queues.
+
+prefetch runs a reader in a background thread so reading and featurizing the
+next batches overlaps the model, and BackgroundWriter consumes results in a
+background thread so formatting and writing overlaps it as well. The queues
+are bounded, a fast stage blocks when it is depth items ahead of the next
+one. Exceptions of a background stage are raised again in the caller.
+"""
+import Queue
+import sys
+import threading
+
+__all__ = ["prefetch", "BackgroundWriter", "write_behind"]
+
+_END = object()
+
+
+class _Error(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def prefetch(reader_creator, depth):
+    """
+    Read ahead up to depth items of a reader in a background thread
+
+    :param reader_creator: a function returning an iterable
+    :type reader_creator: callable
+    :param depth: maximum number of items read ahead, 0 to read in the
+        calling thread
+    :type depth: int
+    :return: a function returning an iterable of the same items
+    :rtype: callable
+    """
+    if depth <= 0:
+        return reader_creator
+
+    def prefetch_reader():
+        items = Queue.Queue(maxsize=depth)
+        stopped = threading.Event()
+
+        def put(item):
+            # give up when the consumer is gone
+            while not stopped.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for item in reader_creator():
+                    if not put(item): return
+                put(_END)
+            except Exception:
+                put(_Error(sys.exc_info()))
+
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is _END: break
+                if isinstance(item, _Error):
+                    raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+                yield item
+        finally:
+            stopped.set()
+
+    return prefetch_reader
+
+
+class BackgroundWriter(object):
+    """
+    Feed items to a consumer running in a background thread
+
+    Usage:
+        with BackgroundWriter(consume, depth) as writer:
+            for item in items:
+                writer.put(item)
+    """
+
+    def __init__(self, consume, depth):
+        """
+        :param consume: a function consuming an iterable of the put items
+        :type consume: callable
+        :param depth: maximum number of items waiting to be consumed
+        :type depth: int
+        """
+        self.consume = consume
+        self.items = Queue.Queue(maxsize=max(depth, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is None:
+            self.check()
+
+    def run(self):
+        ended = []
+
+        def items():
+            while True:
+                item = self.items.get()
+                if item is _END:
+                    ended.append(True)
+                    return
+                yield item
+
+        try:
+            self.consume(items())
+        except Exception:
+            self.error = sys.exc_info()
+        # drain the queue so that put never blocks
+        if not ended:
+            while self.items.get() is not _END:
+                pass
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def put(self, item):
+        self.check()
+        self.items.put(item)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.items.put(_END)
+            self.thread.join()
+
+
+def write_behind(items, consume, depth):
+    """
+    Consume items in a background thread while they are produced by the
+    calling thread
+
+    :param items: an iterable, e.g. the results of the model
+    :param consume: a function consuming an iterable of the items
+    :type consume: callable
+    :param depth: maximum number of items waiting to be consumed, 0 to
+        consume them in the calling thread
+    :type depth: int
+    """
+    if depth <= 0:
+        consume(items)
+        return
+    with BackgroundWriter(consume, depth) as writer:
+        for item in items:
+            writer.put(item)
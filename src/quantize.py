@@ -0,0 +1,220 @@
+"""
+Quantized word embeddings for the numpy engine.
+
+Only the word embeddings are quantized, they are stored as int8 with one
+scale per row and the rows are dequantized when they are looked up, so the
+embedding table stays at a quarter of its float32 size in memory. The other
+parameters stay float32: numpy has no fast int8 matrix product, quantized
+weights would have to be dequantized for every product or kept dequantized
+in memory.
+
+Only the bilstm_crf network has a numpy forward pass, the Match-LSTM models
+of mLSTM_crf are rejected.
+
+Usage:
+    python quantize.py convert params_pass_00024.tar.gz params.quant.npz
+    python quantize.py check params_pass_00024.tar.gz params.quant.npz \
+        data/data/validation.ann.json.gz
+"""
+import argparse
+import logging
+import time
+
+import numpy
+
+import config
+import crf
+import numpy_infer
+import reader
+import utils
+from utils import logger
+
+__all__ = ["quantize_rows", "QuantizedEmbedding", "convert", "load", "check"]
+
+# version 1 also had int8 and float16 weights
+FORMAT_VERSION = 2
+
+
+def quantize_rows(matrix):
+    """
+    Symmetric int8 quantization with one scale per row
+
+    :return: int8 values and float32 scales, matrix ~ values * scales[:, None]
+    :rtype: tuple
+    """
+    matrix = numpy.asarray(matrix, dtype="float32")
+    scales = numpy.abs(matrix).max(axis=1) / 127.
+    scales[scales == 0] = 1.
+    values = numpy.round(matrix / scales[:, None])
+    return values.astype("int8"), scales.astype("float32")
+
+
+class QuantizedEmbedding(object):
+    """
+    An int8 embedding table, rows are dequantized when looked up
+    """
+
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = scales
+        self.shape = values.shape
+
+    def __getitem__(self, ids):
+        return self.values[ids].astype("float32") * \
+            self.scales[ids][..., None]
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scales.nbytes
+
+
+def convert(conf, model_path, output_path):
+    """
+    Quantize the word embeddings of a params_pass_*.tar.gz of bilstm_crf
+    """
+    shapes = numpy_infer.parameter_shapes(conf)
+    params = numpy_infer.load_parameters(model_path)
+    missing = sorted(set(shapes) - set(params))
+    if missing:
+        raise ValueError("%s is not a bilstm_crf model, it has no %s: the "
+                         "Match-LSTM models of mlstm_crf are not supported" %
+                         (model_path, ", ".join(missing)))
+    arrays = {"format_version": numpy.array(FORMAT_VERSION)}
+    for name, value in params.iteritems():
+        if name not in shapes:
+            logger.info("skip %s, not a parameter of the network" % name)
+            continue
+        value = value.reshape(shapes[name])
+        if name == "wordvecs":
+            arrays[name + ".int8"], arrays[name + ".scale"] = \
+                quantize_rows(value)
+        else:
+            arrays[name] = value
+    with open(output_path, "wb") as f:
+        numpy.savez(f, **arrays)
+
+
+def load(path):
+    """
+    Load quantized parameters for numpy_infer.NumpyNetwork
+
+    :return: float32 parameters keyed by names, the int8 embeddings as a
+        QuantizedEmbedding
+    :rtype: dict
+    """
+    arrays = numpy.load(path)
+    version = int(arrays["format_version"])
+    if version != FORMAT_VERSION:
+        raise ValueError("%s has the format version %d instead of %d, "
+                         "convert the model again with quantize.py" %
+                         (path, version, FORMAT_VERSION))
+    params = {}
+    for key in arrays.files:
+        if key in ("format_version", "wordvecs.int8", "wordvecs.scale"):
+            continue
+        params[key] = arrays[key]
+    params["wordvecs"] = QuantizedEmbedding(arrays["wordvecs.int8"],
+                                            arrays["wordvecs.scale"])
+    return params
+
+
+def chunk_counts(tags, labels, settings):
+    """
+    :return: the number of predicted, golden and correct answer spans
+    :rtype: tuple
+    """
+    predicted = set(crf.extract_spans(tags, settings.B, settings.I))
+    golden = set(crf.extract_spans(labels, settings.B, settings.I))
+    return len(predicted), len(golden), len(predicted & golden)
+
+
+def chunk_f1(counts):
+    predicted, golden, correct = counts
+    precision = correct / float(predicted) if predicted else 0.
+    recall = correct / float(golden) if golden else 0.
+    if precision + recall == 0: return 0.
+    return 2 * precision * recall / (precision + recall)
+
+
+def check(conf, model_path, quantized_path, data_path):
+    """
+    Compare the quantized network with the float network on a labeled data
+    file, the chunk F1 of both and their agreement are logged
+
+    :return: chunk F1 of the float network and of the quantized network
+    :rtype: tuple
+    """
+    settings = reader.Settings(
+        vocab=conf.vocab, is_training=False, label_schema=conf.label_schema)
+    # the e-e.comm features of test samples are drawn at random, both
+    # networks must see the same samples
+    samples = list(reader.create_reader(data_path, settings)())
+
+    networks = [
+        numpy_infer.NumpyNetwork.from_tar(conf, model_path),
+        numpy_infer.NumpyNetwork(conf, load(quantized_path))
+    ]
+    counts = [[0, 0, 0], [0, 0, 0]]
+    seconds = [0., 0.]
+    same_tags = total_tags = 0
+    for start in xrange(0, len(samples), conf.batch_size):
+        batch = samples[start:start + conf.batch_size]
+        results = []
+        for i, network in enumerate(networks):
+            start_time = time.time()
+            results.append(network.infer_batch(batch))
+            seconds[i] += time.time() - start_time
+        for sample, float_tags, quant_tags in zip(batch, *results):
+            labels = sample[reader.LABELS]
+            for i, tags in enumerate((float_tags, quant_tags)):
+                for j, n in enumerate(chunk_counts(tags, labels, settings)):
+                    counts[i][j] += n
+            same_tags += (float_tags == quant_tags).sum()
+            total_tags += len(float_tags)
+
+    f1 = [chunk_f1(c) for c in counts]
+    sizes = [network.wordvecs.nbytes for network in networks]
+    logger.info("float: chunk_f1=%.6f time=%.2fs embedding=%dB" %
+                (f1[0], seconds[0], sizes[0]))
+    logger.info("quantized: chunk_f1=%.6f time=%.2fs embedding=%dB" %
+                (f1[1], seconds[1], sizes[1]))
+    logger.info("tag agreement: %.6f" %
+                (same_tags / float(max(total_tags, 1))))
+    return f1[0], f1[1]
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    convert_parser = subparsers.add_parser(
+        "convert",
+        help="quantize the word embeddings of a params_pass_*.tar.gz of "
+        "bilstm_crf")
+    convert_parser.add_argument("model_path")
+    convert_parser.add_argument("output_path")
+    check_parser = subparsers.add_parser(
+        "check", help="compare the quantized and the float networks")
+    check_parser.add_argument("model_path")
+    check_parser.add_argument("quantized_path")
+    check_parser.add_argument("data_path", help="labeled json(.gz) data")
+    return parser.parse_args()
+
+
+def main(args):
+    conf = config.InferConfig()
+    if args.command == "convert":
+        convert(conf, args.model_path, args.output_path)
+    else:
+        # the results of check are logged, utils.logger only shows errors
+        logging.basicConfig()
+        logger.setLevel(logging.INFO)
+        conf.vocab = utils.load_dict(conf.word_dict_path,
+                                     conf.wordvecs_bin_path)
+        check(conf, args.model_path, args.quantized_path, args.data_path)
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
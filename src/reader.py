@@ -1,16 +1,23 @@
+import glob
+import itertools
 import json
+import multiprocessing
 import random
 import sys
 import traceback
 from itertools import izip
 
+import numpy
+
 import utils
 from datapoint import DataPoint, Evidence, EecommFeatures
 from utils import logger
 
 __all__ = [
-    "Q_IDS", "E_IDS", "LABELS", "QE_COMM", "EE_COMM", "Q_IDS_STR", "E_IDS_STR",
-    "LABELS_STR", "QE_COMM_STR", "EE_COMM_STR", "Settings", "create_reader"
+    "Q_IDS", "E_IDS", "LABELS", "QE_COMM", "EE_COMM", "Q_IDX", "TOKENS",
+    "Q_IDS_STR", "E_IDS_STR", "LABELS_STR", "QE_COMM_STR", "EE_COMM_STR",
+    "Settings", "make_eecom_table", "open_sample_stream", "shard_random",
+    "restore_random", "create_reader", "check_resume"
 ]
 
 # slot names
@@ -25,10 +32,39 @@ E_IDS = 1
 LABELS = 2
 QE_COMM = 3
 EE_COMM = 4
+# index of the question in the data file, only in test samples and not fed
+# to the network
+Q_IDX = 5
+# (question tokens, evidence tokens), only in test samples read with
+# keep_tokens and not fed to the network
+TOKENS = 6
 
 NO_ANSWER = "no_answer"
 
 
+def make_eecom_table(positive, negative=()):
+    """
+    Flatten the ee.comm candidates of a sample. Before the sample is fed,
+    one candidate is drawn: a positive one or the bucket of the negative
+    ones uniformly, then a candidate of the bucket uniformly.
+
+    :param positive: the features of the candidates drawn one by one
+    :type positive: list
+    :param negative: the features of the candidates drawn as one bucket
+    :type negative: list
+    :return: (concatenated features, offsets of every candidate and of the
+        end, number of positive candidates, number of negative candidates),
+        candidate k is features[offsets[k]:offsets[k + 1]], the positive
+        ones first
+    :rtype: tuple
+    """
+    feats, offsets = [], [0]
+    for candidate in itertools.chain(positive, negative):
+        feats.extend(candidate)
+        offsets.append(len(feats))
+    return feats, offsets, len(positive), len(negative)
+
+
 class Settings(object):
     """
     class for storing settings
@@ -41,7 +77,11 @@ class Settings(object):
                  negative_sample_ratio=0.2,
                  hit_ans_negative_sample_ratio=0.25,
                  keep_first_b=False,
-                 seed=31425926):
+                 seed=31425926,
+                 num_workers=1,
+                 sample_storage="list",
+                 shuffle_buffer_size=0,
+                 keep_tokens=False):
         """
         Init function
 
@@ -63,12 +103,34 @@ class Settings(object):
         :type keep_first_b: bool
         :param seed: random seed, the default value is 31425926
         :type seed: int
+        :param num_workers: number of processes parsing the data file, the
+            default value is 1
+        :type num_workers: int
+        :param sample_storage: how training samples are kept in memory, "list"
+            for python lists or "array" for flat typed arrays, the default
+            value is "list"
+        :type sample_storage: str
+        :param shuffle_buffer_size: if positive, training samples are streamed
+            through shuffle buffers holding at most this number of samples of
+            each type instead of being loaded all at once, the default value
+            is 0
+        :type shuffle_buffer_size: int
+        :param keep_tokens: keep the tokens in the test samples, see TOKENS,
+            the default value is False
+        :type keep_tokens: bool
         """
         self.negative_sample_ratio = negative_sample_ratio
         self.hit_ans_negative_sample_ratio = hit_ans_negative_sample_ratio
         self.keep_first_b = keep_first_b
         self.is_training = is_training
         self.vocab = vocab
+        self.num_workers = num_workers
+        self.seed = seed
+        if sample_storage not in ("list", "array"):
+            raise ValueError("sample_storage should be list/array")
+        self.sample_storage = sample_storage
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.keep_tokens = keep_tokens
 
         # set up label schema
         if label_schema == "BIO":
@@ -105,136 +167,283 @@ class Settings(object):
 
 
 class SampleStream(object):
-    def __init__(self, filename, settings):
+    def __init__(self, filename, settings, start=0, step=1):
+        """
+        :param start: q_idx of the first question read, the lines before it
+            are not parsed
+        :type start: int
+        :param step: only every step-th question from start is read, the
+            other lines are not parsed
+        :type step: int
+        """
         self.filename = filename
         self.settings = settings
+        self.start = start
+        self.step = step
 
     def __iter__(self):
         return self.load_and_filter_samples(self.filename)
 
-    def load_and_filter_samples(self, filename):
-        def remove_extra_b(labels):
-            if labels.count(self.settings.B) <= 1: return
-
-            i = 0
-            # find the first B
-            while i < len(labels) and labels[i] == self.settings.O1:
-                i += 1
-            i += 1  # skip B
-            # skip the following Is
-            while i < len(labels) and labels[i] == self.settings.I:
-                i += 1
-            # change all the other tags to O2
-            while i < len(labels):
-                labels[i] = self.settings.O2
-                i += 1
-
-        def filter_and_preprocess_evidences(evidences):
-            for i, evi in enumerate(evidences):
-                # convert golden labels to labels ids
-                if Evidence.GOLDEN_LABELS in evi:
-                    labels = [self.settings.label_map[l] \
-                              for l in evi[Evidence.GOLDEN_LABELS]]
-                else:
-                    labels = [self.settings.O1] * len(evi[Evidence.E_TOKENS])
-
-                # determine the current evidence is negative or not
-                answer_list = evi[Evidence.GOLDEN_ANSWERS]
-                is_negative = len(answer_list) == 1 \
-                              and "".join(answer_list[0]).lower() == NO_ANSWER
-
-                # drop positive evidences that do not contain golden answer
-                # matches in training
-                is_all_o1 = labels.count(self.settings.O1) == len(labels)
-                if self.settings.is_training and is_all_o1 and not is_negative:
-                    evidences[i] = None  # dropped
-                    continue
-
-                if self.settings.keep_first_b:
-                    remove_extra_b(labels)
-                evi[Evidence.GOLDEN_LABELS] = labels
-
-        def get_eecom_feats_list(cur_sample_is_negative, eecom_feats_list,
-                                 evidences):
-            if not self.settings.is_training:
-                return [item[EecommFeatures.EECOMM_FEATURES] \
-                        for item in eecom_feats_list]
-
-            positive_eecom_feats_list = []
-            negative_eecom_feats_list = []
-
-            for eecom_feats_, other_evi in izip(eecom_feats_list, evidences):
-                if not other_evi: continue
-
-                eecom_feats = eecom_feats_[EecommFeatures.EECOMM_FEATURES]
-                if not eecom_feats: continue
-
-                other_evi_type = eecom_feats_[EecommFeatures.OTHER_E_TYPE]
-                if cur_sample_is_negative and \
-                        other_evi_type != Evidence.POSITIVE:
-                    continue
-
-                if other_evi_type == Evidence.POSITIVE:
-                    positive_eecom_feats_list.append(eecom_feats)
-                else:
-                    negative_eecom_feats_list.append(eecom_feats)
-
-            eecom_feats_list = positive_eecom_feats_list
-            if negative_eecom_feats_list:
-                eecom_feats_list += [negative_eecom_feats_list]
-
-            return eecom_feats_list
-
-        def process_tokens(data, tok_key):
-            ids = [self.settings.vocab.get(token, self.settings.oov_id) \
-                   for token in data[tok_key]]
-            return ids
-
-        def process_evi(q_ids, evi, evidences):
-            e_ids = process_tokens(evi, Evidence.E_TOKENS)
-
-            labels = evi[Evidence.GOLDEN_LABELS]
-            qe_comm = evi[Evidence.QECOMM_FEATURES]
-            sample_type = evi[Evidence.TYPE]
-
-            ret = [None] * 5
-            ret[Q_IDS] = q_ids
-            ret[E_IDS] = e_ids
-            ret[LABELS] = labels
-            ret[QE_COMM] = qe_comm
-
-            eecom_feats_list = get_eecom_feats_list(
-                sample_type != Evidence.POSITIVE,
-                evi[Evidence.EECOMM_FEATURES_LIST], evidences)
-            if not eecom_feats_list:
-                return None
+    def remove_extra_b(self, labels):
+        if labels.count(self.settings.B) <= 1: return
+
+        i = 0
+        # find the first B
+        while i < len(labels) and labels[i] == self.settings.O1:
+            i += 1
+        i += 1  # skip B
+        # skip the following Is
+        while i < len(labels) and labels[i] == self.settings.I:
+            i += 1
+        # change all the other tags to O2
+        while i < len(labels):
+            labels[i] = self.settings.O2
+            i += 1
+
+    def filter_and_preprocess_evidences(self, evidences):
+        for i, evi in enumerate(evidences):
+            # convert golden labels to labels ids
+            if Evidence.GOLDEN_LABELS in evi:
+                labels = [self.settings.label_map[l] \
+                          for l in evi[Evidence.GOLDEN_LABELS]]
+            else:
+                labels = [self.settings.O1] * len(evi[Evidence.E_TOKENS])
+
+            # determine the current evidence is negative or not
+            answer_list = evi[Evidence.GOLDEN_ANSWERS]
+            is_negative = len(answer_list) == 1 \
+                          and "".join(answer_list[0]).lower() == NO_ANSWER
+
+            # drop positive evidences that do not contain golden answer
+            # matches in training
+            is_all_o1 = labels.count(self.settings.O1) == len(labels)
+            if self.settings.is_training and is_all_o1 and not is_negative:
+                evidences[i] = None  # dropped
+                continue
+
+            if self.settings.keep_first_b:
+                self.remove_extra_b(labels)
+            evi[Evidence.GOLDEN_LABELS] = labels
+
+    def get_eecom_feats_list(self, cur_sample_is_negative, eecom_feats_list,
+                             evidences):
+        if not self.settings.is_training:
+            return make_eecom_table([item[EecommFeatures.EECOMM_FEATURES] \
+                                     for item in eecom_feats_list])
+
+        positive_eecom_feats_list = []
+        negative_eecom_feats_list = []
+
+        for eecom_feats_, other_evi in izip(eecom_feats_list, evidences):
+            if not other_evi: continue
+
+            eecom_feats = eecom_feats_[EecommFeatures.EECOMM_FEATURES]
+            if not eecom_feats: continue
+
+            other_evi_type = eecom_feats_[EecommFeatures.OTHER_E_TYPE]
+            if cur_sample_is_negative and \
+                    other_evi_type != Evidence.POSITIVE:
+                continue
+
+            if other_evi_type == Evidence.POSITIVE:
+                positive_eecom_feats_list.append(eecom_feats)
             else:
-                ret[EE_COMM] = eecom_feats_list
-                return ret
+                negative_eecom_feats_list.append(eecom_feats)
+
+        return make_eecom_table(positive_eecom_feats_list,
+                                negative_eecom_feats_list)
+
+    def process_tokens(self, data, tok_key):
+        ids = [self.settings.vocab.get(token, self.settings.oov_id) \
+               for token in data[tok_key]]
+        return ids
+
+    def process_evi(self, q_ids, evi, evidences):
+        e_ids = self.process_tokens(evi, Evidence.E_TOKENS)
+
+        labels = evi[Evidence.GOLDEN_LABELS]
+        qe_comm = evi[Evidence.QECOMM_FEATURES]
+        sample_type = evi[Evidence.TYPE]
+
+        ret = [None] * 5
+        ret[Q_IDS] = q_ids
+        ret[E_IDS] = e_ids
+        ret[LABELS] = labels
+        ret[QE_COMM] = qe_comm
+
+        eecom_table = self.get_eecom_feats_list(
+            sample_type != Evidence.POSITIVE,
+            evi[Evidence.EECOMM_FEATURES_LIST], evidences)
+        feats, offsets, positive_num, negative_num = eecom_table
+        if positive_num + negative_num == 0:
+            return None
+        else:
+            ret[EE_COMM] = eecom_table
+            return ret
+
+    def parse_line(self, line):
+        """
+        Parse one line of the data file
+
+        :param line: a json encoded DataPoint
+        :type line: str
+        :return: the (sample, type) pairs of the line, None if the line is
+            broken
+        :rtype: list
+        """
+        # parse json line
+        try:
+            data = json.loads(line)
+        except Exception:
+            logger.fatal("ERROR LINE: %s", line.strip())
+            traceback.print_exc()
+            return None
+
+        return [(sample, evi[Evidence.TYPE])
+                for sample, evi in self.process_data(data)]
+
+    def process_data(self, data):
+        """
+        :param data: a decoded DataPoint
+        :type data: dict
+        :return: the (sample, evidence) pairs of the kept evidences
+        :rtype: list
+        """
+        # convert question tokens to ids
+        q_ids = self.process_tokens(data, DataPoint.Q_TOKENS)
+
+        # process evidences
+        ret = []
+        evidences = data[DataPoint.EVIDENCES]
+        self.filter_and_preprocess_evidences(evidences)
+        for evi in evidences:
+            if not evi: continue
+            sample = self.process_evi(q_ids, evi, evidences)
+            if not sample: continue
+            if self.settings.keep_tokens:
+                sample.append((data[DataPoint.Q_TOKENS],
+                               evi[Evidence.E_TOKENS]))
+            ret.append((sample, evi))
+        return ret
 
+    def parse_lines(self, lines):
+        if self.settings.num_workers <= 1:
+            return itertools.imap(self.parse_line, lines)
+        return _parallel_parse(self, lines, self.settings.num_workers)
+
+    def load_and_filter_samples(self, filename):
         with utils.DotBar(utils.open_file(filename)) as f_:
-            for q_idx, line in enumerate(f_):
-                # parse json line
-                try:
-                    data = json.loads(line)
-                except Exception:
-                    logger.fatal("ERROR LINE: %s", line.strip())
-                    traceback.print_exc()
-                    continue
-
-                # convert question tokens to ids
-                q_ids = process_tokens(data, DataPoint.Q_TOKENS)
-
-                # process evidences
-                evidences = data[DataPoint.EVIDENCES]
-                filter_and_preprocess_evidences(evidences)
-                for evi in evidences:
-                    if not evi: continue
-                    sample = process_evi(q_ids, evi, evidences)
-                    if sample: yield q_idx, sample, evi[Evidence.TYPE]
+            lines = itertools.islice(f_, self.start, None, self.step)
+            for i, parsed in enumerate(self.parse_lines(lines)):
+                if parsed is None: continue
+                q_idx = self.start + i * self.step
+                for sample, type_ in parsed:
+                    yield q_idx, sample, type_
+
+
+# the stream used by the parsing processes, set before they are forked
+_worker_stream = None
+
+
+def _init_worker(stream):
+    global _worker_stream
+    _worker_stream = stream
+
+
+def _worker_parse_line(line):
+    return _worker_stream.parse_line(line)
+
+
+def _parallel_parse(stream, lines, num_workers, chunksize=32, chunks_ahead=4):
+    """
+    Parse lines in num_workers processes, the results keep the order of lines.
+    The lines are handed to the pool in blocks of num_workers * chunksize *
+    chunks_ahead lines, the next block is parsed while the results of the
+    current one are consumed, so at most two blocks are read ahead.
+    """
+    pool = multiprocessing.Pool(
+        num_workers, initializer=_init_worker, initargs=(stream, ))
+    lines = iter(lines)
+    block_size = num_workers * chunksize * chunks_ahead
+
+    def parse_blocks():
+        while True:
+            block = list(itertools.islice(lines, block_size))
+            if not block: return
+            yield pool.imap(_worker_parse_line, block, chunksize)
+
+    try:
+        blocks = parse_blocks()
+        current = next(blocks, None)
+        while current is not None:
+            upcoming = next(blocks, None)
+            for parsed in current:
+                yield parsed
+            current = upcoming
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def open_sample_stream(filename, settings, start=0, step=1):
+    """
+    Open a sample stream over filename. The samples compiled by corpus.py are
+    read instead of the json file when they are up to date.
+
+    :param filename: json(.gz) data file or compiled samples directory
+    :type filename: str
+    :param settings: reader settings
+    :type settings: Settings
+    :param start: q_idx of the first question read
+    :type start: int
+    :param step: only every step-th question from start is read
+    :type step: int
+    :return: an iterable of (q_idx, sample, type) tuples
+    """
+    import corpus
+    if corpus.is_compiled(filename):
+        if settings.keep_tokens:
+            raise ValueError("the tokens are not kept in compiled samples, "
+                             "read the json data file instead")
+        return corpus.CompiledSampleStream(filename, settings, start, step)
+
+    # the compiled samples do not keep the tokens
+    compiled = not settings.keep_tokens and \
+        corpus.find_compiled(filename, settings)
+    if compiled:
+        logger.info("reading compiled samples from %s", compiled)
+        return corpus.CompiledSampleStream(compiled, settings, start, step)
+    return SampleStream(filename, settings, start, step)
+
+
+def shard_random(seed, shard_id):
+    """
+    :return: the random generator of a shard, shards of the same seed draw
+        from far apart states
+    :rtype: random.Random
+    """
+    rng = random.Random(seed)
+    if shard_id > 0:
+        rng.jumpahead(shard_id)
+    return rng
+
+
+def restore_random(rng, state):
+    """
+    Set the state of a random.Random to one returned by getstate, which may
+    have been through json
+    """
+    version, internal, gauss = state
+    rng.setstate((version, tuple(internal), gauss))
 
 
 class DataReader(object):
+    def __init__(self, rng=None):
+        # training readers draw from their own random generator, test
+        # readers from the random module
+        self.random = rng or random
+
     def __iter__(self):
         return self
 
@@ -245,22 +454,40 @@ class DataReader(object):
         data_point = self._next()
         return self.post_process_sample(data_point)
 
-    def post_process_sample(self, sample):
-        ret = list(sample)
-
-        # choose eecom features randomly
-        eecom_feats = random.choice(sample[EE_COMM])
-        if not isinstance(eecom_feats[0], int):
+    def choose_eecom_feats(self, sample):
+        # choose eecom features randomly, see make_eecom_table
+        feats, offsets, positive_num, negative_num = sample[EE_COMM]
+        # int(random() * n) draws as random.choice does, randrange is slower
+        rand = self.random.random
+        k = int(rand() * (positive_num + (negative_num > 0)))
+        if k == positive_num:
             # the other evidence is a negative evidence
-            eecom_feats = random.choice(eecom_feats)
-        ret[EE_COMM] = eecom_feats
+            k += int(rand() * negative_num)
+        return feats[offsets[k]:offsets[k + 1]]
 
+    def post_process_sample(self, sample):
+        ret = list(sample)
+        ret[EE_COMM] = self.choose_eecom_feats(sample)
         return ret
 
 
 class TrainingDataReader(DataReader):
-    def __init__(self, sample_stream, negative_ratio, hit_ans_negative_ratio):
-        super(TrainingDataReader, self).__init__()
+    """
+    Draw training samples of one shard of the questions, with the random
+    generator of the shard
+    """
+
+    def __init__(self,
+                 sample_stream,
+                 negative_ratio,
+                 hit_ans_negative_ratio,
+                 seed=None,
+                 shard_id=0,
+                 num_shards=1):
+        super(TrainingDataReader, self).__init__(
+            shard_random(seed, shard_id))
+        self.shard_id = shard_id
+        self.num_shards = num_shards
         self.positive_data = []
         self.hit_ans_negative_data = []
         self.other_negative_data = []
@@ -272,10 +499,16 @@ class TrainingDataReader(DataReader):
         self.hit_idx = 0
         self.other_idx = 0
 
+        # the kept samples in the order they are loaded, the saved states
+        # refer to them by position
+        self.loaded = []
+
         self.load_samples(sample_stream)
 
     def add_data(self, positive, hit_negative, other_negative):
         if not positive: return
+        for samples in (positive, hit_negative, other_negative):
+            self.loaded.extend(samples)
         self.positive_data.extend(positive)
         for samples, target_list in \
                 zip((hit_negative, other_negative),
@@ -288,6 +521,7 @@ class TrainingDataReader(DataReader):
         logger.info("loading data...")
         last_q_id, positive, hit_negative, other_negative = None, [], [], []
         for q_id, sample, type_ in sample_stream:
+            if q_id % self.num_shards != self.shard_id: continue
             if not last_q_id and q_id != last_q_id:
                 self.add_data(positive, hit_negative, other_negative)
                 positive, hit_negative, other_negative = [], [], []
@@ -305,17 +539,86 @@ class TrainingDataReader(DataReader):
 
         # we are not sure whether the input data is shuffled or not
         # so we shuffle them
-        random.shuffle(self.positive_data)
-        random.shuffle(self.hit_ans_negative_data)
-        random.shuffle(self.other_negative_data)
+        self.random.shuffle(self.positive_data)
+        self.random.shuffle(self.hit_ans_negative_data)
+        self.random.shuffle(self.other_negative_data)
+
+        self.set_thresholds(
+            len(self.positive_data),
+            len(self.hit_ans_negative_data), len(self.other_negative_data))
+        logger.info("loaded")
+
+    def get_state(self):
+        """
+        :return: the state of the random generator, the order of the samples
+            and the positions in them, in json
+        :rtype: dict
+        """
+        state = self.get_order()
+        state["random"] = self.random.getstate()
+        state["positions"] = [self.p_idx, self.hit_idx, self.other_idx]
+        return state
+
+    def set_state(self, state):
+        """
+        Go on from a state returned by get_state, before any sample is drawn.
+        The samples are drawn as the reader which saved it would have drawn
+        them.
+        """
+        if not self.set_order(state):
+            logger.info("the samples of shard %d have changed, they are "
+                        "drawn from the start" % self.shard_id)
+            return
+        restore_random(self.random, state["random"])
+        self.p_idx, self.hit_idx, self.other_idx = state["positions"]
+
+    def get_order(self):
+        """
+        :return: the order of the positive samples and of the bundles of
+            negative samples, and the samples used in every bundle
+        :rtype: dict
+        """
+        index = dict((id(sample), i) for i, sample in enumerate(self.loaded))
+
+        def positions(samples):
+            return [index[id(sample)] for sample in samples]
+
+        return {
+            "num_samples": len(self.loaded),
+            "positive": positions(self.positive_data),
+            "hit_ans_negative": [[positions(samples), used]
+                                 for samples, used in
+                                 self.hit_ans_negative_data],
+            "other_negative": [[positions(samples), used]
+                               for samples, used in self.other_negative_data]
+        }
 
-        # set thresholds
-        if len(self.positive_data) == 0:
+    def set_order(self, state):
+        """
+        Restore the order saved by get_order
+
+        :return: False if the loaded samples are not the saved ones
+        :rtype: bool
+        """
+        if state["num_samples"] != len(self.loaded):
+            return False
+        loaded = self.loaded
+        self.positive_data = [loaded[i] for i in state["positive"]]
+        self.hit_ans_negative_data = [[[loaded[i] for i in samples], used]
+                                      for samples, used in
+                                      state["hit_ans_negative"]]
+        self.other_negative_data = [[[loaded[i] for i in samples], used]
+                                    for samples, used in
+                                    state["other_negative"]]
+        return True
+
+    def set_thresholds(self, positive_num, hit_num, other_num):
+        if positive_num == 0:
             logger.fatal("zero positive sample")
             raise ValueError("zero positive sample")
 
-        zero_hit = len(self.hit_ans_negative_data) == 0
-        zero_other = len(self.other_negative_data) == 0
+        zero_hit = hit_num == 0
+        zero_other = other_num == 0
 
         if zero_hit and zero_other:
             logger.fatal("zero negative sample")
@@ -332,11 +635,10 @@ class TrainingDataReader(DataReader):
         if zero_other:
             logger.warning("zero other_negative sample")
             self.hit_ans_neg_threshold = self.negative_ratio
-        logger.info("loaded")
 
     def next_positive_data(self):
         if self.p_idx >= len(self.positive_data):
-            random.shuffle(self.positive_data)
+            self.random.shuffle(self.positive_data)
             self.p_idx = 0
 
         self.p_idx += 1
@@ -344,7 +646,7 @@ class TrainingDataReader(DataReader):
 
     def _next_negative_data(self, idx, negative_data):
         if idx >= len(negative_data):
-            random.shuffle(negative_data)
+            self.random.shuffle(negative_data)
             idx = 0
 
         # a negative evidence is sampled in two steps: 
@@ -354,7 +656,7 @@ class TrainingDataReader(DataReader):
         # bundle -> (sample, idx)
         bundle = negative_data[idx]
         if bundle[1] >= len(bundle[0]):
-            random.shuffle(bundle[0])
+            self.random.shuffle(bundle[0])
             bundle[1] = 0
         bundle[1] += 1
         return idx + 1, bundle[0][bundle[1] - 1]
@@ -370,7 +672,7 @@ class TrainingDataReader(DataReader):
         return data
 
     def _next(self):
-        rand = random.random()
+        rand = self.random.random()
         if rand <= self.hit_ans_neg_threshold:
             return self.next_hit_ans_negative_data()
         elif rand < self.other_neg_threshold:
@@ -379,6 +681,391 @@ class TrainingDataReader(DataReader):
             return self.next_positive_data()
 
 
+class ArrayTrainingDataReader(TrainingDataReader):
+    """
+    A TrainingDataReader keeping the samples in the flat typed columns of
+    corpus.SampleColumns. Sampling works on sample indices, a sample is only
+    converted to lists when it is emitted.
+    """
+
+    def load_samples(self, sample_stream):
+        import corpus
+        logger.info("loading data...")
+        if isinstance(sample_stream, corpus.CompiledSampleStream):
+            # the memory-mapped columns are used as they are
+            self.samples = sample_stream.columns
+        else:
+            # only the questions of the shard are stored
+            builder = corpus.ColumnBuilder()
+            for q_id, sample, type_ in sample_stream:
+                if q_id % self.num_shards != self.shard_id: continue
+                builder.add(q_id, sample, type_)
+            self.samples = builder.build()
+
+        # the order of the indices is drawn from the random generator of
+        # the shard
+        self.rng = numpy.random.RandomState(
+            self.random.randint(0, 2**31 - 1))
+
+        q_ids = numpy.asarray(self.samples.columns["q_idx"])
+        types = numpy.asarray(self.samples.columns["type"])
+        codes = corpus.TYPE_CODES
+        in_shard = q_ids % self.num_shards == self.shard_id
+        # the samples are grouped as TrainingDataReader.load_samples groups
+        # them: it only starts a new group after the question of q_idx 0, so
+        # a shard has at most two groups, that question and all the others
+        groups = (q_ids != 0).astype("int64")
+        positive = in_shard & (types == codes[Evidence.POSITIVE])
+        # groups without positive evidences are skipped
+        used = in_shard & numpy.in1d(groups, groups[positive])
+
+        self.positive_data = numpy.flatnonzero(positive)
+        self.hit_ans_negative_data = self.make_bundles(
+            groups, used & (types == codes[Evidence.HIT_ANS_NEGATIVE]))
+        self.other_negative_data = self.make_bundles(
+            groups, used & (types == codes[Evidence.OTHER_NEGATIVE]))
+
+        self.rng.shuffle(self.positive_data)
+        self.rng.shuffle(self.hit_ans_negative_data[2])
+        self.rng.shuffle(self.other_negative_data[2])
+
+        self.set_thresholds(
+            len(self.positive_data),
+            len(self.hit_ans_negative_data[2]),
+            len(self.other_negative_data[2]))
+        logger.info("loaded")
+
+    def make_bundles(self, groups, mask):
+        """
+        Bundle the selected samples by group, the group ids do not decrease
+        in the order of the samples
+
+        :return: a bundle table [members, offsets, order, cursors], the
+            samples of bundle b are members[offsets[b]:offsets[b + 1]], order
+            is the order in which bundles are visited and cursors[b] is the
+            number of samples of bundle b already used
+        :rtype: list
+        """
+        members = numpy.flatnonzero(mask)
+        starts = numpy.flatnonzero(numpy.diff(groups[members])) + 1
+        offsets = numpy.concatenate(([0], starts, [len(members)])) \
+            if len(members) else numpy.zeros(1, dtype="int64")
+        bundle_num = len(offsets) - 1
+        return [members, offsets, numpy.arange(bundle_num),
+                numpy.zeros(bundle_num, dtype="int64")]
+
+    def get_order(self):
+        name, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        return {
+            "num_samples": len(self.samples),
+            "numpy_random":
+            [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+            "positive": self.positive_data.tolist(),
+            # the offsets of the bundles do not change
+            "hit_ans_negative": [
+                self.hit_ans_negative_data[i].tolist() for i in (0, 2, 3)
+            ],
+            "other_negative":
+            [self.other_negative_data[i].tolist() for i in (0, 2, 3)]
+        }
+
+    def set_order(self, state):
+        if state["num_samples"] != len(self.samples):
+            return False
+        name, keys, pos, has_gauss, cached_gaussian = state["numpy_random"]
+        self.rng.set_state((name, numpy.array(keys, dtype="uint32"), pos,
+                            has_gauss, cached_gaussian))
+        self.positive_data[:] = state["positive"]
+        for table, saved in ((self.hit_ans_negative_data,
+                              state["hit_ans_negative"]),
+                             (self.other_negative_data,
+                              state["other_negative"])):
+            for i, values in zip((0, 2, 3), saved):
+                table[i][:] = values
+        return True
+
+    def next_positive_data(self):
+        if self.p_idx >= len(self.positive_data):
+            self.rng.shuffle(self.positive_data)
+            self.p_idx = 0
+
+        self.p_idx += 1
+        return self.samples.sample(self.positive_data[self.p_idx - 1])
+
+    def _next_negative_data(self, idx, negative_data):
+        members, offsets, order, cursors = negative_data
+        if idx >= len(order):
+            self.rng.shuffle(order)
+            idx = 0
+
+        # the same two steps sampling as TrainingDataReader
+        bundle = order[idx]
+        start, end = offsets[bundle], offsets[bundle + 1]
+        if cursors[bundle] >= end - start:
+            self.rng.shuffle(members[start:end])
+            cursors[bundle] = 0
+        cursors[bundle] += 1
+        return idx + 1, self.samples.sample(
+            members[start + cursors[bundle] - 1])
+
+
+class StreamingTrainingDataReader(TrainingDataReader):
+    """
+    A TrainingDataReader which does not load the whole training set. Samples
+    are read question by question from the data shards into bounded shuffle
+    buffers, one for each evidence type, and drawn from them with the same
+    ratios. The shards are visited in a new random order in every round.
+    """
+
+    def __init__(self,
+                 filenames,
+                 settings,
+                 negative_ratio,
+                 hit_ans_negative_ratio,
+                 buffer_size,
+                 seed=None,
+                 shard_id=0,
+                 num_shards=1):
+        """
+        :param filenames: the data shards
+        :type filenames: list of str
+        :param settings: reader settings
+        :type settings: Settings
+        :param negative_ratio: the ratio of negative samples
+        :type negative_ratio: float
+        :param hit_ans_negative_ratio: the ratio of negative samples that
+            contain golden answer string
+        :type hit_ans_negative_ratio: float
+        :param buffer_size: maximum number of samples of each type in memory
+        :type buffer_size: int
+        :param seed: random seed
+        :type seed: int
+        :param shard_id: only the questions whose q_idx modulo num_shards is
+            shard_id are read
+        :type shard_id: int
+        :param num_shards: number of shards
+        :type num_shards: int
+        """
+        DataReader.__init__(self, shard_random(seed, shard_id))
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.filenames = list(filenames)
+        self.settings = settings
+        self.negative_ratio = negative_ratio
+        self.hit_ans_negative_ratio = hit_ans_negative_ratio
+        self.buffer_size = buffer_size
+
+        # positive samples, and bundles of negative samples by question
+        self.positive_data = []
+        self.hit_ans_negative_data = []
+        self.other_negative_data = []
+        self.sizes = {Evidence.HIT_ANS_NEGATIVE: 0, Evidence.OTHER_NEGATIVE: 0}
+
+        # evidence types not seen in a whole round over the shards
+        self.missing_types = set()
+        # the read position, the index of the data shard in the order of the
+        # round and the q_idx of its next question
+        self.file_idx = 0
+        self.next_q_idx = 0
+        # the number of samples of each type read in the current round, and
+        # whether the round was read from its start
+        self.counts = {}
+        self.whole_round = True
+        self.questions = self.read_questions()
+        self.set_thresholds(1, 1, 1)
+
+    def read_questions(self):
+        """
+        Read the shards forever, from the read position
+
+        :return: a generator of (positive, hit_negative, other_negative)
+            sample lists of one question, None at the end of every round
+        """
+        while True:
+            if self.file_idx == 0 and self.next_q_idx == 0:
+                # a new round
+                self.counts = dict.fromkeys(
+                    (Evidence.POSITIVE, Evidence.HIT_ANS_NEGATIVE,
+                     Evidence.OTHER_NEGATIVE), 0)
+                self.whole_round = True
+                self.random.shuffle(self.filenames)
+            while self.file_idx < len(self.filenames):
+                last_q_id, samples = None, []
+                for q_id, sample, type_ in open_sample_stream(
+                        self.filenames[self.file_idx], self.settings,
+                        self.next_q_idx):
+                    if q_id % self.num_shards != self.shard_id: continue
+                    if last_q_id is not None and q_id != last_q_id:
+                        self.next_q_idx = last_q_id + 1
+                        yield self.split_question(samples, self.counts)
+                        samples = []
+                    last_q_id = q_id
+                    samples.append((sample, type_))
+                if samples:
+                    self.next_q_idx = last_q_id + 1
+                    yield self.split_question(samples, self.counts)
+                self.file_idx += 1
+                self.next_q_idx = 0
+            self.file_idx = 0
+            if self.whole_round:
+                self.missing_types = set(
+                    t for t, c in self.counts.iteritems() if c == 0)
+            yield None
+
+    def get_state(self):
+        """
+        :return: the state of the random generator, the read position and the
+            samples in the shuffle buffers, in json
+        :rtype: dict
+        """
+        return {
+            "random": self.random.getstate(),
+            "filenames": list(self.filenames),
+            "file_idx": self.file_idx,
+            "next_q_idx": self.next_q_idx,
+            "counts": dict(self.counts),
+            "whole_round": self.whole_round,
+            "missing_types": sorted(self.missing_types),
+            "positive": list(self.positive_data),
+            "hit_ans_negative": [list(b) for b in self.hit_ans_negative_data],
+            "other_negative": [list(b) for b in self.other_negative_data]
+        }
+
+    def set_state(self, state):
+        """
+        Go on from a state returned by get_state, before any sample is drawn.
+        The lines before the read position are not parsed again, the samples
+        are drawn as the reader which saved it would have drawn them.
+        """
+        if sorted(state["filenames"]) != sorted(self.filenames):
+            logger.info("the data shards have changed, the samples are drawn "
+                        "from the start")
+            return
+        restore_random(self.random, state["random"])
+        self.filenames = list(state["filenames"])
+        self.file_idx = state["file_idx"]
+        self.next_q_idx = state["next_q_idx"]
+        self.counts = state["counts"]
+        self.whole_round = state["whole_round"]
+        self.missing_types = set(state["missing_types"])
+        self.positive_data = state["positive"]
+        self.hit_ans_negative_data = state["hit_ans_negative"]
+        self.other_negative_data = state["other_negative"]
+        for type_, bundles in ((Evidence.HIT_ANS_NEGATIVE,
+                                self.hit_ans_negative_data),
+                               (Evidence.OTHER_NEGATIVE,
+                                self.other_negative_data)):
+            self.sizes[type_] = sum(len(bundle) for bundle in bundles)
+        self.update_thresholds()
+
+    def split_question(self, samples, counts):
+        ret = {
+            Evidence.POSITIVE: [],
+            Evidence.HIT_ANS_NEGATIVE: [],
+            Evidence.OTHER_NEGATIVE: []
+        }
+        for sample, type_ in samples:
+            if type_ not in ret:
+                raise ValueError("wrong type: %s" % str(type_))
+            ret[type_].append(sample)
+        # questions without positive evidences are skipped
+        if not ret[Evidence.POSITIVE]:
+            return [], [], []
+        for type_, type_samples in ret.iteritems():
+            counts[type_] += len(type_samples)
+        return (ret[Evidence.POSITIVE], ret[Evidence.HIT_ANS_NEGATIVE],
+                ret[Evidence.OTHER_NEGATIVE])
+
+    def add_data(self, positive, hit_negative, other_negative):
+        for sample in positive:
+            if len(self.positive_data) < self.buffer_size:
+                self.positive_data.append(sample)
+            else:
+                # the buffer is full, a random sample is replaced
+                self.positive_data[self.random.randrange(
+                    self.buffer_size)] = sample
+
+        for samples, type_, bundles in \
+                ((hit_negative, Evidence.HIT_ANS_NEGATIVE,
+                  self.hit_ans_negative_data),
+                 (other_negative, Evidence.OTHER_NEGATIVE,
+                  self.other_negative_data)):
+            if not samples: continue
+            bundles.append(list(samples))
+            self.sizes[type_] += len(samples)
+            while self.sizes[type_] > self.buffer_size:
+                self.pop_negative_data(type_, bundles)
+
+    def pop_negative_data(self, type_, bundles):
+        """
+        Remove a random negative sample, the question is chosen first
+        """
+        b = self.random.randrange(len(bundles))
+        bundle = bundles[b]
+        i = self.random.randrange(len(bundle))
+        sample = bundle[i]
+        bundle[i] = bundle[-1]
+        bundle.pop()
+        if not bundle:
+            bundles[b] = bundles[-1]
+            bundles.pop()
+        self.sizes[type_] -= 1
+        return sample
+
+    def fill(self, type_, size):
+        """
+        Read questions until the buffer of type_ holds more than half of its
+        capacity, or a whole round is read
+        """
+        low_watermark = self.buffer_size // 2 + 1
+        for question in self.questions:
+            if question is None:
+                self.update_thresholds()
+                if size() > 0 or type_ in self.missing_types:
+                    return
+                continue
+            self.add_data(*question)
+            if size() >= low_watermark:
+                return
+
+    def update_thresholds(self):
+        if Evidence.POSITIVE in self.missing_types:
+            logger.fatal("zero positive sample")
+            raise ValueError("zero positive sample")
+        self.set_thresholds(1, int(Evidence.HIT_ANS_NEGATIVE not in
+                                   self.missing_types),
+                            int(Evidence.OTHER_NEGATIVE not in
+                                self.missing_types))
+
+    def next_positive_data(self):
+        size = lambda: len(self.positive_data)
+        if size() <= self.buffer_size // 2:
+            self.fill(Evidence.POSITIVE, size)
+        data = self.positive_data
+        i = self.random.randrange(len(data))
+        sample = data[i]
+        data[i] = data[-1]
+        data.pop()
+        return sample
+
+    def next_negative_data(self, type_, bundles):
+        size = lambda: self.sizes[type_]
+        if size() <= self.buffer_size // 2:
+            self.fill(type_, size)
+        if not bundles:
+            # the type is missing in the data, the thresholds are updated
+            return self._next()
+        return self.pop_negative_data(type_, bundles)
+
+    def next_hit_ans_negative_data(self):
+        return self.next_negative_data(Evidence.HIT_ANS_NEGATIVE,
+                                       self.hit_ans_negative_data)
+
+    def next_other_negative_data(self):
+        return self.next_negative_data(Evidence.OTHER_NEGATIVE,
+                                       self.other_negative_data)
+
+
 class TestDataReader(DataReader):
     def __init__(self, sample_stream):
         super(TestDataReader, self).__init__()
@@ -386,24 +1073,111 @@ class TestDataReader(DataReader):
 
     def _next(self):
         q_idx, sample, type_ = self.data_generator.next()
-        return sample
+        return sample, q_idx
 
+    def next(self):
+        sample, q_idx = self._next()
+        ret = self.post_process_sample(sample)
+        ret.insert(Q_IDX, q_idx)
+        return ret
 
-def create_reader(filename, settings, samples_per_pass=sys.maxint):
-    if settings.is_training:
-        training_reader = TrainingDataReader(
-            SampleStream(filename, settings), settings.negative_sample_ratio,
-            settings.hit_ans_negative_sample_ratio)
-
-        def wrapper():
-            for i, data in izip(xrange(samples_per_pass), training_reader):
-                yield data
 
-        return wrapper
+def create_reader(filename,
+                  settings,
+                  samples_per_pass=sys.maxint,
+                  shard_id=0,
+                  num_shards=1,
+                  state=None):
+    """
+    Create a sample reader
+
+    :param filename: json(.gz) data file or compiled samples directory, a
+        glob pattern of data shards for the streaming training reader
+    :type filename: str
+    :param settings: reader settings
+    :type settings: Settings
+    :param samples_per_pass: number of training samples of a pass
+    :type samples_per_pass: int
+    :param shard_id: only the questions whose q_idx modulo num_shards is
+        shard_id are read, a test reader does not parse the other lines
+    :type shard_id: int
+    :param num_shards: number of shards of the training data
+    :type num_shards: int
+    :param state: the state of the training reader of the shard, see
+        TrainingDataReader.get_state: the reader goes on from it if it is not
+        empty, and it is updated at the end of every pass
+    :type state: dict
+    :return: a function returning an iterable of samples
+    :rtype: callable
+    """
+    if settings.is_training and settings.shuffle_buffer_size > 0:
+        # filename may be a glob pattern of data shards
+        filenames = sorted(glob.glob(filename)) or [filename]
+        training_reader = StreamingTrainingDataReader(
+            filenames, settings, settings.negative_sample_ratio,
+            settings.hit_ans_negative_sample_ratio,
+            settings.shuffle_buffer_size, settings.seed, shard_id, num_shards)
+    elif settings.is_training:
+        if settings.sample_storage == "array":
+            reader_cls = ArrayTrainingDataReader
+        else:
+            reader_cls = TrainingDataReader
+        training_reader = reader_cls(
+            open_sample_stream(filename, settings),
+            settings.negative_sample_ratio,
+            settings.hit_ans_negative_sample_ratio, settings.seed, shard_id,
+            num_shards)
     else:
 
         def wrapper():
-            sample_stream = SampleStream(filename, settings)
+            sample_stream = open_sample_stream(filename, settings, shard_id,
+                                               num_shards)
             return TestDataReader(sample_stream)
 
-        return wrapper
\ No newline at end of file
+        return wrapper
+
+    if state:
+        logger.info("restoring the state of the reader of shard %d",
+                    shard_id)
+        training_reader.set_state(state)
+
+    def wrapper():
+        for i, data in izip(xrange(samples_per_pass), training_reader):
+            yield data
+        if state is not None:
+            state.clear()
+            state.update(training_reader.get_state())
+
+    return wrapper
+
+
+def check_resume(filename,
+                 settings,
+                 samples_per_pass,
+                 shard_id=0,
+                 num_shards=1,
+                 num_passes=2):
+    """
+    Check that a training job killed at the end of any pass and resumed from
+    the state saved with its checkpoint draws the samples of a job which is
+    not interrupted
+
+    :param num_passes: number of passes compared
+    :type num_passes: int
+    :return: True if every pass of the resumed jobs draws the same samples
+    :rtype: bool
+    """
+    uninterrupted = create_reader(filename, settings, samples_per_pass,
+                                  shard_id, num_shards)
+    state = {}
+    for pass_id in xrange(num_passes):
+        expected = list(uninterrupted())
+        # the state goes through json as in a checkpoint
+        state = json.loads(json.dumps(state))
+        resumed = create_reader(filename, settings, samples_per_pass,
+                                shard_id, num_shards, state)
+        if list(resumed()) != expected:
+            logger.error("shard %d: pass %d of the resumed job draws other "
+                         "samples" % (shard_id, pass_id))
+            return False
+    return True
@@ -0,0 +1,277 @@
+"""
+A long-running inference server.
+
+The network and the trained parameters are loaded once. Requests are
+accepted concurrently over local HTTP or a Unix socket and coalesced into
+micro-batches: a batch is run as soon as it holds conf.batch_size evidences
+or its first request has waited conf.max_batch_latency seconds.
+
+Request (POST, json):
+    {"question": [token, ...], "evidences": [[token, ...], ...]}
+    tokens may also be given as a space separated string
+Response (json):
+    {"tags": [[tag, ...], ...]}, the tags of each evidence
+
+Results are cached by the content of the samples, see cache.py. GET /stats
+returns the hit and miss counters of the cache.
+
+Usage:
+    python server.py models/params_pass_00024.tar.gz --port 8080
+    python server.py models/params_pass_00024.tar.gz --engine numpy
+"""
+import argparse
+import BaseHTTPServer
+import json
+import os
+import Queue
+import SocketServer
+import threading
+import time
+import traceback
+
+import cache
+import utils
+from utils import logger
+
+__all__ = ["MicroBatcher", "create_server"]
+
+
+class _Request(object):
+    def __init__(self, samples):
+        self.samples = samples
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Coalesce concurrent requests into batches run by a single thread
+    """
+
+    def __init__(self, infer_batch, max_batch_size, max_latency):
+        """
+        :param infer_batch: a function mapping a list of samples to a list of
+            results, one per sample
+        :type infer_batch: callable
+        :param max_batch_size: maximum number of samples in a batch, a larger
+            request is run alone
+        :type max_batch_size: int
+        :param max_latency: maximum time in seconds a request waits for other
+            requests
+        :type max_latency: float
+        """
+        self.infer_batch = infer_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = Queue.Queue()
+
+    def submit(self, samples):
+        """
+        Run samples in the next batch, called by the request threads
+
+        :return: one result per sample
+        :rtype: list
+        """
+        request = _Request(samples)
+        self.requests.put(request)
+        # a timeout keeps the waiting thread interruptible
+        while not request.done.wait(1.0):
+            pass
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self):
+        requests = [self.requests.get()]
+        size = len(requests[0].samples)
+        deadline = time.time() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0: break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            requests.append(request)
+            size += len(request.samples)
+        return requests
+
+    def run(self):
+        """
+        Run the batches forever, in the thread owning the model
+        """
+        while True:
+            requests = self.next_batch()
+            samples = [s for request in requests for s in request.samples]
+            try:
+                results = self.infer_batch(samples)
+                start = 0
+                for request in requests:
+                    end = start + len(request.samples)
+                    request.result = results[start:end]
+                    start = end
+            except Exception as ex:
+                traceback.print_exc()
+                for request in requests:
+                    request.error = ex
+            for request in requests:
+                request.done.set()
+
+
+def _tokens(value):
+    if isinstance(value, basestring):
+        value = value.split()
+    return [t.encode("utf-8") if isinstance(t, unicode) else t for t in value]
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader("content-length", 0))
+            request = json.loads(self.rfile.read(length))
+            question = _tokens(request["question"])
+            evidences = [_tokens(e) for e in request["evidences"]]
+        except Exception as ex:
+            self.reply(400, {"error": "bad request: %s" % ex})
+            return
+
+        try:
+            samples = self.server.application.make_batch(question, evidences)
+            batcher = self.server.batcher
+            tags = self.server.cache.infer(samples, batcher.submit) \
+                if samples else []
+        except Exception as ex:
+            self.reply(500, {"error": str(ex)})
+            return
+        tags = [[int(t) for t in e_tags] for e_tags in tags]
+        self.reply(200, {"tags": tags})
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.reply(404, {"error": "not found"})
+            return
+        result_cache = self.server.cache
+        self.reply(200, {
+            "hits": result_cache.hits,
+            "misses": result_cache.misses,
+            "size": len(result_cache)
+        })
+
+    def reply(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client addresses of Unix sockets are not (host, port) pairs
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def log_message(self, format, *args):
+        logger.info("%s %s" % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                              SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(application,
+                  batcher,
+                  result_cache,
+                  host="127.0.0.1",
+                  port=8080,
+                  unix_socket=None):
+    """
+    Create a threading HTTP server handing requests to batcher
+
+    :param application: a loaded Application
+    :param batcher: the batcher running application.infer_batch
+    :type batcher: MicroBatcher
+    :param result_cache: the cache of the results of application
+    :type result_cache: cache.ResultCache
+    :param unix_socket: listen on this Unix socket instead of host:port
+    :type unix_socket: str
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    # used by RequestHandler
+    server.application = application
+    server.batcher = batcher
+    server.cache = result_cache
+    return server
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path")
+    parser.add_argument(
+        "--network", choices=["bilstm_crf", "mlstm_crf"], default="bilstm_crf")
+    parser.add_argument(
+        "--engine",
+        choices=["paddle", "numpy"],
+        default="paddle",
+        help="numpy runs bilstm_crf without paddle")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix_socket", help="listen on a Unix socket")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.engine == "numpy":
+        if args.network != "bilstm_crf":
+            raise ValueError("the numpy engine only runs bilstm_crf")
+        import config
+        import numpy_infer as application_module
+    elif args.network == "mlstm_crf":
+        from mLSTM_crf import mLSTM_crf_application as application_module
+        from mLSTM_crf import mLSTM_crf_config as config
+    else:
+        import application as application_module
+        import config
+    conf = config.InferConfig()
+    if args.engine == "numpy":
+        application_module.load_vocab(conf)
+    else:
+        conf.vocab = utils.load_dict(conf.word_dict_path,
+                                     conf.wordvecs_bin_path)
+
+    application = application_module.Application(conf)
+    application.load(args.model_path)
+    batcher = MicroBatcher(application.infer_batch, conf.batch_size,
+                           conf.max_batch_latency)
+    result_cache = cache.ResultCache(conf.result_cache_size,
+                                     conf.result_cache_ttl,
+                                     conf.result_cache_path)
+    result_cache.bind(args.model_path)
+    result_cache.load()
+    server = create_server(application, batcher, result_cache, args.host,
+                           args.port, args.unix_socket)
+
+    # the model is only used by the batcher in the main thread
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        batcher.run()
+    finally:
+        result_cache.save()
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
@@ -0,0 +1,209 @@
+"""
+Sharded multi-process inference.
+
+The questions of the data file are dealt out to the shards line by line,
+shard i takes the lines whose index modulo the number of shards is i. Each
+shard is tagged by its own process with its own paddle runtime or numpy
+engine, which reads the data file itself and only parses its own lines, so
+the file is neither counted nor copied beforehand. The outputs of the shards
+keep the q_idx of every question and are merged in the order of the data
+file. The merged output has the format of infer.py, and the same content
+except where a test sample draws its e-e.comm features at random.
+
+Usage:
+    python shard_infer.py model_path data_path output --num_shards 8
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from collections import OrderedDict
+
+import answer
+import tagfile
+import utils
+from utils import logger
+
+__all__ = ["merge_outputs", "run_shards"]
+
+
+def _read_records(f, shard_id):
+    for line in f:
+        record = json.loads(line, object_pairs_hook=OrderedDict)
+        yield record["q_idx"], shard_id, record
+
+
+def _read_tags(f, shard_id):
+    for q_idx, tags in tagfile.read_tags(f):
+        yield q_idx, shard_id, tags
+
+
+def merge_outputs(shard_outputs, output, answers=False, binary=False):
+    """
+    Merge the outputs of the shards in the order of their q_idx
+
+    :param shard_outputs: the paths of the outputs of the shards, tag files
+        unless they are answer records
+    :type shard_outputs: list
+    :param output: the merged output
+    :type output: file
+    :param answers: the outputs are answer records
+    :type answers: bool
+    :param binary: write a tag file instead of the text of infer.py
+    :type binary: bool
+    """
+    files = [open(path, "rb") for path in shard_outputs]
+    try:
+        # the shards never share a question, the shard id breaks no tie
+        read = _read_records if answers else _read_tags
+        merged = heapq.merge(
+            *[read(f, shard_id) for shard_id, f in enumerate(files)])
+        if answers:
+            answer.write_records((record for _, _, record in merged), output)
+        else:
+            tagfile.write(((q_idx, tags) for q_idx, _, tags in merged),
+                          output, binary)
+    finally:
+        for f in files:
+            f.close()
+
+
+def create_infer(engine, network, shard_id=0, num_shards=1):
+    """
+    Create the Infer object of an engine, in the calling process, which only
+    tags the questions of a shard
+    """
+    if engine == "numpy":
+        if network != "bilstm_crf":
+            raise ValueError("the numpy engine only runs bilstm_crf")
+        import config
+        import numpy_infer
+        conf = config.InferConfig()
+        conf.shard_id, conf.num_shards = shard_id, num_shards
+        numpy_infer.load_vocab(conf)
+        return numpy_infer.Infer(conf)
+
+    if network == "mlstm_crf":
+        from mLSTM_crf import mLSTM_crf_config as config
+        from mLSTM_crf import mLSTM_crf_infer as infer_module
+    else:
+        import config
+        import infer as infer_module
+    conf = config.InferConfig()
+    conf.shard_id, conf.num_shards = shard_id, num_shards
+    conf.vocab = utils.load_dict(conf.word_dict_path, conf.wordvecs_bin_path)
+    return infer_module.Infer(conf)
+
+
+def _infer_shard(engine, network, model_path, data_path, shard_id,
+                 num_shards, output_path, answers):
+    try:
+        infer = create_infer(engine, network, shard_id, num_shards)
+        with open(output_path, "wb") as output:
+            if answers:
+                infer.infer_answers(model_path, data_path, output)
+            else:
+                # the tag files keep the q_idx the outputs are merged by
+                infer.infer(model_path, data_path, output, binary=True)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def run_shards(model_path,
+               data_path,
+               output,
+               num_shards,
+               engine="paddle",
+               network="bilstm_crf",
+               answers=False,
+               binary=False,
+               tmp_dir=None):
+    """
+    Tag a data file with num_shards processes
+
+    :param output: the merged output
+    :type output: file
+    :param engine: paddle or numpy
+    :type engine: str
+    :param network: bilstm_crf or mlstm_crf
+    :type network: str
+    :param answers: write answer records instead of tags, see answer.py
+    :type answers: bool
+    :param binary: write a tag file, see tagfile.py
+    :type binary: bool
+    :param tmp_dir: directory of the outputs of the shards, a temporary one
+        if None
+    :type tmp_dir: str
+    """
+    shard_dir = tempfile.mkdtemp(prefix="shard_infer_", dir=tmp_dir)
+    try:
+        logger.info("%d shards in %s" % (num_shards, shard_dir))
+        workers, shard_outputs = [], []
+        for shard_id in xrange(num_shards):
+            output_path = os.path.join(shard_dir, "shard_%05d.out" % shard_id)
+            worker = multiprocessing.Process(
+                target=_infer_shard,
+                args=(engine, network, model_path, data_path, shard_id,
+                      num_shards, output_path, answers))
+            worker.start()
+            workers.append(worker)
+            shard_outputs.append(output_path)
+
+        failed = []
+        for shard_id, worker in enumerate(workers):
+            worker.join()
+            if worker.exitcode != 0:
+                failed.append(str(shard_id))
+        if failed:
+            raise RuntimeError("failed shards: %s" % ", ".join(failed))
+
+        merge_outputs(shard_outputs, output, answers, binary)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path")
+    parser.add_argument("data_path")
+    parser.add_argument("output", help="'-' for stdout")
+    parser.add_argument(
+        "--num_shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument(
+        "--engine", choices=["paddle", "numpy"], default="paddle")
+    parser.add_argument(
+        "--network", choices=["bilstm_crf", "mlstm_crf"], default="bilstm_crf")
+    parser.add_argument(
+        "--answers",
+        action="store_true",
+        help="write the voted answer of every question instead of the tags")
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write the tags to a binary tag file, see tagfile.py")
+    parser.add_argument(
+        "--tmp_dir", help="directory of the outputs of the shards")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = utils.open_file(args.output, "w")
+
+    run_shards(args.model_path, args.data_path, output, args.num_shards,
+               args.engine, args.network, args.answers, args.binary,
+               args.tmp_dir)
+
+    output.close()
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
@@ -0,0 +1,168 @@
+"""
+Binary inference results.
+
+A tag file is a header followed by blocks of evidences, all little endian:
+    header: "QATAGS\0\0", version (uint32)
+    block:  number of evidences n and of tags m (uint32 each),
+            q_idx of each evidence (int32 x n),
+            number of tags of each evidence (uint32 x n),
+            tags (uint8 x m)
+Blocks are written as results arrive, so a file is read back block by block
+with numpy.frombuffer instead of parsing text.
+
+Usage, to convert a tag file to the text written by infer.py:
+    python tagfile.py results.tags results.txt.gz
+"""
+import argparse
+import struct
+import sys
+
+import numpy
+
+import utils
+
+__all__ = ["TagWriter", "read_blocks", "read_tags", "write", "to_text"]
+
+MAGIC = "QATAGS\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sI")
+BLOCK_HEADER = struct.Struct("<II")
+
+
+class TagWriter(object):
+    """
+    Write (q_idx, tags) of evidences to a tag file
+    """
+
+    def __init__(self, f, block_size=4096):
+        """
+        :param f: a binary file
+        :type f: file
+        :param block_size: number of evidences of a block
+        :type block_size: int
+        """
+        self.f = f
+        self.block_size = block_size
+        self.q_indices = []
+        self.tags = []
+        self.f.write(HEADER.pack(MAGIC, VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def write(self, q_idx, tags):
+        self.q_indices.append(q_idx)
+        self.tags.append(tags)
+        if len(self.tags) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.tags: return
+        lengths = numpy.array([len(t) for t in self.tags], dtype="<u4")
+        tag_num = int(lengths.sum())
+        tags = numpy.concatenate([numpy.asarray(t) for t in self.tags]) \
+            if tag_num else numpy.zeros(0)
+        self.f.write(BLOCK_HEADER.pack(len(lengths), tag_num))
+        self.f.write(numpy.array(self.q_indices, dtype="<i4").tostring())
+        self.f.write(lengths.tostring())
+        self.f.write(tags.astype("u1").tostring())
+        self.q_indices = []
+        self.tags = []
+
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated tag file")
+    return data
+
+
+def read_blocks(f):
+    """
+    Read a tag file block by block
+
+    :param f: a binary file opened for reading
+    :type f: file
+    :return: a generator of (q_idx of each evidence, tag offsets of each
+        evidence and the end, tags) of each block
+    """
+    magic, version = HEADER.unpack(_read(f, HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a tag file of version %d" % VERSION)
+    while True:
+        header = f.read(BLOCK_HEADER.size)
+        if not header: return
+        if len(header) != BLOCK_HEADER.size:
+            raise ValueError("truncated tag file")
+        n, m = BLOCK_HEADER.unpack(header)
+        q_indices = numpy.frombuffer(_read(f, 4 * n), dtype="<i4")
+        lengths = numpy.frombuffer(_read(f, 4 * n), dtype="<u4")
+        tags = numpy.frombuffer(_read(f, m), dtype="u1")
+        offsets = numpy.zeros(n + 1, dtype="int64")
+        numpy.cumsum(lengths, out=offsets[1:])
+        yield q_indices, offsets, tags
+
+
+def read_tags(f):
+    """
+    :return: a generator of (q_idx, tags) of each evidence of a tag file
+    """
+    for q_indices, offsets, tags in read_blocks(f):
+        for i, q_idx in enumerate(q_indices.tolist()):
+            yield q_idx, tags[offsets[i]:offsets[i + 1]]
+
+
+def write(results, output, binary=False):
+    """
+    Write inference results
+
+    :param results: (q_idx, tags) of each evidence
+    :param output: the output file
+    :type output: file
+    :param binary: write a tag file instead of the text of infer.py
+    :type binary: bool
+    """
+    if binary:
+        with TagWriter(output) as writer:
+            for q_idx, tags in results:
+                writer.write(q_idx, tags)
+    else:
+        for q_idx, tags in results:
+            print >> output, ";\n".join(str(tag) for tag in tags) + ";"
+
+
+def to_text(f, output):
+    """
+    Convert a tag file to the text written by infer.py
+    """
+    for q_indices, offsets, tags in read_blocks(f):
+        lines = numpy.char.add(tags.astype("S3"), ";").tolist()
+        for i in xrange(len(q_indices)):
+            evidence = lines[offsets[i]:offsets[i + 1]]
+            print >> output, "\n".join(evidence) if evidence else ";"
+
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="tag file")
+    parser.add_argument("output", help="'-' for stdout")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = utils.open_file(args.output, "w")
+
+    with utils.open_file(args.input, "rb") as f:
+        to_text(f, output)
+
+    output.close()
+
+
+if __name__ == "__main__":
+    main(parse_cmd())
@@ -0,0 +1,158 @@
+"""
+Timing and throughput of the training.
+
+The batch reader is wrapped to time how long the trainer waits for every
+batch, which covers reading, featurizing, paddle.reader.buffered and
+batching. The time from BeginIteration to EndIteration is the compute time
+of the batch, feeding and forward/backward. The rest of the time between two
+EndIteration events, mostly the event handler, is the other time. The
+metrics of every batch are written as json lines to a rotating file:
+
+    {"event": "batch", "pass_id": 0, "batch_id": 99, "cost": ...,
+     "samples": 120, "tokens": ..., "evidence_tokens": ...,
+     "reader_wait": ..., "compute": ..., "other": ..., "time": ...,
+     "samples_per_sec": ..., "tokens_per_sec": ...}
+
+and a summary of every pass is logged and written as a "pass" record.
+"""
+import json
+import logging
+import logging.handlers
+import time
+
+import reader
+from utils import logger
+
+__all__ = ["ThroughputMeter"]
+
+# the numbers summed over a pass
+_TOTALS = ("samples", "tokens", "evidence_tokens", "reader_wait", "compute",
+           "other", "time")
+
+
+class ThroughputMeter(object):
+    """
+    Usage:
+        meter = ThroughputMeter(path)
+        train_reader = meter.reader(train_reader)
+        in the event handler:
+            BeginIteration: meter.begin_iteration()
+            EndIteration:   meter.end_iteration(pass_id, batch_id, cost)
+            EndPass:        meter.end_pass(pass_id)
+    """
+
+    def __init__(self, path="", max_bytes=0, backups=0):
+        """
+        :param path: json lines file of the metrics, "" not to write them
+        :type path: str
+        :param max_bytes: the file is rotated when it reaches this size, 0
+            never to rotate it
+        :type max_bytes: int
+        :param backups: number of rotated files kept
+        :type backups: int
+        """
+        self.handler = None
+        if path:
+            self.handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups)
+        self.batch = None
+        self.begin_time = self.last_time = self.pass_start = time.time()
+        self.totals = dict.fromkeys(_TOTALS, 0)
+        self.batch_num = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.handler is not None:
+            self.handler.close()
+
+    def write(self, record):
+        if self.handler is not None:
+            self.handler.handle(
+                logging.makeLogRecord({"msg": json.dumps(record)}))
+
+    def reader(self, reader_creator):
+        """
+        Time the batches of a batch reader
+        """
+
+        def timed_reader():
+            self.last_time = self.pass_start = time.time()
+            batches = iter(reader_creator())
+            while True:
+                start = time.time()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    return
+                evidence_tokens = sum(len(s[reader.E_IDS]) for s in batch)
+                self.batch = {
+                    "samples": len(batch),
+                    "tokens": evidence_tokens + sum(
+                        len(s[reader.Q_IDS]) for s in batch),
+                    "evidence_tokens": evidence_tokens,
+                    "reader_wait": time.time() - start
+                }
+                yield batch
+
+        return timed_reader
+
+    def begin_iteration(self):
+        self.begin_time = time.time()
+
+    def end_iteration(self, pass_id, batch_id, cost):
+        now = time.time()
+        record = self.batch
+        record["compute"] = now - self.begin_time
+        record["time"] = now - self.last_time
+        record["other"] = max(
+            record["time"] - record["compute"] - record["reader_wait"], 0.)
+        self.last_time = now
+
+        for key in _TOTALS:
+            self.totals[key] += record[key]
+        self.batch_num += 1
+
+        record.update(_rates(record))
+        record.update(
+            event="batch", pass_id=pass_id, batch_id=batch_id, cost=cost)
+        self.write(record)
+
+    def end_pass(self, pass_id):
+        """
+        Log and write the summary of a pass
+        """
+        record = dict(self.totals)
+        record.update(_rates(record))
+        record.update(
+            event="pass",
+            pass_id=pass_id,
+            batches=self.batch_num,
+            pass_time=time.time() - self.pass_start)
+        self.write(record)
+
+        busy = max(record["time"], 1e-6)
+        logger.info(
+            ("Pass=%d batches=%d samples=%d evidence_tokens=%d "
+             "samples/sec=%.1f tokens/sec=%.1f reader_wait=%.1f%% "
+             "compute=%.1f%% other=%.1f%% pass_time=%.1fs") %
+            (pass_id, self.batch_num, record["samples"],
+             record["evidence_tokens"], record["samples_per_sec"],
+             record["tokens_per_sec"], 100 * record["reader_wait"] / busy,
+             100 * record["compute"] / busy, 100 * record["other"] / busy,
+             record["pass_time"]))
+
+        self.totals = dict.fromkeys(_TOTALS, 0)
+        self.batch_num = 0
+
+
+def _rates(record):
+    seconds = max(record["time"], 1e-6)
+    return {
+        "samples_per_sec": record["samples"] / seconds,
+        "tokens_per_sec": record["tokens"] / seconds
+    }
@@ -1,23 +1,22 @@
+import argparse
+import logging
 import sys
 import os
-import numpy as np
 
 import paddle.v2 as paddle
 
+import batching
+import checkpoint
+import loader
+import param_stats
 import reader
+import throughput
 import utils
 import network
 import config
 from utils import logger
 
 
-def save_model(trainer, model_save_dir, parameters, pass_id):
-    f = os.path.join(model_save_dir, "params_pass_%05d.tar.gz" % pass_id)
-    logger.info("model saved to %s" % f)
-    with utils.open_file(f, "w") as f:
-        trainer.save_parameter_to_tar(f)
-
-
 def show_parameter_init_info(parameters):
     """
     Print the information of initialization mean and standard deviation of parameters
@@ -35,42 +34,137 @@ def show_parameter_init_info(parameters):
     logger.info("\n")
 
 
-def show_parameter_status(parameters):
+def create_settings(conf):
     """
-    Print some statistical information of parameters in a network
+    :return: the settings of the training reader
+    :rtype: reader.Settings
+    """
+    # the loader workers are daemonic processes which can not start parsing
+    # processes, they parse the data in their own thread
+    num_reader_workers = 1 if conf.loader_workers > 0 else \
+        conf.num_reader_workers
+    return reader.Settings(
+        vocab=conf.vocab,
+        is_training=True,
+        label_schema=conf.label_schema,
+        negative_sample_ratio=conf.negative_sample_ratio,
+        hit_ans_negative_sample_ratio=conf.hit_ans_negative_sample_ratio,
+        keep_first_b=conf.keep_first_b,
+        seed=conf.seed,
+        num_workers=num_reader_workers,
+        sample_storage=conf.sample_storage,
+        shuffle_buffer_size=conf.shuffle_buffer_size)
 
-    :param parameters: the parameters created in a model
+
+def check_resume(conf):
     """
-    for p in parameters:
-        abs_val = np.abs(parameters.get(p))
-        abs_grad = np.abs(parameters.get_grad(p))
+    Check that the samples of every shard of the trainer are drawn as if the
+    training was not interrupted when it is resumed from a checkpoint
 
-        logger.info(
-            ("%-25s avg_abs_val=%-10.6f max_val=%-10.6f avg_abs_grad=%-10.6f "
-             "max_grad=%-10.6f min_val=%-10.6f min_grad=%-10.6f") %
-            (p, abs_val.mean(), abs_val.max(), abs_grad.mean(), abs_grad.max(),
-             abs_val.min(), abs_grad.min()))
+    :return: True if the samples are the same
+    :rtype: bool
+    """
+    settings = create_settings(conf)
+    samples_per_pass = conf.batch_size * conf.batches_per_pass
+    workers_num = max(conf.loader_workers, 1)
+    num_shards = conf.num_trainers * workers_num
+    same = True
+    for worker_id in xrange(workers_num):
+        shard_id = conf.trainer_id * workers_num + worker_id
+        shard_same = reader.check_resume(
+            conf.train_data_path, settings, samples_per_pass // workers_num,
+            shard_id, num_shards)
+        logger.info("shard %d: the samples of the resumed training are %s" %
+                    (shard_id, "the same" if shard_same else "different"))
+        same = same and shard_same
+    return same
 
 
-def train(conf):
+def train(conf, resume=False):
     if not os.path.exists(conf.model_save_dir):
         os.makedirs(conf.model_save_dir, mode=0755)
 
-    settings = reader.Settings(
-        vocab=conf.vocab,
-        is_training=True,
-        label_schema=conf.label_schema,
-        negative_sample_ratio=conf.negative_sample_ratio,
-        hit_ans_negative_sample_ratio=conf.hit_ans_negative_sample_ratio,
-        keep_first_b=conf.keep_first_b,
-        seed=conf.seed)
+    settings = create_settings(conf)
     samples_per_pass = conf.batch_size * conf.batches_per_pass
-    train_reader = paddle.batch(
-        paddle.reader.buffered(
-            reader.create_reader(conf.train_data_path, settings,
-                                 samples_per_pass),
-            size=samples_per_pass),
-        batch_size=conf.batch_size)
+
+    # the questions are split into shards, one for every loader worker of
+    # every trainer process, each shard is sampled with its own random
+    # generator
+    workers_num = max(conf.loader_workers, 1)
+    num_shards = conf.num_trainers * workers_num
+    samples_per_shard = samples_per_pass // workers_num
+
+    # the state of every shard of the trainer, the state of its reader and of
+    # the random generator shuffling its batches, keyed by shard ids
+    shard_states = {}
+    # continue from the last checkpoint, the pass ids go on from it and the
+    # shards go on from their states saved with it
+    start_pass = 0
+    if resume:
+        last_pass = checkpoint.latest_checkpoint(conf.model_save_dir)
+        if last_pass is None:
+            logger.info("no checkpoint in %s, training from scratch" %
+                        conf.model_save_dir)
+        else:
+            start_pass = last_pass + 1
+            state = checkpoint.load_state(conf.model_save_dir, last_pass)
+            if state.get("seed") == conf.seed and \
+                    state.get("num_shards") == num_shards:
+                shard_states = state.get("shards", {})
+            else:
+                logger.info("the data shards have changed, the samples are "
+                            "drawn from the start")
+    if start_pass >= conf.num_passes:
+        logger.info("all the %d passes are trained." % conf.num_passes)
+        return
+
+    # the random generators shuffling the batches, keyed by worker ids
+    batch_randoms = {}
+
+    def create_batch_reader(worker_id):
+        shard_id = conf.trainer_id * workers_num + worker_id
+        state = shard_states.setdefault(str(shard_id), {})
+        # far from the generators of the readers of all the shards
+        batch_random = reader.shard_random(conf.seed, num_shards + shard_id)
+        if "batch_random" in state:
+            reader.restore_random(batch_random, state["batch_random"])
+        batch_randoms[worker_id] = batch_random
+        return batching.batch(
+            paddle.reader.buffered(
+                reader.create_reader(
+                    conf.train_data_path, settings, samples_per_shard,
+                    shard_id, num_shards, state.setdefault("reader", {})),
+                size=samples_per_shard),
+            batch_size=conf.batch_size,
+            window=conf.bucket_window,
+            max_tokens=conf.max_batch_tokens,
+            rng=batch_random)
+
+    def get_shard_state(worker_id):
+        """
+        :return: the state of the shard of a worker at the end of a pass
+        """
+        shard_id = conf.trainer_id * workers_num + worker_id
+        return {
+            "reader": dict(shard_states[str(shard_id)]["reader"]),
+            "batch_random": batch_randoms[worker_id].getstate()
+        }
+
+    process_loader = None
+    if conf.loader_workers > 0:
+        # the batches are made in worker processes, which are forked before
+        # paddle starts its threads, see loader.py
+        process_loader = loader.ProcessLoader(
+            create_batch_reader, conf.loader_workers, conf.loader_depth,
+            conf.loader_slot_bytes, conf.seed, get_shard_state)
+        train_reader = process_loader
+    else:
+        train_reader = create_batch_reader(0)
+
+    # times the batches and the iterations, see throughput.py
+    meter = throughput.ThroughputMeter(
+        conf.metrics_path, conf.metrics_max_bytes, conf.metrics_backups)
+    train_reader = meter.reader(train_reader)
 
     # TODO(lipeng17) v2 API does not support parallel_nn yet. Therefore, we can
     # only use CPU currently
@@ -87,6 +181,9 @@ def train(conf):
     # print parameter initialization info in the beginning of the first batch
     parameters = paddle.parameters.create(cost)
 
+    if start_pass > 0:
+        checkpoint.restore(parameters, conf.model_save_dir, start_pass - 1)
+
     # create optimizer
     rmsprop_optimizer = paddle.optimizer.RMSProp(
         learning_rate=conf.learning_rate,
@@ -105,47 +202,95 @@ def train(conf):
         """
         Define end batch and end pass event handler
         """
+        pass_id = start_pass + event.pass_id
         if isinstance(event, paddle.event.EndIteration):
+            meter.end_iteration(pass_id, event.batch_id, event.cost)
             sys.stderr.write(".")
             batch_num = event.batch_id + 1
-            total_batch = conf.batches_per_pass * event.pass_id + batch_num
+            total_batch = conf.batches_per_pass * pass_id + batch_num
             if batch_num % conf.log_period == 0:
                 sys.stderr.write("\n")
                 logger.info("Total batch=%d Batch=%d CurrentCost=%f Eval: %s" \
                         % (total_batch, batch_num, event.cost, event.metrics))
 
             if batch_num % conf.show_parameter_status_period == 0:
-                show_parameter_status(parameters)
+                stats.record(parameters, pass_id, event.batch_id)
         elif isinstance(event, paddle.event.EndPass):
-            save_model(trainer, conf.model_save_dir, parameters, event.pass_id)
+            meter.end_pass(pass_id)
+            if process_loader is not None:
+                worker_states = process_loader.states
+            else:
+                worker_states = {0: get_shard_state(0)}
+            checkpointer.save(trainer, parameters, pass_id, {
+                "seed": conf.seed,
+                "num_shards": num_shards,
+                "shards": dict(
+                    (str(conf.trainer_id * workers_num + worker_id), state)
+                    for worker_id, state in worker_states.iteritems())
+            })
         elif isinstance(event, paddle.event.BeginIteration):
-            if event.batch_id == 0 and event.pass_id == 0:
+            if event.batch_id == 0 and pass_id == 0:
                 show_parameter_init_info(parameters)
+            meter.begin_iteration()
 
     ## for debugging purpose
     #with utils.open_file("config", "w") as config:
     #    print >> config, paddle.layer.parse_network(cost)
 
-    trainer.train(
-        reader=train_reader,
-        event_handler=_event_handler,
-        feeding=network.feeding,
-        num_passes=conf.num_passes)
+    # the parameters are written in a background thread at the end of
+    # every pass
+    checkpointer = checkpoint.Checkpointer(
+        conf.model_save_dir, conf.keep_checkpoints, conf.val_eval_log)
+    # the parameter statistics are computed in a background thread as well
+    stats = param_stats.ParameterStats(
+        conf.parameter_status_path, conf.parameter_status_rows,
+        conf.parameter_status_bins, conf.seed)
+    with checkpointer, stats, meter:
+        trainer.train(
+            reader=train_reader,
+            event_handler=_event_handler,
+            feeding=network.feeding,
+            num_passes=conf.num_passes - start_pass)
+    if process_loader is not None:
+        process_loader.close()
 
     logger.info("Training has finished.")
 
 
-def main():
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the parameters being trained when the last "
+        "checkpoint in model_save_dir was saved, the RMSProp moments and "
+        "the model average are not saved and start from zero")
+    parser.add_argument(
+        "--check_resume",
+        action="store_true",
+        help="check that a resumed training draws the samples of an "
+        "uninterrupted one and exit, the data are loaded for every pass")
+    return parser.parse_args()
+
+
+def main(args):
     conf = config.TrainingConfig()
+    if args.check_resume:
+        # the results are logged, utils.logger only shows errors
+        logging.basicConfig()
+        logger.setLevel(logging.INFO)
+        conf.vocab = utils.load_dict(conf.word_dict_path,
+                                     conf.wordvecs_bin_path)
+        sys.exit(0 if check_resume(conf) else 1)
 
     logger.info("loading word embeddings...")
-    conf.vocab, conf.wordvecs = utils.load_wordvecs(conf.word_dict_path,
-                                                    conf.wordvecs_path)
+    conf.vocab, conf.wordvecs = utils.load_wordvecs(
+        conf.word_dict_path, conf.wordvecs_path, conf.wordvecs_bin_path)
     logger.info("loaded")
     logger.info("length of word dictionary is : %d." % len(conf.vocab))
 
-    train(conf)
+    train(conf, args.resume)
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_cmd())
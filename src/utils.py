@@ -1,11 +1,16 @@
 import argparse
 import gzip
 import logging
+import os
 import sys
+import threading
+import time
+from collections import OrderedDict
 import numpy
 
 __all__ = [
-    "open_file", "cumsum", "logger", "DotBar", "load_dict", "load_wordvecs"
+    "open_file", "cumsum", "logger", "DotBar", "LRUCache", "load_dict",
+    "load_wordvecs"
 ]
 
 logger = logging.getLogger("paddle")
@@ -89,7 +94,68 @@ class DotBar(object):
         return self.obj.next()
 
 
-def load_dict(word_dict_path):
+class LRUCache(object):
+    """
+    A thread safe mapping keeping the capacity most recently used items,
+    optionally expiring them ttl seconds after they are put
+    """
+
+    def __init__(self, capacity, ttl=0):
+        """
+        :param capacity: maximum number of items, 0 disables the cache
+        :type capacity: int
+        :param ttl: lifetime of the items in seconds, 0 for no expiry
+        :type ttl: float
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        # key -> (expire time, value)
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expire, value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire is not None and expire < time.time():
+                self.misses += 1
+                return default
+            self.items[key] = (expire, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        expire = time.time() + self.ttl if self.ttl > 0 else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expire, value)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+def load_dict(word_dict_path, binary_path=None):
+    # prefer the memory-mapped vocabulary written by embedding.py
+    if binary_path and os.path.exists(binary_path):
+        import embedding
+        return embedding.load_vocab(binary_path)
+
     with open_file(word_dict_path) as f:
         # the first word must be OOV
         vocab = {k.rstrip("\n").split()[0].decode("utf-8"):i \
@@ -97,7 +163,21 @@ def load_dict(word_dict_path):
     return vocab
 
 
-def load_wordvecs(word_dict_path, wordvecs_path):
+def load_wordvecs(word_dict_path, wordvecs_path, binary_path=None,
+                  tokens=None):
+    # only load the given tokens, see embedding.restrict
+    if tokens is not None:
+        import embedding
+        vocab, wordvecs, ids = embedding.load_restricted(
+            word_dict_path, wordvecs_path, tokens, binary_path)
+        assert len(vocab) == wordvecs.shape[0]
+        return vocab, wordvecs
+
+    # prefer the memory-mapped store written by embedding.py
+    if binary_path and os.path.exists(binary_path):
+        import embedding
+        return embedding.load(binary_path)
+
     vocab = load_dict(word_dict_path)
     wordvecs = numpy.loadtxt(wordvecs_path, delimiter=",", dtype="float32")
     assert len(vocab) == wordvecs.shape[0]
@@ -6,6 +6,7 @@ import subprocess
 import re
 
 import utils
+import embedding
 import infer
 import config
 from utils import logger
@@ -110,6 +111,10 @@ def parse_cmd():
     parser.add_argument(
         "--end_pass_id", type=int, default=24, help="this pass is included")
     parser.add_argument("--force_rerun", action="store_true")
+    parser.add_argument(
+        "--restrict_vocab",
+        action="store_true",
+        help="only load the words of the validation and test data")
     return parser.parse_args()
 
 
@@ -131,7 +136,15 @@ __tst_data = {
 
 def main(args):
     conf = config.InferConfig()
-    conf.vocab = utils.load_dict(conf.word_dict_path)
+    if args.restrict_vocab:
+        tokens = embedding.load_tokens(__val_data[args.data_type]) | \
+            embedding.load_tokens(__tst_data[args.data_type])
+        conf.vocab, conf.wordvecs = utils.load_wordvecs(
+            conf.word_dict_path, conf.wordvecs_path, conf.wordvecs_bin_path,
+            tokens)
+    else:
+        conf.vocab = utils.load_dict(conf.word_dict_path,
+                                     conf.wordvecs_bin_path)
     logger.info("length of word dictionary is : %d." % len(conf.vocab))
 
     if args.val_eval_output: